@@ -24,3 +24,6 @@ psql -v ON_ERROR_STOP=1 --username ${POSTGRES_USER} --dbname vlans <<-EOSQL
   (${VLAB_VLAN_ID_MAX}, 'noone', 'noone_max')
   ;
 EOSQL
+
+# Everything else in the schema is a versioned migration in
+# vlab_vlan/lib/worker/migrations.py, which the worker applies when it starts.
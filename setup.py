@@ -16,5 +16,6 @@ setup(name="vlab-vlan",
       description="A service for working with vLANs in vLab",
       long_description=open('README.rst').read(),
       install_requires=['flask', 'psycopg2', 'pyjwt', 'uwsgi', 'vlab-api-common',
-                        'ujson', 'cryptography', 'celery', 'vlab-inf-common']
+                        'ujson', 'cryptography', 'celery', 'vlab-inf-common'],
+      extras_require={'redis': ['redis']}
       )
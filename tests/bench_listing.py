@@ -0,0 +1,59 @@
+# -*- coding: UTF-8 -*-
+"""
+Measures how long listing one user's vLANs takes as the records table grows.
+With the person_vlans index the time should stay flat; without it, every
+listing reads the whole table.
+
+Needs a vLAN database with the current schema (see ``setup-db.sh`` and
+``database.migrate``). The extra records are added in a transaction that is
+rolled back, so the database is left as it was::
+
+    $ INF_DB_HOSTNAME=localhost python tests/bench_listing.py
+"""
+import time
+
+from vlab_vlan.lib.worker import database
+
+SIZES = (1000, 10000, 100000)
+RUNS = 200
+VLANS_PER_USER = 10
+
+
+def bench(cur, size):
+    """Add records until there are ``size`` of them, then time listing one user's vLANs.
+
+    :Returns: Tuple - (Float average seconds per listing, String query plan)
+    """
+    cur.execute("""SELECT count(*) FROM records;""")
+    have = cur.fetchone()[0]
+    if have < size:
+        # One switch per batch of 4000 tags keeps (switch_name, tag) unique
+        cur.execute("""INSERT INTO records(tag, person, vlan_name, switch_name, state) \
+                       SELECT n %% 4000, 'bench' || (n / %s), 'bench' || n, 'bench-switch-' || (n / 4000), 'ready' \
+                       FROM generate_series(%s, %s) n;""", (VLANS_PER_USER, have, size - 1))
+        cur.execute("""ANALYZE records;""")
+    cur.execute("""EXPLAIN """ + database._LIST_SQL, ('bench1',))
+    plan = '\n'.join([x[0] for x in cur.fetchall()])
+    started = time.perf_counter()
+    for _ in range(RUNS):
+        cur.execute(database._LIST_SQL, ('bench1',))
+        cur.fetchall()
+    return (time.perf_counter() - started) / RUNS, plan
+
+
+def main():
+    """Print the time to list one user's vLANs at each table size"""
+    database.migrate()
+    conn, cur = database.get_db_connection()
+    try:
+        for size in SIZES:
+            seconds, plan = bench(cur, size)
+            print('{:>8} records: {:.3f} ms per listing'.format(size, seconds * 1000))
+        print(plan)
+    finally:
+        conn.rollback()
+        database.release_db_connection(conn)
+
+
+if __name__ == '__main__':
+    main()
@@ -31,6 +31,16 @@ class TestVlanViewSchema(unittest.TestCase):
 
         self.assertTrue(schema_valid)
 
+    def test_get_args_schema(self):
+        """The schema defined for GET args on /api/1/inf/vlan is valid"""
+        try:
+            Draft4Validator.check_schema(vlan.VlanView.GET_ARGS_SCHEMA)
+            schema_valid = True
+        except RuntimeError:
+            schema_valid = False
+
+        self.assertTrue(schema_valid)
+
     def test_token_schema(self):
         """The schema defined for DELETE on /api/1/inf/vlan/token is valid"""
         try:
@@ -0,0 +1,151 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions and objects in cache.py
+"""
+import sys
+import unittest
+from unittest.mock import patch, MagicMock
+
+from vlab_vlan.lib import cache
+
+
+class TestMemoryCache(unittest.TestCase):
+    """A set of test cases for the ``MemoryCache`` object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.cache = cache.MemoryCache(max_size=2, ttl=30)
+
+    def test_get(self):
+        """MemoryCache - ``get`` returns what was set"""
+        self.cache.set('foo', {'bar': 1})
+
+        self.assertEqual(self.cache.get('foo'), {'bar': 1})
+
+    def test_get_missing(self):
+        """MemoryCache - ``get`` returns None for unknown keys"""
+        self.assertTrue(self.cache.get('foo') is None)
+
+    @patch.object(cache.time, 'time')
+    def test_get_expired(self, fake_time):
+        """MemoryCache - ``get`` returns None once an entry has expired"""
+        fake_time.return_value = 100
+        self.cache.set('foo', 'bar')
+        fake_time.return_value = 131
+
+        self.assertTrue(self.cache.get('foo') is None)
+
+    def test_lru(self):
+        """MemoryCache - evicts the least recently used entry once full"""
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+
+        self.assertTrue(self.cache.get('b') is None)
+        self.assertEqual(self.cache.get('a'), 1)
+
+    def test_counters(self):
+        """MemoryCache - ``stats`` reports the number of hits and misses"""
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+
+        stats = self.cache.stats()
+        expected = {'hits': 1, 'misses': 1, 'size': 1}
+
+        self.assertEqual(stats, expected)
+
+    def test_add(self):
+        """MemoryCache - ``add`` does not replace a valid entry"""
+        first = self.cache.add('a', 1)
+        second = self.cache.add('a', 2)
+
+        self.assertEqual((first, second, self.cache.get('a')), (True, False, 1))
+
+    @patch.object(cache.time, 'time')
+    def test_add_expired(self, fake_time):
+        """MemoryCache - ``add`` replaces an expired entry"""
+        fake_time.return_value = 100
+        self.cache.add('a', 1)
+        fake_time.return_value = 131
+
+        self.assertTrue(self.cache.add('a', 2))
+
+    def test_delete(self):
+        """MemoryCache - ``delete`` removes an entry"""
+        self.cache.set('a', 1)
+        self.cache.delete('a')
+
+        self.assertTrue(self.cache.get('a') is None)
+
+    def test_clear(self):
+        """MemoryCache - ``clear`` removes every entry and resets the counters"""
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.clear()
+
+        expected = {'hits': 0, 'misses': 0, 'size': 0}
+
+        self.assertEqual(self.cache.stats(), expected)
+
+
+class TestRedisCache(unittest.TestCase):
+    """A set of test cases for the ``RedisCache`` object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.fake_redis_module = MagicMock()
+        cls.fake_redis = cls.fake_redis_module.Redis.from_url.return_value
+        with patch.dict(sys.modules, {'redis': cls.fake_redis_module}):
+            cls.cache = cache.RedisCache('redis://localhost')
+
+    def test_get(self):
+        """RedisCache - ``get`` decodes the stored JSON"""
+        self.fake_redis.get.return_value = b'{"bar":1}'
+
+        self.assertEqual(self.cache.get('foo'), {'bar': 1})
+
+    def test_get_missing(self):
+        """RedisCache - ``get`` counts a miss when there's no entry"""
+        self.fake_redis.get.return_value = None
+        self.cache.get('foo')
+
+        self.assertEqual(self.cache.stats(), {'hits': 0, 'misses': 1})
+
+    def test_set(self):
+        """RedisCache - ``set`` stores the entry with the TTL"""
+        self.cache.set('foo', {'bar': 1})
+
+        self.fake_redis.set.assert_called_with('vlab-vlan:foo', '{"bar":1}', ex=30)
+
+    def test_add(self):
+        """RedisCache - ``add`` only creates an entry if it does not exist"""
+        self.fake_redis.set.return_value = None
+
+        self.assertFalse(self.cache.add('foo', 1))
+        self.assertTrue(self.fake_redis.set.call_args[1]['nx'])
+
+    def test_no_redis(self):
+        """RedisCache - raises RuntimeError if the redis package is not installed"""
+        with patch.dict(sys.modules, {'redis': None}):
+            with self.assertRaises(RuntimeError):
+                cache.RedisCache('redis://localhost')
+
+
+class TestGetCache(unittest.TestCase):
+    """A set of test cases for the ``get_cache`` function"""
+    def test_memory(self):
+        """get_cache - returns a MemoryCache by default"""
+        self.assertTrue(isinstance(cache.get_cache(url=''), cache.MemoryCache))
+
+    def test_redis(self):
+        """get_cache - returns a RedisCache when given a URL"""
+        with patch.dict(sys.modules, {'redis': MagicMock()}):
+            the_cache = cache.get_cache(url='redis://localhost')
+
+        self.assertTrue(isinstance(the_cache, cache.RedisCache))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,161 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the functions in callbacks.py
+"""
+import hmac
+import time
+import hashlib
+import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import ujson
+
+from vlab_vlan.lib.worker import callbacks
+
+
+class _Receiver(BaseHTTPRequestHandler):
+    """Stands in for the service that takes the callbacks"""
+    def do_POST(self):
+        """Record the callback, and answer with the next status code the test wants"""
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append((self.headers['X-Vlab-Signature'], body))
+        status = self.server.codes.pop(0) if self.server.codes else 200
+        self.send_response(status)
+        if status == 302:
+            self.send_header('Location', '/elsewhere')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        """Record a redirect that was followed"""
+        self.server.received.append((None, b''))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        """Keep the test output quiet"""
+        pass
+
+
+class TestCallbackSender(unittest.TestCase):
+    """A set of test cases for the ``CallbackSender`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.server = HTTPServer(('127.0.0.1', 0), _Receiver)
+        self.server.received = []
+        self.server.codes = []
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/done'.format(self.server.server_port)
+        self.sender = callbacks.CallbackSender(secret='shh', retries=2, timeout=2, backoff=0.01)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.sender.close(timeout=0)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _wait_for(self, count, timeout=5):
+        """Wait until the receiver has taken ``count`` callbacks"""
+        deadline = time.time() + timeout
+        while len(self.server.received) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_send(self):
+        """CallbackSender - ``send`` POSTs the payload to the URL"""
+        self.sender.send(self.url, {'task-id': 'some-task', 'error': None})
+        self._wait_for(1)
+
+        _, body = self.server.received[0]
+
+        self.assertEqual(ujson.loads(body), {'task-id': 'some-task', 'error': None})
+
+    def test_send_signed(self):
+        """CallbackSender - ``send`` signs the payload with an HMAC-SHA256 of the body"""
+        self.sender.send(self.url, {'task-id': 'some-task'})
+        self._wait_for(1)
+
+        signature, body = self.server.received[0]
+        expected = 'sha256={}'.format(hmac.new(b'shh', body, hashlib.sha256).hexdigest())
+
+        self.assertEqual(signature, expected)
+
+    def test_send_retry(self):
+        """CallbackSender - ``send`` sends the callback again if the receiver has an error"""
+        self.server.codes = [500, 503]
+        self.sender.send(self.url, {'task-id': 'some-task'})
+        self.sender.close()
+
+        self.assertEqual(len(self.server.received), 3)
+
+    def test_send_gives_up(self):
+        """CallbackSender - ``send`` stops sending a callback after ``retries`` more attempts"""
+        self.server.codes = [500, 500, 500, 500]
+        self.sender.send(self.url, {'task-id': 'some-task'})
+
+        dropped = self.sender.close()
+
+        self.assertEqual((dropped, len(self.server.received)), (0, 3))
+
+    def test_send_rejected(self):
+        """CallbackSender - ``send`` does not send a callback again if the receiver rejects it"""
+        self.server.codes = [400]
+        self.sender.send(self.url, {'task-id': 'some-task'})
+        self.sender.close()
+
+        self.assertEqual(len(self.server.received), 1)
+
+    def test_send_no_redirects(self):
+        """CallbackSender - ``send`` does not follow a redirect, or send the callback again"""
+        self.server.codes = [302]
+        self.sender.send(self.url, {'task-id': 'some-task'})
+        self.sender.close()
+
+        self.assertEqual(len(self.server.received), 1)
+
+    def test_send_too_many(self):
+        """CallbackSender - ``send`` drops callbacks once ``max_pending`` are waiting to be delivered"""
+        sender = callbacks.CallbackSender(secret='shh', max_pending=1, backoff=60)
+        # Nothing listens on the port, so the first callback waits to be sent again
+        sender.send('http://127.0.0.1:1/done', {'task-id': 'task-1'})
+
+        result = sender.send(self.url, {'task-id': 'task-2'})
+        sender.close(timeout=0)
+
+        self.assertFalse(result)
+
+    def test_close(self):
+        """CallbackSender - ``close`` returns how many callbacks were never delivered"""
+        sender = callbacks.CallbackSender(secret='shh', backoff=60)
+        sender.send('http://127.0.0.1:1/done', {'task-id': 'task-1'})
+
+        dropped = sender.close(timeout=0.2)
+
+        self.assertEqual(dropped, 1)
+
+    def test_close_waits(self):
+        """CallbackSender - ``close`` lets queued callbacks be delivered"""
+        for idx in range(3):
+            self.sender.send(self.url, {'task-id': 'task-{}'.format(idx)})
+
+        dropped = self.sender.close()
+
+        self.assertEqual((dropped, len(self.server.received)), (0, 3))
+
+    def test_send_after_idle(self):
+        """CallbackSender - ``send`` starts delivering again after ``close``"""
+        self.sender.send(self.url, {'task-id': 'task-1'})
+        self._wait_for(1)
+        self.sender.close()
+
+        self.sender.send(self.url, {'task-id': 'task-2'})
+        self._wait_for(2)
+
+        self.assertEqual(len(self.server.received), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,10 @@
 """
 A suite of tests for the functions in database.py
 """
+import time
+import uuid
 import unittest
+import threading
 from unittest.mock import patch, MagicMock
 
 import psycopg2
@@ -34,16 +37,20 @@ class TestDatabase(unittest.TestCase):
         cls.fake_cur = MagicMock()
         cls.fake_conn = MagicMock()
         cls.fake_conn.cursor.return_value = cls.fake_cur
+        cls.fake_conn.closed = 0
         cls.fake_psycopg2_connect.return_value = cls.fake_conn
+        database.close_pool()
+        database.vlan_cache.clear()
 
     @classmethod
     def tearDown(cls):
         """Runs after every test case"""
-        cls.fake_psycopg2_connect.stop()
+        cls.patcher.stop()
+        database.close_pool()
 
     def test_get_vlan_no_strip_name(self):
         """database - ``get_vlan`` does not strip the username off the vLAN name"""
-        self.fake_cur.fetchall.return_value = [('alice_smith_vlanA', 100)]
+        self.fake_cur.fetchall.return_value = [('alice_smith_vlanA', 100, None, None, 'ready')]
 
         result = database.get_vlan(username='alice_smith')
         expected = {'alice_smith_vlanA': 100}
@@ -59,15 +66,113 @@ class TestDatabase(unittest.TestCase):
 
     def test_get_vlan(self):
         """database - ``get_vlan`` returns a dictionary"""
-        self.fake_cur.fetchall.return_value = [('vlanA', 100), ('vlanB', 101)]
+        self.fake_cur.fetchall.return_value = [('vlanA', 100, None, None, 'ready'), ('vlanB', 101, None, None, 'ready')]
 
         result = database.get_vlan(username='alice')
         expected = {'vlanA': 100, 'vlanB': 101}
 
         self.assertEqual(result, expected)
 
-    def test_get_vlan_closes(self):
-        """database - ``get_vlan`` always closes the DB connection"""
+    def test_get_db_connection_reuses(self):
+        """database - ``get_db_connection`` reuses pooled connections"""
+        conn, _ = database.get_db_connection()
+        database.release_db_connection(conn)
+        conn, _ = database.get_db_connection()
+        database.release_db_connection(conn)
+
+        self.assertEqual(self.fake_psycopg2_connect.call_count, 1)
+
+    def test_get_db_connection_dead(self):
+        """database - ``get_db_connection`` replaces connections that have died"""
+        conn, _ = database.get_db_connection()
+        database.release_db_connection(conn)
+        self.fake_conn.closed = 2
+        new_conn = MagicMock()
+        new_conn.closed = 0
+        self.fake_psycopg2_connect.return_value = new_conn
+
+        conn, _ = database.get_db_connection()
+
+        self.assertTrue(conn is new_conn)
+
+    def test_get_db_connection_ping(self):
+        """database - ``get_db_connection`` pings connections that have been idle too long"""
+        conn, _ = database.get_db_connection()
+        database.release_db_connection(conn)
+        database._LAST_USED[id(conn)] = 0
+
+        database.get_db_connection()
+
+        self.fake_cur.execute.assert_called_with('SELECT 1;')
+
+    def test_get_db_connection_ping_fails(self):
+        """database - ``get_db_connection`` replaces idle connections that fail the ping"""
+        conn, _ = database.get_db_connection()
+        database.release_db_connection(conn)
+        database._LAST_USED[id(conn)] = 0
+        self.fake_cur.execute.side_effect = psycopg2.OperationalError('testing')
+        new_conn = MagicMock()
+        new_conn.closed = 0
+        self.fake_psycopg2_connect.return_value = new_conn
+
+        conn, _ = database.get_db_connection()
+
+        self.assertTrue(conn is new_conn)
+
+    def test_release_db_connection_broken(self):
+        """database - ``release_db_connection`` discards broken connections"""
+        conn, _ = database.get_db_connection()
+        self.fake_conn.closed = 2
+        database.release_db_connection(conn)
+        self.fake_conn.closed = 0
+
+        database.get_db_connection()
+
+        self.assertEqual(self.fake_psycopg2_connect.call_count, 2)
+
+    def test_get_db_connection_waits(self):
+        """database - ``get_db_connection`` waits for a connection when every one is checked out"""
+        database.init_pool(minconn=1, maxconn=1)
+        conn, _ = database.get_db_connection()
+        timer = threading.Timer(0.05, database.release_db_connection, args=(conn,))
+        timer.start()
+
+        again, _ = database.get_db_connection()
+        timer.join()
+
+        self.assertTrue(again is conn)
+
+    def test_get_db_connection_timeout(self):
+        """database - ``get_db_connection`` raises OperationalError if no connection is handed back in time"""
+        database.init_pool(minconn=1, maxconn=1)
+        database.get_db_connection()
+
+        with patch.object(database, 'const', database.const._replace(INF_DB_POOL_TIMEOUT=0.01)):
+            with self.assertRaises(psycopg2.OperationalError):
+                database.get_db_connection()
+
+    def test_release_db_connection_slot(self):
+        """database - ``release_db_connection`` lets another caller check out a connection"""
+        database.init_pool(minconn=1, maxconn=1)
+        conn, _ = database.get_db_connection()
+        database.release_db_connection(conn)
+
+        with patch.object(database, 'const', database.const._replace(INF_DB_POOL_TIMEOUT=0.01)):
+            again, _ = database.get_db_connection()
+
+        self.assertTrue(again is conn)
+
+    def test_init_pool(self):
+        """database - ``init_pool`` closes the connections of any existing pool"""
+        conn, _ = database.get_db_connection()
+        database.release_db_connection(conn)
+
+        database.init_pool()
+
+        self.assertTrue(self.fake_conn.close.called)
+
+    def test_get_vlan_releases(self):
+        """database - ``get_vlan`` always returns the DB connection to the pool"""
         self.fake_cur.execute.side_effect = RuntimeError('testing')
 
         try:
@@ -75,7 +180,102 @@ class TestDatabase(unittest.TestCase):
         except RuntimeError:
             pass
 
-        self.assertTrue(self.fake_conn.close.called)
+        self.assertEqual(database._POOL._used, {})
+
+    def test_get_vlan_cached(self):
+        """database - ``get_vlan`` answers repeat lookups from the cache"""
+        self.fake_cur.fetchall.return_value = [('vlanA', 100, None, None, 'ready')]
+
+        database.get_vlan(username='alice')
+        result = database.get_vlan(username='alice')
+
+        self.assertEqual(result, {'vlanA': 100})
+        # One query for the version, one for the vLANs
+        self.assertEqual(self.fake_cur.execute.call_count, 2)
+
+    def test_get_vlan_no_cache(self):
+        """database - ``get_vlan`` reads the database when told not to use the cache"""
+        self.fake_cur.fetchall.return_value = [('vlanA', 100, None, None, 'ready')]
+
+        database.get_vlan(username='alice')
+        database.get_vlan(username='alice', use_cache=False)
+
+        self.assertEqual(self.fake_cur.execute.call_count, 4)
+
+    def test_get_vlan_copy(self):
+        """database - changing what ``get_vlan`` returns does not change the cache"""
+        self.fake_cur.fetchall.return_value = [('vlanA', 100, None, None, 'ready')]
+
+        database.get_vlan(username='alice')['vlanB'] = 101
+        result = database.get_vlan(username='alice')
+
+        self.assertEqual(result, {'vlanA': 100})
+
+    def test_invalidate_vlan_cache(self):
+        """database - ``invalidate_vlan_cache`` makes the next ``get_vlan`` read the database"""
+        self.fake_cur.fetchall.return_value = [('vlanA', 100, None, None, 'ready')]
+
+        database.get_vlan(username='alice')
+        database.invalidate_vlan_cache(username='alice')
+        database.get_vlan(username='alice')
+
+        self.assertEqual(self.fake_cur.execute.call_count, 4)
+
+    def test_get_vlan_min_version(self):
+        """database - ``get_vlan`` ignores cached answers older than ``min_version``"""
+        self.fake_cur.fetchone.return_value = (3,)
+        self.fake_cur.fetchall.return_value = [('vlanA', 100, None, None, 'ready')]
+        database.get_vlan(username='alice')
+        self.fake_cur.fetchone.return_value = (4,)
+        self.fake_cur.fetchall.return_value = [('vlanA', 100, None, None, 'ready'), ('vlanB', 101, None, None, 'ready')]
+
+        result = database.get_vlan(username='alice', min_version=4)
+
+        self.assertEqual(result, {'vlanA': 100, 'vlanB': 101})
+
+    def test_get_vlan_min_version_cached(self):
+        """database - ``get_vlan`` uses the cache when it is new enough for ``min_version``"""
+        self.fake_cur.fetchone.return_value = (3,)
+        self.fake_cur.fetchall.return_value = [('vlanA', 100, None, None, 'ready')]
+        database.get_vlan(username='alice')
+
+        database.get_vlan(username='alice', min_version=3)
+
+        self.assertEqual(self.fake_cur.execute.call_count, 2)
+
+    def test_get_vlan_version_first(self):
+        """database - ``get_vlan`` reads the version before reading the vLANs"""
+        self.fake_cur.fetchone.return_value = (3,)
+        database.get_vlan(username='alice')
+
+        first_sql = self.fake_cur.execute.call_args_list[0][0][0]
+
+        self.assertTrue('versions' in first_sql)
+
+    def test_get_version(self):
+        """database - ``get_version`` returns the version of the user's records"""
+        self.fake_cur.fetchone.return_value = (7,)
+
+        result = database.get_version(username='alice')
+
+        self.assertEqual(result, 7)
+
+    def test_get_version_new_user(self):
+        """database - ``get_version`` returns zero for a user that has never had a vLAN"""
+        self.fake_cur.fetchone.return_value = None
+
+        result = database.get_version(username='alice')
+
+        self.assertEqual(result, 0)
+
+    def test_get_version_not_cached(self):
+        """database - ``get_version`` always reads the database"""
+        self.fake_cur.fetchone.return_value = (7,)
+
+        database.get_version(username='alice')
+        database.get_version(username='alice')
+
+        self.assertEqual(self.fake_cur.execute.call_count, 2)
 
     def test_delete_vlan(self):
         """database - ``delete_vlan`` returns None when delete succeeds"""
@@ -105,8 +305,8 @@ class TestDatabase(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             database.delete_vlan(vlan_name='someVlan', username='bob')
 
-    def test_delete_vlan_closes(self):
-        """database - ``delete_vlan`` always closes the DB connection"""
+    def test_delete_vlan_releases(self):
+        """database - ``delete_vlan`` always returns the DB connection to the pool"""
         self.fake_cur.execute.side_effect = RuntimeError('testing')
 
         try:
@@ -114,53 +314,700 @@ class TestDatabase(unittest.TestCase):
         except RuntimeError:
             pass
 
-        self.assertTrue(self.fake_conn.close.called)
+        self.assertEqual(database._POOL._used, {})
 
     def test_register_vlan(self):
         """database - ``register_vlan`` returns the vlan tag id upon success"""
-        self.fake_cur.fetchall.return_value = [(200,)]
+        self.fake_cur.fetchone.return_value = (200,)
         fake_logger = MagicMock()
 
-        vlan_id = database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger)
+        vlan_id = database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='someSwitch')
         expected = 200
 
         self.assertEqual(vlan_id, expected)
 
-    def test_register_vlan_runtime_error(self):
+    def test_register_vlan_commits(self):
+        """database - ``register_vlan`` commits the claimed tag and new record"""
+        self.fake_cur.fetchone.return_value = (200,)
+        fake_logger = MagicMock()
+
+        database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='someSwitch')
+
+        self.assertTrue(self.fake_conn.commit.called)
+
+    def test_register_vlan_one_query(self):
+        """database - ``register_vlan`` claims a tag and records the vLAN in a single query"""
+        self.fake_cur.fetchone.return_value = (200,)
+        fake_logger = MagicMock()
+
+        database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='someSwitch')
+
+        self.assertEqual(self.fake_cur.execute.call_count, 1)
+
+    @patch.object(database, 'get_switch_pools', return_value={'someSwitch': (100, 4000), 'newSwitch': (100, 4000)})
+    def test_register_vlan_runtime_error(self, fake_get_switch_pools):
         """database - ``register_vlan`` raises RuntimeError if no vlan tags available"""
-        self.fake_cur.fetchall.return_value = [(200,)]
-        self.fake_cur.rowcount = 0
-        self.fake_cur.execute.side_effect = [MagicMock(),
-                                             FakeIntegrityError23505(),
-                                             MagicMock(),
-                                            ]
+        self.fake_cur.fetchone.return_value = None
         fake_logger = MagicMock()
         with self.assertRaises(RuntimeError):
-            database.register_vlan(username='bob', vlan_name='someVlan', logger=fake_logger)
+            database.register_vlan(username='bob', vlan_name='someVlan', logger=fake_logger, switch_name='someSwitch')
 
     def test_register_vlan_dberror(self):
         """database - ``register_vlan`` raises any the IntegrityError if the pgcode is not 23505"""
-        self.fake_cur.fetchall.return_value = [(200,)]
         self.fake_cur.rowcount = 0
-        self.fake_cur.execute.side_effect = [MagicMock(),
-                                             FakeIntegrityError23504(),
+        self.fake_cur.execute.side_effect = [FakeIntegrityError23504(),
                                              MagicMock(),
                                             ]
         fake_logger = MagicMock()
         with self.assertRaises(psycopg2.DatabaseError):
-            database.register_vlan(username='bob', vlan_name='someVlan', logger=fake_logger)
+            database.register_vlan(username='bob', vlan_name='someVlan', logger=fake_logger, switch_name='someSwitch')
 
     def test_register_vlan_valueerror(self):
         """database - ``register_vlan`` raises ValueError if a vlan with the same name already exists"""
-        self.fake_cur.fetchall.return_value = [(200,)]
         self.fake_cur.rowcount = 1
-        self.fake_cur.execute.side_effect = [MagicMock(),
-                                             FakeIntegrityError23505(),
+        self.fake_cur.execute.side_effect = [FakeIntegrityError23505(),
+                                             MagicMock(),
+                                            ]
+        fake_logger = MagicMock()
+        with self.assertRaises(ValueError):
+            database.register_vlan(username='bob', vlan_name='someVlan', logger=fake_logger, switch_name='someSwitch')
+
+    @patch.object(database, 'get_switch_pools', return_value={'someSwitch': (100, 4000), 'newSwitch': (100, 4000)})
+    def test_register_vlan_releases(self, fake_get_switch_pools):
+        """database - ``register_vlan`` returns the DB connection to the pool upon failure"""
+        self.fake_cur.fetchone.return_value = None
+        fake_logger = MagicMock()
+        try:
+            database.register_vlan(username='bob', vlan_name='someVlan', logger=fake_logger, switch_name='someSwitch')
+        except RuntimeError:
+            pass
+
+        self.assertEqual(database._POOL._used, {})
+
+    def test_register_vlan_rollback(self):
+        """database - ``register_vlan`` rolls back so the claimed tag is not lost when the name is taken"""
+        self.fake_cur.rowcount = 1
+        self.fake_cur.execute.side_effect = [FakeIntegrityError23505(),
                                              MagicMock(),
                                             ]
         fake_logger = MagicMock()
+        try:
+            database.register_vlan(username='bob', vlan_name='someVlan', logger=fake_logger, switch_name='someSwitch')
+        except ValueError:
+            pass
+
+        self.assertTrue(self.fake_conn.rollback.called)
+
+    def test_register_vlans(self):
+        """database - ``register_vlans`` returns the tag ids of the registered vLANs, and any errors"""
+        self.fake_cur.fetchone.side_effect = [(200,), (201,)]
+        fake_logger = MagicMock()
+
+        result = database.register_vlans(username='alice', vlan_names=['vlanA', 'vlanB'], logger=fake_logger, switch_name='someSwitch')
+        expected = ({'vlanA': 200, 'vlanB': 201}, {})
+
+        self.assertEqual(result, expected)
+
+    def test_register_vlans_one_commit(self):
+        """database - ``register_vlans`` registers every vLAN in a single transaction"""
+        self.fake_cur.fetchone.side_effect = [(200,), (201,)]
+        fake_logger = MagicMock()
+
+        database.register_vlans(username='alice', vlan_names=['vlanA', 'vlanB'], logger=fake_logger, switch_name='someSwitch')
+
+        self.assertEqual(self.fake_conn.commit.call_count, 1)
+
+    def test_register_vlans_name_taken(self):
+        """database - ``register_vlans`` reports taken names without failing the other vLANs"""
+        self.fake_cur.fetchone.side_effect = [(201,)]
+        self.fake_cur.execute.side_effect = [FakeIntegrityError23505(), MagicMock(), MagicMock()]
+        fake_logger = MagicMock()
+
+        tags, errors = database.register_vlans(username='alice', vlan_names=['vlanA', 'vlanB'], logger=fake_logger, switch_name='someSwitch')
+
+        self.assertEqual(tags, {'vlanB': 201})
+        self.assertEqual(list(errors.keys()), ['vlanA'])
+
+    @patch.object(database, 'get_switch_pools', return_value={'someSwitch': (100, 4000), 'newSwitch': (100, 4000)})
+    def test_register_vlans_no_tags(self, fake_get_switch_pools):
+        """database - ``register_vlans`` reports an error for vLANs when tags run out"""
+        # The 2nd None is from trying to add a pool for a switch that already has one
+        self.fake_cur.fetchone.side_effect = [(200,), None, None]
+        fake_logger = MagicMock()
+
+        tags, errors = database.register_vlans(username='alice', vlan_names=['vlanA', 'vlanB'], logger=fake_logger, switch_name='someSwitch')
+
+        self.assertEqual(tags, {'vlanA': 200})
+        self.assertEqual(list(errors.keys()), ['vlanB'])
+
+    def test_register_vlans_dberror(self):
+        """database - ``register_vlans`` raises any IntegrityError if the pgcode is not 23505"""
+        self.fake_cur.execute.side_effect = [FakeIntegrityError23504(), MagicMock()]
+        fake_logger = MagicMock()
+
+        with self.assertRaises(psycopg2.DatabaseError):
+            database.register_vlans(username='alice', vlan_names=['vlanA'], logger=fake_logger, switch_name='someSwitch')
+
+    def test_delete_vlans(self):
+        """database - ``delete_vlans`` returns the deleted vLANs and their old tag ids"""
+        self.fake_cur.fetchall.return_value = [('vlanA', 200)]
+
+        result = database.delete_vlans(vlan_names=['vlanA', 'vlanB'], username='alice')
+        expected = {'vlanA': 200}
+
+        self.assertEqual(result, expected)
+
+    def test_delete_vlans_one_query(self):
+        """database - ``delete_vlans`` removes every vLAN with a single query"""
+        self.fake_cur.fetchall.return_value = [('vlanA', 200), ('vlanB', 201)]
+
+        database.delete_vlans(vlan_names=['vlanA', 'vlanB'], username='alice')
+
+        self.assertEqual(self.fake_cur.execute.call_count, 1)
+
+
+    def test_get_vlan_details(self):
+        """database - ``get_vlan_details`` returns the tag, switch and portgroup of each vLAN"""
+        self.fake_cur.fetchall.return_value = [('vlanA', 100, 'someSwitch', 'dvportgroup-1', 'ready')]
+
+        result = database.get_vlan_details(username='alice')
+        expected = {'vlanA': {'tag': 100, 'switch': 'someSwitch', 'portgroup': 'dvportgroup-1', 'state': 'ready'}}
+
+        self.assertEqual(result, expected)
+
+    def test_register_vlan_switch(self):
+        """database - ``register_vlan`` records the switch the vLAN is made on"""
+        self.fake_cur.fetchone.return_value = (200,)
+        fake_logger = MagicMock()
+
+        database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='someSwitch')
+        the_args = self.fake_cur.execute.call_args[0][1]
+
+        self.assertEqual(the_args['switch_name'], 'someSwitch')
+
+    def test_record_portgroups(self):
+        """database - ``record_portgroups`` updates every record with a single query"""
+        self.fake_cur.rowcount = 2
+
+        result = database.record_portgroups({'vlanA': ('someSwitch', 'dvportgroup-1'),
+                                             'vlanB': ('someSwitch', 'dvportgroup-2')})
+
+        self.assertEqual(result, 2)
+        self.assertEqual(self.fake_cur.execute.call_count, 1)
+        self.assertTrue(self.fake_conn.commit.called)
+
+    def test_get_unmapped_vlans(self):
+        """database - ``get_unmapped_vlans`` maps the name of each vLAN without a portgroup to its owner"""
+        self.fake_cur.fetchall.return_value = [('alice_vlanA', 'alice')]
+
+        result = database.get_unmapped_vlans()
+        expected = {'alice_vlanA': 'alice'}
+
+        self.assertEqual(result, expected)
+
+    @patch.object(database, 'get_switch_pools', return_value={'someSwitch': (100, 4000), 'newSwitch': (100, 4000)})
+    def test_register_vlan_new_switch(self, fake_get_switch_pools):
+        """database - ``register_vlan`` makes a pool of tags for a switch with no pool, then claims a tag"""
+        self.fake_cur.fetchone.side_effect = [None, (100,)]
+        fake_logger = MagicMock()
+
+        vlan_id = database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='newSwitch')
+        pool_sql = self.fake_cur.execute.call_args_list[1][0][0]
+
+        self.assertEqual(vlan_id, 100)
+        self.assertTrue('INSERT INTO tag_pools' in pool_sql)
+        self.assertEqual(self.fake_cur.execute.call_count, 3)
+
+    @patch.object(database, 'get_switch_pools', return_value={'someSwitch': (100, 4000), 'newSwitch': (100, 4000)})
+    def test_register_vlan_pool_empty(self, fake_get_switch_pools):
+        """database - ``register_vlan`` raises RuntimeError if the switch's pool exists, but has no free tags"""
+        self.fake_cur.fetchone.side_effect = [None, None]
+        fake_logger = MagicMock()
+
+        with self.assertRaises(RuntimeError):
+            database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='someSwitch')
+
+    @patch.object(database, 'get_switch_pools', return_value={'someSwitch': (100, 4000), 'newSwitch': (100, 4000)})
+    def test_register_vlan_pool_made_elsewhere(self, fake_get_switch_pools):
+        """database - ``register_vlan`` claims again when another transaction made the switch's pool"""
+        self.fake_cur.fetchone.side_effect = [None, (100,)]
+        fake_logger = MagicMock()
+
+        vlan_id = database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='newSwitch')
+
+        self.assertEqual(vlan_id, 100)
+        self.assertEqual(self.fake_cur.execute.call_count, 3)
+
+    @patch.object(database, 'get_switch_pools', return_value={'newSwitch': (2, 4094)})
+    def test_register_vlan_switch_range(self, fake_get_switch_pools):
+        """database - ``register_vlan`` makes the pool of a new switch with the range set in ``VLAB_VLAN_SWITCHES``"""
+        self.fake_cur.fetchone.side_effect = [None, (2,)]
+        fake_logger = MagicMock()
+
+        database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='newSwitch')
+        pool_args = self.fake_cur.execute.call_args_list[1][0][1]
+
+        self.assertEqual(pool_args, ('newSwitch', 2, 4094))
+
+    @patch.object(database, 'get_switch_pools', return_value={})
+    def test_register_vlan_unknown_switch(self, fake_get_switch_pools):
+        """database - ``register_vlan`` raises ValueError, and makes no pool, for a switch that is not listed and has no pool"""
+        self.fake_cur.fetchone.side_effect = [None, None]
+        fake_logger = MagicMock()
+
+        with self.assertRaises(ValueError):
+            database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='typoSwitch')
+        all_sql = ' '.join(x[0][0] for x in self.fake_cur.execute.call_args_list)
+
+        self.assertFalse('INSERT INTO tag_pools' in all_sql)
+
+    @patch.object(database, 'get_switch_pools', return_value={})
+    def test_register_vlan_unlisted_pool(self, fake_get_switch_pools):
+        """database - ``register_vlan`` uses the pool of a switch that is not listed, but already has one"""
+        self.fake_cur.fetchone.side_effect = [None, (1,)]
+        fake_logger = MagicMock()
+
+        with self.assertRaises(RuntimeError):
+            database.register_vlan(username='alice', vlan_name='wootVlan', logger=fake_logger, switch_name='oldSwitch')
+        all_sql = ' '.join(x[0][0] for x in self.fake_cur.execute.call_args_list)
+
+        self.assertFalse('INSERT INTO tag_pools' in all_sql)
+
+    @patch.object(database, 'get_switch_pools', return_value={})
+    def test_register_vlans_unknown_switch(self, fake_get_switch_pools):
+        """database - ``register_vlans`` reports an error for every vLAN on an unknown switch"""
+        self.fake_cur.fetchone.return_value = None
+        fake_logger = MagicMock()
+
+        tags, errors = database.register_vlans(username='alice', vlan_names=['vlanA', 'vlanB'], logger=fake_logger, switch_name='typoSwitch')
+
+        self.assertEqual(tags, {})
+        self.assertEqual(sorted(errors.keys()), ['vlanA', 'vlanB'])
+
+    def test_get_switch_pools(self):
+        """database - ``get_switch_pools`` uses the default range for switches listed without one"""
+        result = database.get_switch_pools(['switchA', 'switchB:2-4094'], tag_min=100, tag_max=4000)
+        expected = {'switchA': (100, 4000), 'switchB': (2, 4094)}
+
+        self.assertEqual(result, expected)
+
+    def test_claim_warm_portgroup(self):
+        """database - ``claim_warm_portgroup`` returns the tag and portgroup id it claimed"""
+        self.fake_cur.fetchone.return_value = (200, 'dvportgroup-1')
+
+        result = database.claim_warm_portgroup(username='alice', vlan_name='vlanA', switch_name='someSwitch')
+        expected = (200, 'dvportgroup-1')
+
+        self.assertEqual(result, expected)
+        self.assertTrue(self.fake_conn.commit.called)
+
+    def test_claim_warm_portgroup_empty(self):
+        """database - ``claim_warm_portgroup`` returns None if the switch has no warm portgroups"""
+        self.fake_cur.fetchone.return_value = None
+
+        result = database.claim_warm_portgroup(username='alice', vlan_name='vlanA', switch_name='someSwitch')
+
+        self.assertEqual(result, None)
+
+    def test_claim_warm_portgroup_stats(self):
+        """database - ``claim_warm_portgroup`` only counts hits and misses when asked to"""
+        self.fake_cur.fetchone.return_value = None
+        database.claim_warm_portgroup(username='alice', vlan_name='vlanA', switch_name='someSwitch', record_stats=False)
+
+        the_sql = self.fake_cur.execute.call_args[0][0]
+
+        self.assertFalse('warm_pool_stats' in the_sql)
+
+    def test_claim_warm_portgroup_valueerror(self):
+        """database - ``claim_warm_portgroup`` raises ValueError if a vlan with the same name already exists"""
+        self.fake_cur.execute.side_effect = [FakeIntegrityError23505()]
+
+        with self.assertRaises(ValueError):
+            database.claim_warm_portgroup(username='alice', vlan_name='vlanA', switch_name='someSwitch')
+
+    def test_reserve_warm_tags(self):
+        """database - ``reserve_warm_tags`` returns the reserved tags"""
+        self.fake_cur.fetchall.return_value = [(201,), (200,)]
+
+        result = database.reserve_warm_tags('someSwitch', 2)
+        expected = [200, 201]
+
+        self.assertEqual(result, expected)
+
+    @patch.object(database, 'get_switch_pools', return_value={'someSwitch': (100, 4000), 'newSwitch': (100, 4000)})
+    def test_reserve_warm_tags_new_switch(self, fake_get_switch_pools):
+        """database - ``reserve_warm_tags`` makes a pool of tags for a switch without one"""
+        self.fake_cur.fetchall.side_effect = [[], [(200,)]]
+
+        result = database.reserve_warm_tags('someSwitch', 2)
+
+        self.assertEqual(result, [200])
+
+    @patch.object(database, 'get_switch_pools', return_value={})
+    def test_reserve_warm_tags_unknown_switch(self, fake_get_switch_pools):
+        """database - ``reserve_warm_tags`` raises ValueError for a switch that is not listed and has no pool"""
+        self.fake_cur.fetchall.return_value = []
+        self.fake_cur.fetchone.return_value = None
+
         with self.assertRaises(ValueError):
-            database.register_vlan(username='bob', vlan_name='someVlan', logger=fake_logger)
+            database.reserve_warm_tags('typoSwitch', 2)
+
+    def test_get_warm_pool_stats(self):
+        """database - ``get_warm_pool_stats`` maps the switch name to its counters"""
+        self.fake_cur.fetchall.return_value = [('someSwitch', 1, 2, 3, 4)]
+
+        result = database.get_warm_pool_stats()
+        expected = {'someSwitch': {'hits': 1, 'misses': 2, 'ready': 3, 'pending': 4}}
+
+        self.assertEqual(result, expected)
+
+    def test_start_provisioning(self):
+        """database - ``start_provisioning`` returns the tag and warm portgroup of a reserved vLAN"""
+        self.fake_cur.fetchone.return_value = (200, None)
+
+        result = database.start_provisioning(username='alice', vlan_name='vlanA')
+        expected = (200, None)
+
+        self.assertEqual(result, expected)
+
+    def test_start_provisioning_not_reserved(self):
+        """database - ``start_provisioning`` returns None if the vLAN is not reserved"""
+        self.fake_cur.fetchone.return_value = None
+
+        result = database.start_provisioning(username='alice', vlan_name='vlanA')
+
+        self.assertTrue(result is None)
+
+    def test_fail_vlan(self):
+        """database - ``fail_vlan`` saves the error"""
+        database.fail_vlan(username='alice', vlan_name='vlanA', error='some error')
+
+        the_args, _ = self.fake_cur.execute.call_args
+        self.assertEqual(the_args[1], ('some error', 'alice', 'vlanA'))
+        self.assertTrue(self.fake_conn.commit.called)
+
+    def test_get_vlan_by_task(self):
+        """database - ``get_vlan_by_task`` returns the vLAN a task is making"""
+        self.fake_cur.fetchone.return_value = ('alice_vlanA', 200, 'someSwitch', 'failed', 'some error')
+
+        result = database.get_vlan_by_task(username='alice', task_id='asdf')
+        expected = {'vlan_name': 'alice_vlanA', 'tag': 200, 'switch': 'someSwitch', 'state': 'failed', 'error': 'some error'}
+
+        self.assertEqual(result, expected)
+
+    def test_get_vlan_by_task_none(self):
+        """database - ``get_vlan_by_task`` returns None for tasks that don't make a vLAN"""
+        self.fake_cur.fetchone.return_value = None
+
+        result = database.get_vlan_by_task(username='alice', task_id='asdf')
+
+        self.assertTrue(result is None)
+
+    def test_register_vlan_reserved(self):
+        """database - ``register_vlan`` saves the state and task id of the new vLAN"""
+        self.fake_cur.fetchone.return_value = (200,)
+
+        database.register_vlan(username='alice', vlan_name='vlanA', logger=MagicMock(),
+                               switch_name='someSwitch', state='reserved', task_id='asdf')
+
+        the_args, _ = self.fake_cur.execute.call_args
+        self.assertEqual((the_args[1]['state'], the_args[1]['task_id']), ('reserved', 'asdf'))
+
+    def test_get_warm_pool_targets(self):
+        """database - ``get_warm_pool_targets`` uses the default size for switches without one, and skips empty pools"""
+        result = database.get_warm_pool_targets(switches=['switchA', 'switchB:10', 'switchC:0'], default_size=3)
+        expected = {'switchA': 3, 'switchB': 10}
+
+        self.assertEqual(result, expected)
+
+
+    def test_mark_deleting(self):
+        """database - ``mark_deleting`` maps the name of each of the user's vLANs to what happened to it"""
+        self.fake_cur.fetchall.return_value = [('vlanA', 'deleting'), ('vlanB', 'provisioning')]
+
+        result = database.mark_deleting(username='alice', vlan_names=['vlanA', 'vlanB', 'vlanC'])
+
+        self.assertEqual(result, {'vlanA': 'deleting', 'vlanB': 'provisioning'})
+        self.assertTrue(self.fake_conn.commit.called)
+
+    def test_mark_deleting_all(self):
+        """database - ``mark_deleting`` marks every vLAN the user owns when no names are given"""
+        self.fake_cur.fetchall.return_value = []
+
+        database.mark_deleting(username='alice')
+
+        the_args, _ = self.fake_cur.execute.call_args
+        self.assertEqual(the_args[1], {'person': 'alice', 'vlan_names': None})
+
+    def test_claim_deleting(self):
+        """database - ``claim_deleting`` returns a dictionary for each vLAN it takes"""
+        self.fake_cur.fetchall.return_value = [('vlanA', 'alice', 'someSwitch', 200, 'dvportgroup-1', 0)]
+
+        result = database.claim_deleting()
+        expected = [{'vlan_name': 'vlanA', 'person': 'alice', 'switch': 'someSwitch', 'tag': 200,
+                     'portgroup': 'dvportgroup-1', 'attempts': 0}]
+
+        self.assertEqual(result, expected)
+
+    def test_claim_deleting_names(self):
+        """database - ``claim_deleting`` can take only the vLANs with some names"""
+        self.fake_cur.fetchall.return_value = []
+
+        database.claim_deleting(limit=None, vlan_names=('vlanA',))
+
+        the_args, _ = self.fake_cur.execute.call_args
+        self.assertEqual((the_args[1]['limit'], the_args[1]['vlan_names']), (None, ['vlanA']))
+
+    def test_release_deleted(self):
+        """database - ``release_deleted`` removes the records in one statement"""
+        self.fake_cur.rowcount = 2
+        deleted = [{'vlan_name': 'vlanA', 'switch': 'someSwitch', 'tag': 200},
+                   {'vlan_name': 'vlanB', 'switch': None, 'tag': 201}]
+
+        result = database.release_deleted(deleted)
+
+        the_args, _ = self.fake_cur.execute.call_args
+        self.assertEqual(result, 2)
+        self.assertEqual(the_args[1], (['vlanA', 'vlanB'], ['someSwitch', None], [200, 201]))
+
+    def test_retry_deleting(self):
+        """database - ``retry_deleting`` saves the error of each vLAN"""
+        vlan = {'vlan_name': 'vlanA', 'switch': 'someSwitch', 'tag': 200}
+
+        database.retry_deleting([(vlan, 'in use')], backoff=30, backoff_max=3600)
+
+        the_args, _ = self.fake_cur.execute.call_args
+        self.assertEqual(the_args[1], (30, 3600, ['vlanA'], ['someSwitch'], [200], ['in use']))
+
+    def test_migrate(self):
+        """database - ``migrate`` applies the changes the database is missing, in order"""
+        self.fake_cur.fetchall.return_value = [(1,)]
+        migrations = [(3, 'three', 'SQL 3'), (1, 'one', 'SQL 1'), (2, 'two', 'SQL 2')]
+
+        applied = database.migrate(migrations)
+        sent = [x[0][0] for x in self.fake_cur.execute.call_args_list]
+
+        self.assertEqual(applied, [2, 3])
+        self.assertTrue(sent.index('SQL 2') < sent.index('SQL 3'))
+        self.assertFalse('SQL 1' in sent)
+
+    def test_migrate_error(self):
+        """database - ``migrate`` stops at the first change that fails, and closes its connection"""
+        self.fake_cur.fetchall.return_value = []
+        self.fake_cur.execute.side_effect = lambda sql, *args: self._fail_on(sql, 'SQL 2')
+
+        with self.assertRaises(psycopg2.ProgrammingError):
+            database.migrate([(1, 'one', 'SQL 1'), (2, 'two', 'SQL 2'), (3, 'three', 'SQL 3')])
+
+        self.assertEqual(self.fake_conn.commit.call_count, 2)
+        self.assertTrue(self.fake_conn.close.called)
+
+    def test_migrate_no_records(self):
+        """database - ``migrate`` raises RuntimeError, and changes nothing, if ``setup-db.sh`` was never run"""
+        self.fake_cur.fetchone.return_value = (None,)
+
+        with self.assertRaises(RuntimeError):
+            database.migrate([(1, 'one', 'SQL 1')])
+        sent = [x[0][0] for x in self.fake_cur.execute.call_args_list]
+
+        self.assertFalse('SQL 1' in sent)
+        self.assertTrue(self.fake_conn.close.called)
+
+    def test_migrations_run_in_order(self):
+        """database - the migrations are listed in order of their version"""
+        versions = [x[0] for x in database.MIGRATIONS]
+
+        self.assertEqual(versions, list(range(1, len(versions) + 1)))
+
+    def _fail_on(self, sql, bad_sql):
+        """Stands in for ``cursor.execute``; raises for one statement"""
+        if sql == bad_sql:
+            raise psycopg2.ProgrammingError('testing')
+
+    def test_migrations_versions(self):
+        """database - every migration has its own version"""
+        versions = [x[0] for x in database.MIGRATIONS]
+
+        self.assertEqual(len(versions), len(set(versions)))
+
+    def test_get_reconcile_state(self):
+        """database - ``get_reconcile_state`` returns the records, warm portgroups, tag pools, and a token"""
+        self.fake_cur.fetchone.return_value = ('someTime',)
+        self.fake_cur.fetchall.side_effect = [[('vlanA', 'alice', 200, 'someSwitch', 'dvportgroup-1', 'ready')],
+                                              [],
+                                              [('someSwitch', 201, 'dvportgroup-2')],
+                                              [('someSwitch', 200, 299)]]
+
+        result = database.get_reconcile_state()
+        expected = {'records': [{'vlan_name': 'vlanA', 'person': 'alice', 'tag': 200, 'switch': 'someSwitch',
+                                 'portgroup': 'dvportgroup-1', 'state': 'ready'}],
+                    'warm': {('someSwitch', 201): 'dvportgroup-2'},
+                    'pools': {'someSwitch': (200, 299)},
+                    'stuck': [],
+                    'token': 'someTime'}
+
+        self.assertEqual(result, expected)
+
+    def test_get_reconcile_state_since(self):
+        """database - ``get_reconcile_state`` only reads the records that changed, or belong to the given portgroups"""
+        self.fake_cur.fetchone.return_value = ('someTime',)
+        self.fake_cur.fetchall.return_value = []
+
+        database.get_reconcile_state(since='lastTime', moids={'dvportgroup-1': None}.keys(), names=['vlanA'])
+
+        the_args, _ = self.fake_cur.execute.call_args_list[1]
+        self.assertEqual(the_args[1], {'since': 'lastTime', 'moids': ['dvportgroup-1'], 'names': ['vlanA']})
+
+
+
+class TestChangeFeed(unittest.TestCase):
+    """A set of test cases for the ``ChangeFeed`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.thread_patcher = patch.object(database.threading, 'Thread')
+        self.fake_thread = self.thread_patcher.start()
+        self.feed = database.ChangeFeed(backlog=2)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.thread_patcher.stop()
+
+    def _change(self, person='alice', vlan_name='alice_vlanA'):
+        """Make a change like the ones the records trigger sends"""
+        return {'event': 'created', 'person': person, 'vlan_name': vlan_name, 'tag': 200,
+                'switch': 'someSwitch', 'state': 'reserved'}
+
+    def test_subscribe(self):
+        """ChangeFeed - ``subscribe`` starts the thread that listens for changes"""
+        self.feed.subscribe('alice')
+
+        self.assertTrue(self.fake_thread.return_value.start.called)
+
+    def test_publish(self):
+        """ChangeFeed - subscribers only get the changes to their own vLANs"""
+        alice = self.feed.subscribe('alice')
+        bob = self.feed.subscribe('bob')
+
+        self.feed._publish(self._change())
+
+        self.assertEqual(alice.get_nowait()['vlan_name'], 'alice_vlanA')
+        self.assertTrue(bob.empty())
+
+    def test_publish_everyone(self):
+        """ChangeFeed - a change without an owner goes to every subscriber"""
+        alice = self.feed.subscribe('alice')
+        bob = self.feed.subscribe('bob')
+
+        self.feed._publish({'event': 'resync', 'person': None})
+
+        self.assertEqual((alice.qsize(), bob.qsize()), (1, 1))
+
+    def test_publish_backlog(self):
+        """ChangeFeed - drops a subscriber that falls too far behind"""
+        alice = self.feed.subscribe('alice')
+
+        for _ in range(3):
+            self.feed._publish(self._change())
+
+        self.assertFalse(self.feed.is_subscribed(alice))
+
+    def test_unsubscribe(self):
+        """ChangeFeed - ``unsubscribe`` stops the changes"""
+        alice = self.feed.subscribe('alice')
+
+        self.feed.unsubscribe(alice)
+        self.feed._publish(self._change())
+
+        self.assertTrue(alice.empty())
+
+    def test_listen_exits(self):
+        """ChangeFeed - the listening thread stops when there are no subscribers"""
+        self.feed._thread = MagicMock()
+
+        self.feed._listen()
+
+        self.assertTrue(self.feed._thread is None)
+
+
+class TestNewSwitchRace(unittest.TestCase):
+    """Claims tags on a new switch while another transaction makes its pool of
+    tags. Needs a vLAN database with the current schema; skipped without one::
+
+        $ INF_DB_HOSTNAME=localhost python -m pytest tests/test_database.py
+    """
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        try:
+            conn = psycopg2.connect(database='vlans', host=database.const.INF_DB_HOSTNAME, user='postgres',
+                                    password=database.const.POSTGRES_PASSWORD, connect_timeout=2)
+        except psycopg2.OperationalError:
+            raise unittest.SkipTest('No vLAN database to test with')
+        conn.close()
+
+    def setUp(self):
+        """Runs before every test case"""
+        database.close_pool()
+        self.switch_name = 'race-{}'.format(uuid.uuid4())
+        # Only a switch in VLAB_VLAN_SWITCHES gets a pool made for it
+        self.patcher = patch.object(database, 'get_switch_pools', return_value={self.switch_name: (100, 110)})
+        self.patcher.start()
+        self.conn = psycopg2.connect(database='vlans', host=database.const.INF_DB_HOSTNAME, user='postgres',
+                                     password=database.const.POSTGRES_PASSWORD)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.conn.rollback()
+        cur = self.conn.cursor()
+        for table in ('records', 'warm_portgroups', 'free_tags', 'tag_pools'):
+            cur.execute("""DELETE FROM {} WHERE switch_name = %s;""".format(table), (self.switch_name,))
+        self.conn.commit()
+        self.conn.close()
+        database.close_pool()
+        self.patcher.stop()
+
+    def _race(self, claim):
+        """Make the switch's pool in one transaction, and run ``claim`` in another
+        until it waits on the first one. Then commit the first transaction.
+
+        :Returns: The result of ``claim``
+        """
+        cur = self.conn.cursor()
+        cur.execute("""INSERT INTO tag_pools(switch_name, tag_min, tag_max) VALUES (%s, 100, 110);""", (self.switch_name,))
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(answer=claim()))
+        thread.daemon = True
+        thread.start()
+        # Activity is only read once per transaction, so watch from another connection
+        watcher = psycopg2.connect(database='vlans', host=database.const.INF_DB_HOSTNAME, user='postgres',
+                                   password=database.const.POSTGRES_PASSWORD)
+        watcher.autocommit = True
+        watch = watcher.cursor()
+        deadline = time.time() + 5
+        waiting = 0
+        while not waiting and time.time() < deadline:
+            watch.execute("""SELECT COUNT(*) FROM pg_stat_activity \
+                             WHERE wait_event_type = 'Lock' AND query LIKE 'INSERT INTO tag_pools%';""")
+            waiting = watch.fetchone()[0]
+            time.sleep(0.01)
+        watcher.close()
+        self.conn.commit()
+        thread.join(5)
+        self.assertTrue(waiting, 'The claim never waited on the new pool')
+        return result.get('answer', None)
+
+    def test_register_vlan(self):
+        """database - ``register_vlan`` claims a tag on a switch whose pool another transaction is making"""
+        vlan_id = self._race(lambda: database.register_vlan(username='alice', vlan_name='alice_{}'.format(uuid.uuid4()),
+                                                            logger=MagicMock(), switch_name=self.switch_name))
+
+        self.assertTrue(100 <= vlan_id <= 110)
+
+    def test_reserve_warm_tags(self):
+        """database - ``reserve_warm_tags`` reserves tags on a switch whose pool another transaction is making"""
+        tags = self._race(lambda: database.reserve_warm_tags(self.switch_name, 2))
+
+        self.assertEqual(len(tags), 2)
 
 
 if __name__ == '__main__':
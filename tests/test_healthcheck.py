@@ -31,6 +31,32 @@ class TestHealthView(unittest.TestCase):
 
         self.assertEqual(resp.status_code, expected)
 
+    def test_get_cache_stats(self):
+        """HealthView for /api/1/inf/vlan/heathcheck reports the hit/miss counters of the vLAN cache"""
+        resp = self.app.get('/api/1/inf/vlan/healthcheck')
+
+        self.assertTrue('hits' in resp.json['cache'])
+
+    @patch.object(healthcheck, 'database')
+    def test_get_warm_pool_stats(self, fake_database):
+        """HealthView for /api/1/inf/vlan/heathcheck reports the warm pool metrics, when there is a warm pool"""
+        fake_database.vlan_cache.stats.return_value = {}
+        fake_database.get_warm_pool_stats.return_value = {'someSwitch': {'hits': 1, 'misses': 2, 'ready': 3, 'pending': 0}}
+        with patch.object(healthcheck, 'const', healthcheck.const._replace(VLAB_VLAN_WARM_POOL_SWITCHES=['someSwitch'])):
+            resp = self.app.get('/api/1/inf/vlan/healthcheck')
+
+        self.assertEqual(resp.json['warm_pool']['someSwitch']['hits'], 1)
+
+    @patch.object(healthcheck, 'database')
+    def test_get_warm_pool_db_error(self, fake_database):
+        """HealthView for /api/1/inf/vlan/heathcheck still works if the warm pool metrics are unreachable"""
+        fake_database.vlan_cache.stats.return_value = {}
+        fake_database.get_warm_pool_stats.side_effect = healthcheck.psycopg2.OperationalError('testing')
+        with patch.object(healthcheck, 'const', healthcheck.const._replace(VLAB_VLAN_WARM_POOL_SWITCHES=['someSwitch'])):
+            resp = self.app.get('/api/1/inf/vlan/healthcheck')
+
+        self.assertEqual(resp.status_code, 200)
+
 
 if __name__ == '__main__':
     unittest.main()
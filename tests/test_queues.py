@@ -0,0 +1,45 @@
+# -*- coding: UTF-8 -*-
+"""
+A suite of tests for the queues.py module
+"""
+import unittest
+
+from celery import Celery
+
+from vlab_vlan.lib import queues
+
+
+class TestQueues(unittest.TestCase):
+    """A set of test cases for the ``configure`` function"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.app = Celery('testing', broker='memory://')
+        queues.configure(self.app, read_queue='reads', vcenter_queue='slow')
+
+    def _queue_of(self, task_name):
+        """Where the Celery app will send a task"""
+        return self.app.amqp.router.route({}, task_name)['queue'].name
+
+    def test_reads(self):
+        """queues - ``configure`` sends listing vLANs to the read queue"""
+        self.assertEqual(self._queue_of('vlan.show'), 'reads')
+
+    def test_deletes(self):
+        """queues - ``configure`` sends deletes to the read queue, since they only mark the database records"""
+        for task_name in ('vlan.delete', 'vlan.delete_batch', 'vlan.delete_all'):
+            self.assertEqual(self._queue_of(task_name), 'reads')
+
+    def test_vcenter(self):
+        """queues - ``configure`` sends tasks that change vCenter to the vCenter queue"""
+        for task_name in ('vlan.create', 'vlan.create_batch', 'vlan.provision', 'vlan.reap'):
+            self.assertEqual(self._queue_of(task_name), 'slow')
+
+    def test_consumes_both(self):
+        """queues - ``configure`` has a worker consume both queues by default"""
+        names = sorted(self.app.amqp.queues.keys())
+
+        self.assertEqual(names, ['reads', 'slow'])
+
+
+if __name__ == '__main__':
+    unittest.main()
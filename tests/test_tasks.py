@@ -2,91 +2,207 @@
 """
 A suite of tests for the functions in tasks.py
 """
+import uuid
 import unittest
 from unittest.mock import patch, MagicMock
 
+import psycopg2
+
 from vlab_vlan.lib.worker import tasks
 
 
+def _details(vlans):
+    """Make the records returned by ``database.get_vlan_details`` from a mapping of name -> tag"""
+    return {name: {'tag': tag, 'switch': 'someSwitch', 'portgroup': None, 'state': 'ready'} for name, tag in vlans.items()}
+
+
 class TestTasks(unittest.TestCase):
     """A set of test cases for ``tasks.py``"""
-    @patch.object(tasks, 'get_task_logger')
     @patch.object(tasks, 'database')
-    def test_list(self, fake_database, fake_get_task_logger):
-        """tasks - ``list`` returns a dictionary mapping vlan names to vlan tag ids"""
-        fake_database.get_vlan.return_value = {'myVlan' : 1234}
-        result = tasks.list(username='bob', txn_id='myId')
-        expected =  {'content': {'myVlan': 1234}, 'params': {}, 'error': None}
+    def test_init_worker_process(self, fake_database):
+        """tasks - ``init_worker_process`` creates the database connection pool"""
+        tasks.init_worker_process()
 
-        self.assertEqual(result, expected)
+        self.assertTrue(fake_database.init_pool.called)
+
+    def test_beat_schedule(self):
+        """tasks - ``celery beat`` runs the tasks that reap deleted vLANs and reconcile the database"""
+        scheduled = sorted([x['task'] for x in tasks.app.conf.beat_schedule.values()])
+
+        self.assertTrue(set(['vlan.reap', 'vlan.reconcile']).issubset(scheduled))
 
     @patch.object(tasks, 'get_task_logger')
     @patch.object(tasks, 'database')
-    def test_list_strips(self, fake_database, fake_get_task_logger):
-        """tasks - ``list`` strips off the username tag before returning the response"""
-        fake_database.get_vlan.return_value = {'bob_myVlan' : 1234}
-        result = tasks.list(username='bob', txn_id='myId')
-        expected =  {'content': {'myVlan': 1234}, 'params': {}, 'error': None}
+    def test_init_worker(self, fake_database, fake_get_task_logger):
+        """tasks - ``init_worker`` migrates the database schema"""
+        fake_database.migrate.return_value = [1]
 
-        self.assertEqual(result, expected)
+        tasks.init_worker()
 
+        self.assertTrue(fake_database.migrate.called)
+
+    @patch.object(tasks.time, 'sleep')
     @patch.object(tasks, 'get_task_logger')
     @patch.object(tasks, 'database')
-    @patch.object(tasks, 'delete_network')
-    def test_delete(self, fake_delete_network, fake_database, fake_get_task_logger):
-        """tasks - ``delete`` destroys the defined vLAN returns a dictionary"""
-        fake_database.get_vlan.return_value = {'someVlan' : 1234}
+    def test_init_worker_retry(self, fake_database, fake_get_task_logger, fake_sleep):
+        """tasks - ``init_worker`` tries again if the database cannot be migrated"""
+        fake_database.migrate.side_effect = [RuntimeError('testing'), [1]]
 
-        result = tasks.delete(username='alice', vlan_name='someVlan', txn_id='myId')
-        expected = {'content': {}, 'error': None, 'params': {'vlan_name': 'someVlan'}}
+        tasks.init_worker()
 
-        self.assertEqual(result, expected)
+        self.assertEqual(fake_database.migrate.call_count, 2)
 
+    @patch.object(tasks.time, 'sleep')
     @patch.object(tasks, 'get_task_logger')
     @patch.object(tasks, 'database')
-    @patch.object(tasks, 'delete_network')
-    def test_delete_not_owned(self, fake_delete_network, fake_database, fake_get_task_logger):
-        """tasks - ``delete`` returns an error message when the user does not own the vLAN"""
-        fake_database.get_vlan.return_value = {'someVlan' : 1234}
+    def test_init_worker_error(self, fake_database, fake_get_task_logger, fake_sleep):
+        """tasks - ``init_worker`` stops the worker if the database can never be migrated"""
+        fake_database.migrate.side_effect = RuntimeError('testing')
 
-        result = tasks.delete(username='alice', vlan_name='derpVlan', txn_id='myId')['error']
-        expected = 'Unable to delete vLAN you do not own'
+        with self.assertRaises(SystemExit):
+            tasks.init_worker()
 
-        self.assertEqual(result, expected)
+    @patch.object(tasks, 'vcenter_session')
+    @patch.object(tasks, 'database')
+    def test_shutdown_worker_process(self, fake_database, fake_vcenter_session):
+        """tasks - ``shutdown_worker_process`` closes the database connection pool"""
+        tasks.shutdown_worker_process()
+
+        self.assertTrue(fake_database.close_pool.called)
+
+    @patch.object(tasks, 'vcenter_session')
+    @patch.object(tasks, 'database')
+    def test_shutdown_worker_process_vcenter(self, fake_database, fake_vcenter_session):
+        """tasks - ``shutdown_worker_process`` logs out of vCenter"""
+        tasks.shutdown_worker_process()
+
+        self.assertTrue(fake_vcenter_session.close.called)
+
+    @patch.object(tasks, 'task_watcher')
+    @patch.object(tasks, 'vcenter_session')
+    @patch.object(tasks, 'database')
+    def test_shutdown_worker_process_tasks(self, fake_database, fake_vcenter_session, fake_task_watcher):
+        """tasks - ``shutdown_worker_process`` stops waiting on vCenter tasks"""
+        tasks.shutdown_worker_process()
+
+        self.assertTrue(fake_task_watcher.close.called)
 
     @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'callback_sender')
+    @patch.object(tasks, 'vcenter_session')
     @patch.object(tasks, 'database')
-    @patch.object(tasks, 'delete_network')
-    def test_delete_vmware_fail(self, fake_delete_network, fake_database, fake_get_task_logger):
-        """tasks - ``delete`` returns an error message if unable to delete the vLAN network"""
-        fake_database.get_vlan.return_value = {'someVlan' : 1234}
-        fake_delete_network.side_effect = [ValueError("some error message")]
+    def test_shutdown_worker_process_callbacks(self, fake_database, fake_vcenter_session, fake_callback_sender, fake_get_task_logger):
+        """tasks - ``shutdown_worker_process`` logs the callbacks it could not deliver"""
+        fake_callback_sender.close.return_value = 2
 
-        result = tasks.delete(username='alice', vlan_name='someVlan', txn_id='myId')['error']
-        expected = 'some error message'
+        tasks.shutdown_worker_process()
+
+        self.assertTrue(fake_get_task_logger.return_value.error.called)
+
+    @patch.object(tasks, 'callback_sender')
+    def test_send_callback(self, fake_callback_sender):
+        """tasks - ``send_callback`` sends the result of the task, with its id, owner, and status"""
+        result = {'error': None, 'content': {}, 'params': {'vlan_name': 'bob_vlanA'}}
+        tasks.send_callback(task_id='some-task', task=tasks.delete, args=['bob'],
+                            kwargs={'vlan_name': 'bob_vlanA', 'txn_id': 'myId', 'callback_url': 'http://pipeline/done'},
+                            retval=result, state='SUCCESS')
+
+        the_args, _ = fake_callback_sender.send.call_args
+        expected = ('http://pipeline/done', {'error': None, 'content': {}, 'params': {'vlan_name': 'bob_vlanA'},
+                                             'task-id': 'some-task', 'user': 'bob', 'status': 'SUCCESS'})
+
+        self.assertEqual(the_args, expected)
+
+    @patch.object(tasks, 'callback_sender')
+    def test_send_callback_exception(self, fake_callback_sender):
+        """tasks - ``send_callback`` reports the error of a task that raised an exception"""
+        tasks.send_callback(task_id='some-task', task=tasks.delete, args=['bob'],
+                            kwargs={'vlan_name': 'bob_vlanA', 'txn_id': 'myId', 'callback_url': 'http://pipeline/done'},
+                            retval=RuntimeError('testing'), state='FAILURE')
+
+        the_args, _ = fake_callback_sender.send.call_args
+        result = (the_args[1]['status'], the_args[1]['error'])
+        expected = ('FAILURE', 'Task failed: testing')
 
         self.assertEqual(result, expected)
 
+    @patch.object(tasks, 'callback_sender')
+    def test_send_callback_no_url(self, fake_callback_sender):
+        """tasks - ``send_callback`` does nothing for a task without a ``callback_url``"""
+        tasks.send_callback(task_id='some-task', task=tasks.delete, args=['bob'],
+                            kwargs={'vlan_name': 'bob_vlanA', 'txn_id': 'myId'},
+                            retval={}, state='SUCCESS')
+
+        self.assertFalse(fake_callback_sender.send.called)
+
+    @patch.object(tasks, 'callback_sender')
+    def test_send_callback_retry(self, fake_callback_sender):
+        """tasks - ``send_callback`` waits for a task that will be retried to finish"""
+        tasks.send_callback(task_id='some-task', task=tasks.delete, args=['bob'],
+                            kwargs={'vlan_name': 'bob_vlanA', 'txn_id': 'myId', 'callback_url': 'http://pipeline/done'},
+                            retval=None, state='RETRY')
+
+        self.assertFalse(fake_callback_sender.send.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'callback_sender')
+    def test_send_callback_dropped(self, fake_callback_sender, fake_get_task_logger):
+        """tasks - ``send_callback`` logs a callback that was dropped because too many are waiting"""
+        fake_callback_sender.send.return_value = False
+        tasks.send_callback(task_id='some-task', task=tasks.delete, args=['bob'],
+                            kwargs={'vlan_name': 'bob_vlanA', 'txn_id': 'myId', 'callback_url': 'http://pipeline/done'},
+                            retval={}, state='SUCCESS')
+
+        self.assertTrue(fake_get_task_logger.return_value.error.called)
+
+    def test_send_callback_connected(self):
+        """tasks - ``send_callback`` runs after every task"""
+        receivers = [x[1]() for x in tasks.task_postrun.receivers]
+
+        self.assertTrue(tasks.send_callback in receivers)
+
+    def test_shutdown_worker_threads(self):
+        """tasks - ``shutdown_worker_process`` also runs when a worker using threads exits"""
+        receivers = [x[1]() for x in tasks.worker_shutdown.receivers]
+
+        self.assertTrue(tasks.shutdown_worker_process in receivers)
+
     @patch.object(tasks, 'get_task_logger')
     @patch.object(tasks, 'database')
-    @patch.object(tasks, 'delete_network')
-    def test_delete_db_issue(self, fake_delete_network, fake_database, fake_get_task_logger):
-        """tasks - ``delete`` returns an error when unable to remove DB ref to vLAN"""
-        fake_database.get_vlan.return_value = {'someVlan' : 1234}
-        fake_database.delete_vlan.side_effect = ValueError('some error')
+    def test_list(self, fake_database, fake_get_task_logger):
+        """tasks - ``list`` returns a dictionary mapping vlan names to vlan tag ids"""
+        fake_database.get_vlan.return_value = {'myVlan' : 1234}
+        result = tasks.list(username='bob', txn_id='myId')
+        expected =  {'content': {'myVlan': 1234}, 'params': {}, 'error': None}
 
-        result = tasks.delete(username='alice', vlan_name='someVlan', txn_id='myId')['error']
-        expected = 'some error'
+        self.assertEqual(result, expected)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    def test_list_strips(self, fake_database, fake_get_task_logger):
+        """tasks - ``list`` strips off the username tag before returning the response"""
+        fake_database.get_vlan.return_value = {'bob_myVlan' : 1234}
+        result = tasks.list(username='bob', txn_id='myId')
+        expected =  {'content': {'myVlan': 1234}, 'params': {}, 'error': None}
 
         self.assertEqual(result, expected)
 
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    def test_list_min_version(self, fake_database, fake_get_task_logger):
+        """tasks - ``list`` passes ``min_version`` along to the database"""
+        fake_database.get_vlan.return_value = {'bob_myVlan' : 1234}
+        tasks.list(username='bob', txn_id='myId', min_version=5)
+
+        fake_database.get_vlan.assert_called_with('bob', min_version=5)
+
     @patch.object(tasks, 'get_task_logger')
     @patch.object(tasks, 'database')
     @patch.object(tasks, 'create_network')
     def test_create(self, fake_create_network, fake_database, fake_get_task_logger):
         """tasks - ``create`` returns empty content in dictionary upon success"""
         fake_database.register_vlan.return_value = 1234
-        fake_create_network.return_value = None
+        fake_create_network.return_value = (None, 'dvportgroup-1')
 
         result = tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
         expected = {'error' : None, 'content': {},
@@ -94,13 +210,25 @@ class TestTasks(unittest.TestCase):
 
         self.assertEqual(result, expected)
 
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_network')
+    def test_create_invalidates_cache(self, fake_create_network, fake_database, fake_get_task_logger):
+        """tasks - ``create`` discards the user's cached vLANs"""
+        fake_database.register_vlan.return_value = 1234
+        fake_create_network.return_value = (None, 'dvportgroup-1')
+
+        tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        fake_database.invalidate_vlan_cache.assert_called_with('alice')
+
     @patch.object(tasks, 'get_task_logger')
     @patch.object(tasks, 'database')
     @patch.object(tasks, 'create_network')
     def test_create_register_failure(self, fake_create_network, fake_database, fake_get_task_logger):
         """tasks - ``create`` returns an error message if the vlan registration fails"""
         fake_database.register_vlan.side_effect = [ValueError('testing error msg')]
-        fake_create_network.return_value = None
+        fake_create_network.return_value = (None, 'dvportgroup-1')
 
         result = tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')['error']
         expected = 'testing error msg'
@@ -134,7 +262,762 @@ class TestTasks(unittest.TestCase):
         result = tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')['error']
         expected = 'Some Error'
 
-        self.assertTrue(fake_logger.traceback.called)
+        self.assertTrue(fake_logger.exception.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_networks')
+    def test_create_batch(self, fake_create_networks, fake_database, fake_get_task_logger):
+        """tasks - ``create_batch`` returns the tag of every new vLAN"""
+        fake_database.register_vlans.return_value = ({'alice_vlanA': 200, 'alice_vlanB': 201}, {})
+        fake_create_networks.return_value = ({'alice_vlanA': '', 'alice_vlanB': ''}, {})
+
+        result = tasks.create_batch(username='alice', vlan_names=['alice_vlanA', 'alice_vlanB'],
+                                    switch_name='someSwitch', txn_id='myId')
+        expected = {'error': None,
+                    'content': {'vlanA': {'tag': 200, 'error': None},
+                                'vlanB': {'tag': 201, 'error': None}},
+                    'params': {'vlan_names': ['alice_vlanA', 'alice_vlanB'], 'switch_name': 'someSwitch'}}
+
+        self.assertEqual(result, expected)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_networks')
+    def test_create_batch_partial(self, fake_create_networks, fake_database, fake_get_task_logger):
+        """tasks - ``create_batch`` reports per-vLAN errors"""
+        fake_database.register_vlans.return_value = ({'alice_vlanA': 200}, {'alice_vlanB': 'taken'})
+        fake_create_networks.return_value = ({'alice_vlanA': ''}, {})
+
+        result = tasks.create_batch(username='alice', vlan_names=['alice_vlanA', 'alice_vlanB'],
+                                    switch_name='someSwitch', txn_id='myId')
+        expected = {'vlanA': {'tag': 200, 'error': None},
+                    'vlanB': {'tag': None, 'error': 'taken'}}
+
+        self.assertEqual(result['content'], expected)
+        self.assertEqual(result['error'], 'Unable to create 1 of 2 vLANs')
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_networks')
+    def test_create_batch_rollback(self, fake_create_networks, fake_database, fake_get_task_logger):
+        """tasks - ``create_batch`` only deletes the DB records of vLANs that failed in vCenter"""
+        fake_database.register_vlans.return_value = ({'alice_vlanA': 200, 'alice_vlanB': 201}, {})
+        fake_create_networks.return_value = ({'alice_vlanA': '', 'alice_vlanB': 'some error'}, {})
+
+        tasks.create_batch(username='alice', vlan_names=['alice_vlanA', 'alice_vlanB'],
+                           switch_name='someSwitch', txn_id='myId')
+
+        fake_database.delete_vlans.assert_called_with(username='alice', vlan_names=['alice_vlanB'])
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_networks')
+    def test_create_batch_vcenter_error(self, fake_create_networks, fake_database, fake_get_task_logger):
+        """tasks - ``create_batch`` rolls back every vLAN if the vCenter call fails outright"""
+        fake_database.register_vlans.return_value = ({'alice_vlanA': 200, 'alice_vlanB': 201}, {})
+        fake_create_networks.side_effect = ValueError('No such switch')
+
+        result = tasks.create_batch(username='alice', vlan_names=['alice_vlanA', 'alice_vlanB'],
+                                    switch_name='someSwitch', txn_id='myId')
+
+        fake_database.delete_vlans.assert_called_with(username='alice', vlan_names=['alice_vlanA', 'alice_vlanB'])
+        self.assertEqual(result['content']['vlanA']['error'], 'No such switch')
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    def test_list_details(self, fake_database, fake_get_task_logger):
+        """tasks - ``list`` includes the switch of each vLAN when asked for details"""
+        fake_database.get_vlan_details.return_value = {'bob_myVlan': {'tag': 1234, 'switch': 'someSwitch', 'portgroup': 'dvportgroup-1'}}
+
+        result = tasks.list(username='bob', txn_id='myId', details=True)['content']
+        expected = {'myVlan': {'tag': 1234, 'switch': 'someSwitch'}}
+
+        self.assertEqual(result, expected)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_network')
+    def test_create_records_portgroup(self, fake_create_network, fake_database, fake_get_task_logger):
+        """tasks - ``create`` saves the switch and portgroup of the new vLAN"""
+        fake_database.register_vlan.return_value = 1234
+        fake_create_network.return_value = ('', 'dvportgroup-1')
+
+        tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        fake_database.record_portgroups.assert_called_with({'someVlan': ('someSwitch', 'dvportgroup-1')})
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_network')
+    def test_create_records_portgroup_fail(self, fake_create_network, fake_database, fake_get_task_logger):
+        """tasks - ``create`` does not fail if unable to save the portgroup of the new vLAN"""
+        fake_database.register_vlan.return_value = 1234
+        fake_database.record_portgroups.side_effect = RuntimeError('testing')
+        fake_create_network.return_value = ('', 'dvportgroup-1')
+
+        result = tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        self.assertEqual(result['error'], '')
+        self.assertFalse(fake_database.delete_vlan.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_networks')
+    def test_create_batch_records_portgroups(self, fake_create_networks, fake_database, fake_get_task_logger):
+        """tasks - ``create_batch`` only saves the portgroups of the vLANs that were made"""
+        fake_database.register_vlans.return_value = ({'alice_vlanA': 200, 'alice_vlanB': 201}, {})
+        fake_create_networks.return_value = ({'alice_vlanA': '', 'alice_vlanB': 'some error'},
+                                             {'alice_vlanA': 'dvportgroup-1'})
+
+        tasks.create_batch(username='alice', vlan_names=['alice_vlanA', 'alice_vlanB'],
+                           switch_name='someSwitch', txn_id='myId')
+
+        fake_database.record_portgroups.assert_called_with({'alice_vlanA': ('someSwitch', 'dvportgroup-1')})
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'find_portgroups')
+    def test_backfill(self, fake_find_portgroups, fake_database, fake_get_task_logger):
+        """tasks - ``backfill`` records the portgroups of vLANs made before they were tracked"""
+        fake_database.get_unmapped_vlans.return_value = {'alice_vlanA': 'alice', 'bob_vlanB': 'bob'}
+        fake_find_portgroups.return_value = {'alice_vlanA': ('someSwitch', 'dvportgroup-1')}
+
+        result = tasks.backfill(txn_id='myId')['content']
+        expected = {'updated': 1, 'missing': ['bob_vlanB']}
+
+        self.assertEqual(result, expected)
+        fake_database.record_portgroups.assert_called_with({'alice_vlanA': ('someSwitch', 'dvportgroup-1')})
+        fake_database.invalidate_vlan_cache.assert_called_with('alice')
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'find_portgroups')
+    def test_backfill_nothing(self, fake_find_portgroups, fake_database, fake_get_task_logger):
+        """tasks - ``backfill`` does not contact vCenter when every record has a portgroup"""
+        fake_database.get_unmapped_vlans.return_value = {}
+
+        tasks.backfill(txn_id='myId')
+
+        self.assertFalse(fake_find_portgroups.called)
+
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'replenish')
+    @patch.object(tasks, 'rename_network')
+    @patch.object(tasks, 'create_network')
+    def test_create_warm(self, fake_create_network, fake_rename_network, fake_replenish, fake_database, fake_get_task_logger):
+        """tasks - ``create`` renames a warm portgroup instead of making a new one"""
+        fake_database.claim_warm_portgroup.return_value = (1234, 'dvportgroup-1')
+        fake_rename_network.return_value = ''
+        fake_database.get_warm_pool_targets.return_value = {'someSwitch': 2}
+        result = tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        self.assertEqual(result['error'], None)
+        self.assertFalse(fake_create_network.called)
+        self.assertFalse(fake_database.register_vlan.called)
+        fake_rename_network.assert_called_with('dvportgroup-1', 'someVlan')
+        self.assertTrue(fake_replenish.apply_async.called)
+        fake_database.record_portgroups.assert_called_with({'someVlan': ('someSwitch', 'dvportgroup-1')})
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'replenish')
+    @patch.object(tasks, 'create_network')
+    def test_create_warm_empty(self, fake_create_network, fake_replenish, fake_database, fake_get_task_logger):
+        """tasks - ``create`` makes a new portgroup when the warm pool is empty"""
+        fake_database.claim_warm_portgroup.return_value = None
+        fake_database.register_vlan.return_value = 1234
+        fake_create_network.return_value = ('', 'dvportgroup-1')
+        fake_database.get_warm_pool_targets.return_value = {'someSwitch': 2}
+        tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        self.assertTrue(fake_create_network.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'replenish')
+    @patch.object(tasks, 'rename_network')
+    @patch.object(tasks, 'create_network')
+    def test_create_warm_rename_fail(self, fake_create_network, fake_rename_network, fake_replenish, fake_database, fake_get_task_logger):
+        """tasks - ``create`` gives back the warm portgroup and makes a new one if the rename fails"""
+        fake_database.claim_warm_portgroup.return_value = (1234, 'dvportgroup-1')
+        fake_database.register_vlan.return_value = 1235
+        fake_rename_network.return_value = 'some error'
+        fake_create_network.return_value = ('', 'dvportgroup-2')
+        fake_database.get_warm_pool_targets.return_value = {'someSwitch': 2}
+        result = tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        self.assertEqual(result['error'], '')
+        fake_database.unclaim_warm_portgroup.assert_called_with(username='alice', vlan_name='someVlan')
+        self.assertTrue(fake_create_network.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_network')
+    def test_create_no_warm_pool(self, fake_create_network, fake_database, fake_get_task_logger):
+        """tasks - ``create`` does not look for a warm portgroup on a switch without a warm pool"""
+        fake_database.register_vlan.return_value = 1234
+        fake_create_network.return_value = ('', 'dvportgroup-1')
+        fake_database.get_warm_pool_targets.return_value = {'otherSwitch': 2}
+        tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        self.assertFalse(fake_database.claim_warm_portgroup.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_networks')
+    def test_replenish(self, fake_create_networks, fake_database, fake_get_task_logger):
+        """tasks - ``replenish`` makes portgroups for the reserved tags, and gives back the tags that failed"""
+        fake_database.reserve_warm_tags.return_value = [200, 201]
+        fake_create_networks.return_value = ({'vlab-warm-someSwitch-200': '', 'vlab-warm-someSwitch-201': 'some error'},
+                                             {'vlab-warm-someSwitch-200': 'dvportgroup-1'})
+        fake_database.get_warm_pool_targets.return_value = {'someSwitch': 2}
+        result = tasks.replenish(txn_id='myId')['content']
+
+        self.assertEqual(result, {'someSwitch': {'added': 1, 'failed': 1}})
+        fake_database.reserve_warm_tags.assert_called_with('someSwitch', 2)
+        fake_database.fill_warm_portgroups.assert_called_with('someSwitch', {200: 'dvportgroup-1'})
+        fake_database.release_warm_tags.assert_called_with('someSwitch', [201])
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_networks')
+    def test_replenish_full(self, fake_create_networks, fake_database, fake_get_task_logger):
+        """tasks - ``replenish`` does not contact vCenter when the warm pool is full"""
+        fake_database.reserve_warm_tags.return_value = []
+        fake_database.get_warm_pool_targets.return_value = {'someSwitch': 2}
+        tasks.replenish(txn_id='myId')
+
+        self.assertFalse(fake_create_networks.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_networks')
+    def test_replenish_only(self, fake_create_networks, fake_database, fake_get_task_logger):
+        """tasks - ``replenish`` can be limited to some switches"""
+        fake_database.reserve_warm_tags.return_value = []
+        fake_database.get_warm_pool_targets.return_value = {'switchA': 2, 'switchB': 2}
+        tasks.replenish(txn_id='myId', switch_names=['switchB'])
+
+        fake_database.reserve_warm_tags.assert_called_once_with('switchB', 2)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_networks')
+    def test_replenish_unknown_switch(self, fake_create_networks, fake_database, fake_get_task_logger):
+        """tasks - ``replenish`` reports a switch that is unknown, and still refills the others"""
+        fake_database.reserve_warm_tags.side_effect = [ValueError('No such switch: switchA'), []]
+        fake_database.get_warm_pool_targets.return_value = {'switchA': 2, 'switchB': 2}
+        result = tasks.replenish(txn_id='myId')['content']
+
+        self.assertEqual(result['switchA']['error'], 'No such switch: switchA')
+        fake_database.reserve_warm_tags.assert_called_with('switchB', 2)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_network')
+    def test_provision(self, fake_create_network, fake_database, fake_get_task_logger):
+        """tasks - ``provision`` makes the portgroup of a reserved vLAN, and marks it ready"""
+        fake_database.start_provisioning.return_value = (1234, None)
+        fake_create_network.return_value = ('', 'dvportgroup-1')
+
+        result = tasks.provision(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        self.assertEqual(result['content'], {'tag': 1234, 'state': 'ready'})
+        fake_create_network.assert_called_with('someVlan', 1234, 'someSwitch')
+        fake_database.record_portgroups.assert_called_with({'someVlan': ('someSwitch', 'dvportgroup-1')})
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_network')
+    def test_provision_fail(self, fake_create_network, fake_database, fake_get_task_logger):
+        """tasks - ``provision`` marks the vLAN as failed, and keeps its record, if the portgroup cannot be made"""
+        fake_database.start_provisioning.return_value = (1234, None)
+        fake_create_network.return_value = ('some error', None)
+
+        result = tasks.provision(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        self.assertEqual(result['content'], {'tag': 1234, 'state': 'failed'})
+        fake_database.fail_vlan.assert_called_with('alice', 'someVlan', 'some error')
+        self.assertFalse(fake_database.delete_vlan.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'replenish')
+    @patch.object(tasks, 'rename_network')
+    @patch.object(tasks, 'create_network')
+    def test_provision_warm(self, fake_create_network, fake_rename_network, fake_replenish, fake_database, fake_get_task_logger):
+        """tasks - ``provision`` renames the warm portgroup that came with the reserved tag"""
+        fake_database.start_provisioning.return_value = (1234, 'dvportgroup-1')
+        fake_rename_network.return_value = ''
+
+        tasks.provision(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        fake_rename_network.assert_called_with('dvportgroup-1', 'someVlan')
+        self.assertFalse(fake_create_network.called)
+        self.assertTrue(fake_replenish.apply_async.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'create_network')
+    def test_provision_twice(self, fake_create_network, fake_database, fake_get_task_logger):
+        """tasks - ``provision`` does nothing if the vLAN is no longer reserved"""
+        fake_database.start_provisioning.return_value = None
+
+        result = tasks.provision(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        self.assertTrue(result['error'])
+        self.assertFalse(fake_create_network.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete`` marks the vLAN as deleted and returns a dictionary"""
+        fake_database.mark_deleting.return_value = {'someVlan': 'deleting'}
+
+        result = tasks.delete(username='alice', vlan_name='someVlan', txn_id='myId')
+        expected = {'content': {}, 'error': None, 'params': {'vlan_name': 'someVlan'}}
+
+        self.assertEqual(result, expected)
+        fake_database.mark_deleting.assert_called_with('alice', ['someVlan'])
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_starts_reap(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete`` starts the task that destroys deleted vLANs"""
+        fake_database.mark_deleting.return_value = {'someVlan': 'deleting'}
+
+        tasks.delete(username='alice', vlan_name='someVlan', txn_id='myId')
+
+        self.assertTrue(fake_reap.apply_async.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_not_owned(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete`` returns an error message when the user does not own the vLAN"""
+        fake_database.mark_deleting.return_value = {}
+
+        result = tasks.delete(username='alice', vlan_name='derpVlan', txn_id='myId')['error']
+        expected = 'Unable to delete vLAN you do not own'
+
+        self.assertEqual(result, expected)
+        self.assertFalse(fake_reap.apply_async.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_being_made(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete`` returns an error message when the vLAN is still being made"""
+        fake_database.mark_deleting.return_value = {'someVlan': 'provisioning'}
+
+        result = tasks.delete(username='alice', vlan_name='someVlan', txn_id='myId')['error']
+        expected = 'vLAN someVlan is still being made; try again once it is ready'
+
+        self.assertEqual(result, expected)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_db_issue(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete`` returns an error when unable to mark the vLAN as deleted"""
+        fake_database.mark_deleting.side_effect = RuntimeError('some error')
+
+        result = tasks.delete(username='alice', vlan_name='someVlan', txn_id='myId')['error']
+        expected = 'some error'
+
+        self.assertEqual(result, expected)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_invalidates_cache(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete`` discards the user's cached vLANs"""
+        fake_database.mark_deleting.return_value = {'someVlan': 'deleting'}
+
+        tasks.delete(username='alice', vlan_name='someVlan', txn_id='myId')
+
+        fake_database.invalidate_vlan_cache.assert_called_with('alice')
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_batch(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete_batch`` marks all the vLANs as deleted in one call"""
+        fake_database.mark_deleting.return_value = {'alice_vlanA': 'deleting', 'alice_vlanB': 'deleting'}
+
+        result = tasks.delete_batch(username='alice', vlan_names=['alice_vlanA', 'alice_vlanB'], txn_id='myId')
+        expected = {'error': None,
+                    'content': {'vlanA': {'error': None}, 'vlanB': {'error': None}},
+                    'params': {'vlan_names': ['alice_vlanA', 'alice_vlanB']}}
+
+        self.assertEqual(result, expected)
+        fake_database.mark_deleting.assert_called_with('alice', ['alice_vlanA', 'alice_vlanB'])
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_batch_not_owned(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete_batch`` reports the vLANs the user does not own"""
+        fake_database.mark_deleting.return_value = {'alice_vlanA': 'deleting'}
+
+        result = tasks.delete_batch(username='alice', vlan_names=['alice_vlanA', 'alice_vlanB'], txn_id='myId')
+
+        self.assertEqual(result['content']['vlanB']['error'], 'Unable to delete vLAN you do not own')
+        self.assertEqual(result['error'], 'Unable to delete 1 of 2 vLANs')
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_all(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete_all`` marks every vLAN the user owns as deleted, in one call"""
+        fake_database.mark_deleting.return_value = {'alice_vlanA': 'deleting', 'alice_vlanB': 'deleting'}
+
+        result = tasks.delete_all(username='alice', txn_id='myId')
+        expected = {'error': None,
+                    'content': {'vlanA': {'error': None}, 'vlanB': {'error': None}},
+                    'params': {'username': 'alice'}}
+
+        self.assertEqual(result, expected)
+        fake_database.mark_deleting.assert_called_with('alice', None)
+        self.assertFalse(fake_database.get_vlan_details.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_all_none(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete_all`` does not start ``vlan.reap`` if the user has no vLANs"""
+        fake_database.mark_deleting.return_value = {}
+
+        result = tasks.delete_all(username='alice', txn_id='myId')
+
+        self.assertEqual(result['content'], {})
+        self.assertFalse(fake_reap.apply_async.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'reap')
+    def test_delete_unmade(self, fake_reap, fake_database, fake_get_task_logger):
+        """tasks - ``delete`` does not start ``vlan.reap`` for a failed vLAN that was removed at once"""
+        fake_database.mark_deleting.return_value = {'someVlan': 'deleted'}
+
+        result = tasks.delete(username='alice', vlan_name='someVlan', txn_id='myId')
+
+        self.assertEqual(result['error'], None)
+        self.assertFalse(fake_reap.apply_async.called)
+        fake_database.invalidate_vlan_cache.assert_called_with('alice')
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    def test_reap(self, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reap`` destroys deleted vLANs by their portgroup, and frees their tags"""
+        vlan = {'vlan_name': 'vlanA', 'person': 'alice', 'switch': 'someSwitch', 'tag': 200,
+                'portgroup': 'dvportgroup-1', 'attempts': 0}
+        fake_database.claim_deleting.return_value = [vlan]
+        fake_delete_networks.return_value = {'vlanA': ''}
+
+        result = tasks.reap(txn_id='myId')['content']
+
+        self.assertEqual(result, {'destroyed': 1, 'failed': 0})
+        fake_delete_networks.assert_called_with(['vlanA'], portgroups={'vlanA': 'dvportgroup-1'})
+        fake_database.release_deleted.assert_called_with([vlan])
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    def test_reap_retry(self, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reap`` keeps the tag of a vLAN vCenter could not destroy, and tries again later"""
+        vlan = {'vlan_name': 'vlanA', 'person': 'alice', 'switch': 'someSwitch', 'tag': 200,
+                'portgroup': 'dvportgroup-1', 'attempts': 0}
+        fake_database.claim_deleting.return_value = [vlan]
+        fake_delete_networks.return_value = {'vlanA': 'in use'}
+
+        tasks.reap(txn_id='myId')
+
+        self.assertFalse(fake_database.release_deleted.called)
+        fake_database.retry_deleting.assert_called_with([(vlan, 'in use')])
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    def test_reap_gone(self, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reap`` frees the tag of a vLAN whose network no longer exists"""
+        vlan = {'vlan_name': 'vlanA', 'person': 'alice', 'switch': 'someSwitch', 'tag': 200,
+                'portgroup': None, 'attempts': 2}
+        fake_database.claim_deleting.return_value = [vlan]
+        fake_delete_networks.return_value = {'vlanA': tasks.NO_SUCH_VLAN.format('vlanA')}
+
+        tasks.reap(txn_id='myId')
+
+        fake_database.release_deleted.assert_called_with([vlan])
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    def test_reap_gone_other_error(self, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reap`` keeps the tag of a vLAN whose error only looks like its network no longer exists"""
+        vlan = {'vlan_name': 'vlanA', 'person': 'alice', 'switch': 'someSwitch', 'tag': 200,
+                'portgroup': None, 'attempts': 2}
+        fake_database.claim_deleting.return_value = [vlan]
+        fake_delete_networks.return_value = {'vlanA': tasks.NO_SUCH_VLAN.format('vlanA') + ' (vCenter is restarting)'}
+
+        tasks.reap(txn_id='myId')
+
+        self.assertFalse(fake_database.release_deleted.called)
+        self.assertTrue(fake_database.retry_deleting.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    def test_reap_same_name(self, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reap`` destroys deleted vLANs with the same name in separate calls to vCenter"""
+        first = {'vlan_name': 'vlanA', 'person': 'alice', 'switch': 'someSwitch', 'tag': 200,
+                 'portgroup': 'dvportgroup-1', 'attempts': 0}
+        second = dict(first, tag=201, portgroup='dvportgroup-2')
+        fake_database.claim_deleting.return_value = [first, second]
+        fake_delete_networks.return_value = {'vlanA': ''}
+
+        tasks.reap(txn_id='myId')
+
+        self.assertEqual(fake_delete_networks.call_count, 2)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    def test_reap_nothing(self, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reap`` does not contact vCenter when no vLANs are due to be destroyed"""
+        fake_database.claim_deleting.return_value = []
+
+        tasks.reap(txn_id='myId')
+
+        self.assertFalse(fake_delete_networks.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    @patch.object(tasks, 'create_network')
+    def test_create_reaps_name(self, fake_create_network, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``create`` first destroys a deleted vLAN with the same name"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.claim_deleting.return_value = [{'vlan_name': 'someVlan', 'person': 'alice', 'switch': 'someSwitch',
+                                                      'tag': 200, 'portgroup': 'dvportgroup-1', 'attempts': 0}]
+        fake_delete_networks.return_value = {'someVlan': ''}
+        fake_database.register_vlan.return_value = 1234
+        fake_create_network.return_value = ('', 'dvportgroup-2')
+
+        tasks.create(username='alice', vlan_name='someVlan', switch_name='someSwitch', txn_id='myId')
+
+        fake_database.claim_deleting.assert_called_with(limit=None, vlan_names=['someVlan'])
+        self.assertTrue(fake_delete_networks.called)
+
+    def test_diff_missing(self):
+        """tasks - ``_diff`` finds ready vLANs whose portgroup is gone"""
+        records = [self._record('vlanA', 200, 'dvportgroup-1')]
+
+        found = tasks._diff({}, records, {}, {}, [])
+
+        self.assertEqual(list(found['missing'].keys()), ['vlanA'])
+
+    def test_diff_adopt(self):
+        """tasks - ``_diff`` adopts the portgroup with the name of a vLAN that has no portgroup id"""
+        records = [self._record('vlanA', 200, None)]
+        portgroups = {'dvportgroup-1': {'name': 'vlanA', 'tag': 200, 'switch': 'someSwitch'}}
+
+        found = tasks._diff(portgroups, records, {}, {}, [])
+
+        self.assertEqual(found['adopt'], {'vlanA': ('someSwitch', 'dvportgroup-1')})
+        self.assertEqual(found['missing'], {})
+
+    def test_diff_mismatched(self):
+        """tasks - ``_diff`` finds vLANs whose portgroup has a different tag"""
+        records = [self._record('vlanA', 200, 'dvportgroup-1')]
+        portgroups = {'dvportgroup-1': {'name': 'vlanA', 'tag': 250, 'switch': 'someSwitch'}}
+
+        found = tasks._diff(portgroups, records, {}, {}, [])
+
+        self.assertEqual(list(found['mismatched'].keys()), ['vlanA'])
+
+    def test_diff_orphans(self):
+        """tasks - ``_diff`` finds portgroups with a pooled tag that no record or warm portgroup owns"""
+        portgroups = {'dvportgroup-1': {'name': 'lost', 'tag': 200, 'switch': 'someSwitch'},
+                      'dvportgroup-2': {'name': 'vlab-warm-someSwitch-201', 'tag': 201, 'switch': 'someSwitch'},
+                      'dvportgroup-3': {'name': 'VM Network', 'tag': 10, 'switch': 'someSwitch'},
+                      'dvportgroup-4': {'name': 'uplinks', 'tag': None, 'switch': 'someSwitch'}}
+        warm = {('someSwitch', 201): None}
+        pools = {'someSwitch': (200, 299)}
+
+        found = tasks._diff(portgroups, [], warm, pools, [])
+
+        self.assertEqual(found['orphans'], {'lost': 'dvportgroup-1'})
+
+    def test_diff_stuck(self):
+        """tasks - ``_diff`` adopts stuck vLANs whose portgroup exists, and reports the rest"""
+        stuck = [self._record('vlanA', 200, None, state='provisioning'),
+                 self._record('vlanB', 201, None, state='reserved')]
+        portgroups = {'dvportgroup-1': {'name': 'vlanA', 'tag': 200, 'switch': 'someSwitch'}}
+
+        found = tasks._diff(portgroups, [], {}, {'someSwitch': (200, 299)}, stuck)
+
+        self.assertEqual(found['adopt'], {'vlanA': ('someSwitch', 'dvportgroup-1')})
+        self.assertEqual(list(found['stuck'].keys()), ['vlanB'])
+
+    def _record(self, vlan_name, tag, portgroup, state='ready'):
+        """Make a record like the ones from ``database.get_reconcile_state``"""
+        return {'vlan_name': vlan_name, 'person': 'alice', 'tag': tag, 'switch': 'someSwitch',
+                'portgroup': portgroup, 'state': state}
+
+    def _reconcile_state(self, records=(), stuck=()):
+        """Make the output of ``database.get_reconcile_state``"""
+        return {'records': list(records), 'stuck': list(stuck), 'warm': {},
+                'pools': {'someSwitch': (200, 299)}, 'token': 'someTime'}
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    @patch.object(tasks, 'portgroup_mirror')
+    @patch.object(tasks, 'get_portgroup_changes')
+    def test_reconcile(self, fake_get_portgroup_changes, fake_portgroup_mirror, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reconcile`` only reports what it finds, by default"""
+        fake_get_portgroup_changes.return_value = (True, {'dvportgroup-9': {'name': 'lost', 'tag': 250, 'switch': 'someSwitch'}})
+        fake_database.get_reconcile_state.return_value = self._reconcile_state([self._record('vlanA', 200, 'dvportgroup-1')])
+        fake_portgroup_mirror.get.return_value = {}
+        fake_portgroup_mirror.find.return_value = {}
+
+        output = tasks.reconcile(txn_id='myId')
+        expected = {'full': True, 'adopted': [], 'missing': ['vlanA'], 'stuck': [], 'orphans': ['lost'], 'mismatched': []}
+
+        self.assertEqual(output['content'], expected)
+        self.assertFalse(fake_database.fail_vlan.called)
+        self.assertFalse(fake_delete_networks.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    @patch.object(tasks, 'portgroup_mirror')
+    @patch.object(tasks, 'get_portgroup_changes')
+    def test_reconcile_repair(self, fake_get_portgroup_changes, fake_portgroup_mirror, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reconcile`` fails vLANs whose portgroup is gone, and destroys orphaned portgroups, when repairing"""
+        fake_get_portgroup_changes.return_value = (True, {'dvportgroup-9': {'name': 'lost', 'tag': 250, 'switch': 'someSwitch'}})
+        fake_database.get_reconcile_state.return_value = self._reconcile_state([self._record('vlanA', 200, 'dvportgroup-1')])
+        fake_portgroup_mirror.get.return_value = {}
+        fake_portgroup_mirror.find.return_value = {}
+        fake_delete_networks.return_value = {'lost': ''}
+
+        tasks.reconcile(txn_id='myId', repair=True)
+
+        fake_database.fail_vlan.assert_called_with('alice', 'vlanA', 'The portgroup of this vLAN no longer exists in vCenter')
+        fake_delete_networks.assert_called_with(['lost'], portgroups={'lost': 'dvportgroup-9'})
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    @patch.object(tasks, 'portgroup_mirror')
+    @patch.object(tasks, 'get_portgroup_changes')
+    def test_reconcile_repair_gone(self, fake_get_portgroup_changes, fake_portgroup_mirror, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reconcile`` does not report an orphaned portgroup that is already gone as a failure"""
+        fake_get_portgroup_changes.return_value = (True, {'dvportgroup-9': {'name': 'lost', 'tag': 250, 'switch': 'someSwitch'}})
+        fake_database.get_reconcile_state.return_value = self._reconcile_state()
+        fake_portgroup_mirror.get.return_value = {}
+        fake_portgroup_mirror.find.return_value = {}
+        fake_delete_networks.return_value = {'lost': tasks.NO_SUCH_VLAN.format('lost')}
+
+        tasks.reconcile(txn_id='myId', repair=True)
+
+        self.assertFalse(fake_get_task_logger.return_value.error.called)
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    @patch.object(tasks, 'portgroup_mirror')
+    @patch.object(tasks, 'get_portgroup_changes')
+    def test_reconcile_incremental(self, fake_get_portgroup_changes, fake_portgroup_mirror, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reconcile`` only reads the records that changed since the last run"""
+        fake_get_portgroup_changes.return_value = (False, {'dvportgroup-1': None})
+        fake_database.get_reconcile_state.return_value = self._reconcile_state()
+        fake_portgroup_mirror.get.return_value = {}
+        fake_portgroup_mirror.find.return_value = {}
+
+        with patch.dict(tasks._reconcile_token, {'since': 'lastTime'}):
+            tasks.reconcile(txn_id='myId')
+            token = tasks._reconcile_token['since']
+
+        _, the_kwargs = fake_database.get_reconcile_state.call_args
+        self.assertEqual(the_kwargs['since'], 'lastTime')
+        self.assertEqual(list(the_kwargs['moids']), ['dvportgroup-1'])
+        self.assertEqual(token, 'someTime')
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'database')
+    @patch.object(tasks, 'delete_networks')
+    @patch.object(tasks, 'portgroup_mirror')
+    @patch.object(tasks, 'get_portgroup_changes')
+    def test_reconcile_adopts(self, fake_get_portgroup_changes, fake_portgroup_mirror, fake_delete_networks, fake_database, fake_get_task_logger):
+        """tasks - ``reconcile`` looks up the portgroups of records by name, and records the ones it finds"""
+        fake_get_portgroup_changes.return_value = (False, {})
+        fake_database.get_reconcile_state.return_value = self._reconcile_state([self._record('vlanA', 200, None)])
+        fake_portgroup_mirror.get.return_value = {}
+        fake_portgroup_mirror.find.return_value = {'vlanA': ('dvportgroup-1', {'name': 'vlanA', 'tag': 200, 'switch': 'someSwitch'})}
+
+        tasks.reconcile(txn_id='myId', repair=True)
+
+        fake_database.record_portgroups.assert_called_with({'vlanA': ('someSwitch', 'dvportgroup-1')})
+
+
+class TestWarmCreate(unittest.TestCase):
+    """Makes a vLAN from the warm pool of a switch, against a real database.
+    Needs a vLAN database with the current schema; skipped without one::
+
+        $ INF_DB_HOSTNAME=localhost python -m pytest tests/test_tasks.py
+    """
+    @classmethod
+    def setUpClass(cls):
+        """Runs once for the whole test suite"""
+        try:
+            conn = psycopg2.connect(database='vlans', host=tasks.const.INF_DB_HOSTNAME, user='postgres',
+                                    password=tasks.const.POSTGRES_PASSWORD, connect_timeout=2)
+        except psycopg2.OperationalError:
+            raise unittest.SkipTest('No vLAN database to test with')
+        conn.close()
+
+    def setUp(self):
+        """Runs before every test case"""
+        tasks.database.close_pool()
+        self.switch_name = 'warm-{}'.format(uuid.uuid4())
+        self.conn = psycopg2.connect(database='vlans', host=tasks.const.INF_DB_HOSTNAME, user='postgres',
+                                     password=tasks.const.POSTGRES_PASSWORD)
+        cur = self.conn.cursor()
+        cur.execute("""INSERT INTO tag_pools(switch_name, tag_min, tag_max) VALUES (%s, 100, 110);""", (self.switch_name,))
+        cur.execute("""DELETE FROM free_tags WHERE switch_name = %s AND tag = 105;""", (self.switch_name,))
+        cur.execute("""INSERT INTO warm_portgroups(switch_name, tag, portgroup_moid) VALUES (%s, 105, 'dvportgroup-1');""",
+                    (self.switch_name,))
+        self.conn.commit()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        cur = self.conn.cursor()
+        for table in ('records', 'warm_portgroups', 'warm_pool_stats', 'free_tags', 'tag_pools'):
+            cur.execute("""DELETE FROM {} WHERE switch_name = %s;""".format(table), (self.switch_name,))
+        self.conn.commit()
+        self.conn.close()
+        tasks.database.close_pool()
+
+    @patch.object(tasks, 'get_task_logger')
+    @patch.object(tasks, 'replenish')
+    @patch.object(tasks, 'rename_network')
+    def test_create_warm_ready(self, fake_rename_network, fake_replenish, fake_get_task_logger):
+        """tasks - ``create`` marks a vLAN made from a warm portgroup as ready"""
+        fake_rename_network.return_value = ''
+        with patch.object(tasks.database, 'get_warm_pool_targets', return_value={self.switch_name: 1}):
+            tasks.create(username='alice', vlan_name='alice_warmVlan', switch_name=self.switch_name, txn_id='myId')
+        cur = self.conn.cursor()
+        cur.execute("""SELECT tag, state, portgroup_moid FROM records WHERE switch_name = %s;""", (self.switch_name,))
+
+        self.assertEqual(cur.fetchall(), [(105, 'ready', 'dvportgroup-1')])
 
 
 if __name__ == '__main__':
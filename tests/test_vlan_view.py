@@ -3,6 +3,7 @@
 A suite of unit tests for the VlanView object
 """
 import unittest
+import threading
 from unittest.mock import patch, MagicMock
 
 import ujson
@@ -28,14 +29,17 @@ class TestVlanView(unittest.TestCase):
         vlan.VlanView.register(app)
         app.config['TESTING'] = True
         cls.app = app.test_client()
+        vlan.inflight.clear()
+        vlan._streams['open'] = 0
         # Mock Celery
         app.celery_app = MagicMock()
         cls.fake_task = MagicMock()
         cls.fake_task.id = 'asdf-asdf-asdf'
         app.celery_app.send_task.return_value = cls.fake_task
 
+    @patch.object(vlan, 'database')
     @patch.object(flask_common, 'logger')
-    def test_get_task_id(self, fake_logger):
+    def test_get_task_id(self, fake_logger, fake_database):
         """VlanView - GET on /api/2/inf/vlan returns a task-id"""
         resp = self.app.get('/api/2/inf/vlan',
                             headers={'X-Auth': self.token})
@@ -45,8 +49,9 @@ class TestVlanView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    @patch.object(vlan, 'database')
     @patch.object(flask_common, 'logger')
-    def test_get_status_coded(self, fake_logger):
+    def test_get_status_coded(self, fake_logger, fake_database):
         """VlanView - GET on /api/2/inf/vlan returns HTTP 202"""
         resp = self.app.get('/api/2/inf/vlan',
                             headers={'X-Auth': self.token})
@@ -56,8 +61,9 @@ class TestVlanView(unittest.TestCase):
 
         self.assertEqual(status, expected)
 
+    @patch.object(vlan, 'database')
     @patch.object(flask_common, 'logger')
-    def test_get_link(self, fake_logger):
+    def test_get_link(self, fake_logger, fake_database):
         """VlanView - GET on /api/2/inf/vlan sets the Link header"""
         resp = self.app.get('/api/2/inf/vlan',
                             headers={'X-Auth': self.token})
@@ -67,9 +73,185 @@ class TestVlanView(unittest.TestCase):
 
         self.assertEqual(link, expected)
 
+    @patch.object(vlan, 'database')
     @patch.object(flask_common, 'logger')
-    def test_post_task_id(self, fake_logger):
+    def test_get_sync(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan?sync=true returns the vLANs without a task"""
+        fake_database.get_vlan.return_value = {'bob_vlanA': 200}
+        resp = self.app.get('/api/2/inf/vlan?sync=true',
+                            headers={'X-Auth': self.token})
+
+        result = (resp.status_code, resp.json['content'])
+        expected = (200, {'vlanA': 200})
+
+        self.assertEqual(result, expected)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_sync_details(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan?sync=true&details=true includes the switch and state of each vLAN"""
+        fake_database.get_vlan_details.return_value = {'bob_vlanA': {'tag': 200, 'switch': 'someSwitch', 'portgroup': 'dvportgroup-1',
+                                                                     'state': 'ready'}}
+        resp = self.app.get('/api/2/inf/vlan?sync=true&details=true',
+                            headers={'X-Auth': self.token})
+
+        result = resp.json['content']
+        expected = {'vlanA': {'tag': 200, 'switch': 'someSwitch', 'state': 'ready'}}
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_sync_config(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan skips the task when VLAB_VLAN_SYNC_LIST is set"""
+        fake_database.get_vlan.return_value = {'bob_vlanA': 200}
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_SYNC_LIST='true')):
+            resp = self.app.get('/api/2/inf/vlan',
+                                headers={'X-Auth': self.token})
+
+        status = resp.status_code
+        expected = 200
+
+        self.assertEqual(status, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_sync_db_error(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan?sync=true falls back to a task if the database is unreachable"""
+        fake_database.get_vlan.side_effect = vlan.psycopg2.OperationalError('testing')
+        resp = self.app.get('/api/2/inf/vlan?sync=true',
+                            headers={'X-Auth': self.token})
+
+        status = resp.status_code
+        expected = 202
+
+        self.assertEqual(status, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_etag(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan does not set an ETag on a response with only a task-id"""
+        fake_database.get_version.return_value = 5
+        resp = self.app.get('/api/2/inf/vlan',
+                            headers={'X-Auth': self.token})
+
+        etag = resp.headers.get('ETag')
+
+        self.assertEqual(etag, None)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_etag_sync(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan?sync=true sets the ETag"""
+        fake_database.get_version.return_value = 5
+        fake_database.get_vlan.return_value = {'bob_vlanA': 200}
+        resp = self.app.get('/api/2/inf/vlan?sync=true',
+                            headers={'X-Auth': self.token})
+
+        etag = resp.headers['ETag']
+        expected = '"5"'
+
+        self.assertEqual(etag, expected)
+        fake_database.get_vlan.assert_called_with('bob', min_version=5)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_etag_details(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan?details=true has a different ETag than the listing without details"""
+        fake_database.get_version.return_value = 5
+        fake_database.get_vlan_details.return_value = {'bob_vlanA': {'tag': 200, 'switch': 'someSwitch', 'state': 'ready'}}
+        resp = self.app.get('/api/2/inf/vlan?sync=true&details=true',
+                            headers={'X-Auth': self.token})
+
+        etag = resp.headers['ETag']
+        expected = '"5-d"'
+
+        self.assertEqual(etag, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_details_not_cached(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan?details=true does not return HTTP 304 for the ETag of the listing without details"""
+        fake_database.get_version.return_value = 5
+        fake_database.get_vlan_details.return_value = {'bob_vlanA': {'tag': 200, 'switch': 'someSwitch', 'state': 'ready'}}
+        resp = self.app.get('/api/2/inf/vlan?sync=true&details=true',
+                            headers={'X-Auth': self.token, 'If-None-Match': '"5"'})
+
+        self.assertEqual(resp.status_code, 200)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_not_modified(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan returns HTTP 304 when the ETag matches"""
+        fake_database.get_version.return_value = 5
+        resp = self.app.get('/api/2/inf/vlan',
+                            headers={'X-Auth': self.token, 'If-None-Match': '"5"'})
+
+        status = resp.status_code
+        expected = 304
+
+        self.assertEqual(status, expected)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+        self.assertFalse(fake_database.get_vlan.called)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_modified(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan returns a task-id when the ETag is stale"""
+        fake_database.get_version.return_value = 6
+        resp = self.app.get('/api/2/inf/vlan',
+                            headers={'X-Auth': self.token, 'If-None-Match': '"5"'})
+
+        status = resp.status_code
+        expected = 202
+
+        self.assertEqual(status, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_min_version(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan tells the task not to answer with an older cached list"""
+        fake_database.get_version.return_value = 5
+        self.app.get('/api/2/inf/vlan', headers={'X-Auth': self.token})
+
+        the_kwargs = self.app.application.celery_app.send_task.call_args[1]['kwargs']
+        expected = {'min_version': 5, 'details': False}
+
+        self.assertEqual(the_kwargs, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_details(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan?details=true passes the option to the task"""
+        fake_database.get_version.return_value = 5
+        self.app.get('/api/2/inf/vlan?details=true', headers={'X-Auth': self.token})
+
+        the_kwargs = self.app.application.celery_app.send_task.call_args[1]['kwargs']
+
+        self.assertTrue(the_kwargs['details'])
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_get_version_db_error(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan still works without an ETag if the database is unreachable"""
+        fake_database.get_version.side_effect = vlan.psycopg2.OperationalError('testing')
+        resp = self.app.get('/api/2/inf/vlan',
+                            headers={'X-Auth': self.token, 'If-None-Match': '"5"'})
+
+        result = (resp.status_code, resp.headers.get('ETag'))
+        expected = (202, None)
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vlan.uuid, 'uuid4')
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_task_id(self, fake_logger, fake_database, fake_uuid4):
         """VlanView - POST on /api/2/inf/vlan returns a task-id"""
+        fake_uuid4.return_value = 'asdf-asdf-asdf'
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
         resp = self.app.post('/api/2/inf/vlan',
                              json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
                              headers={'X-Auth': self.token})
@@ -79,9 +261,14 @@ class TestVlanView(unittest.TestCase):
 
         self.assertEqual(task_id, expected)
 
+    @patch.object(vlan.uuid, 'uuid4')
+    @patch.object(vlan, 'database')
     @patch.object(flask_common, 'logger')
-    def test_post_status_code(self, fake_logger):
+    def test_post_status_code(self, fake_logger, fake_database, fake_uuid4):
         """VlanView - POST on /api/2/inf/vlan returns HTTP 202"""
+        fake_uuid4.return_value = 'asdf-asdf-asdf'
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
         resp = self.app.post('/api/2/inf/vlan',
                              json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
                              headers={'X-Auth': self.token})
@@ -115,9 +302,14 @@ class TestVlanView(unittest.TestCase):
 
         self.assertEqual(status_code, expected)
 
+    @patch.object(vlan.uuid, 'uuid4')
+    @patch.object(vlan, 'database')
     @patch.object(flask_common, 'logger')
-    def test_post_link(self, fake_logger):
+    def test_post_link(self, fake_logger, fake_database, fake_uuid4):
         """VlanView - POST on /api/2/inf/vlan sets the Link header"""
+        fake_uuid4.return_value = 'asdf-asdf-asdf'
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
         resp = self.app.post('/api/2/inf/vlan',
                              json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
                              headers={'X-Auth': self.token})
@@ -128,6 +320,303 @@ class TestVlanView(unittest.TestCase):
 
         self.assertEqual(link, expected)
 
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_tag(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan returns the reserved tag right away"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                             headers={'X-Auth': self.token})
+
+        result = (resp.json['content']['tag'], resp.json['content']['state'])
+        expected = (200, 'reserved')
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_provision(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan sends the task that makes the reserved vLAN, with the same task id"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                             headers={'X-Auth': self.token})
+
+        the_args, the_kwargs = self.app.application.celery_app.send_task.call_args
+        result = (the_args[0], the_kwargs['task_id'])
+        expected = ('vlan.provision', resp.json['content']['task-id'])
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_warm(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan reserves a warm portgroup on switches with a warm pool"""
+        fake_database.get_warm_pool_targets.return_value = {'SomeSwitch': 2}
+        fake_database.claim_warm_portgroup.return_value = (300, 'dvportgroup-1')
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                             headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.json['content']['tag'], 300)
+        self.assertFalse(fake_database.register_vlan.called)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_exists(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan returns HTTP 400 if the vLAN already exists"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.side_effect = ValueError('vLAN bob_NewVLAN already exits')
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                             headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_unknown_switch(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan returns HTTP 400 if the switch is unknown"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.side_effect = ValueError('No such switch: TypoSwitch')
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'TypoSwitch', 'vlan-name': 'NewVLAN'},
+                             headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_no_tags(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan returns HTTP 503 if the switch has no tags left"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.side_effect = RuntimeError('no more tags')
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                             headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 503)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_send_fail(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan marks the reserved vLAN as failed if the task cannot be sent"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
+        self.app.application.celery_app.send_task.side_effect = RuntimeError('testing')
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                             headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertTrue(fake_database.fail_vlan.called)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_db_error(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan falls back to making the vLAN in a task if the database is unreachable"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.side_effect = vlan.psycopg2.OperationalError('testing')
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                             headers={'X-Auth': self.token})
+
+        the_args, _ = self.app.application.celery_app.send_task.call_args
+        result = (resp.status_code, the_args[0])
+        expected = (202, 'vlan.create')
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_reserved(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> reports a reserved vLAN as pending, from the database"""
+        fake_database.get_vlan_by_task.return_value = {'vlan_name': 'bob_vlanA', 'tag': 200, 'switch': 'someSwitch',
+                                                       'state': 'reserved', 'error': None}
+        resp = self.app.get('/api/2/inf/vlan/task/asdf', headers={'X-Auth': self.token})
+
+        result = (resp.status_code, resp.json['content'])
+        expected = (202, {'tag': 200, 'state': 'reserved', 'status': 'PENDING'})
+
+        self.assertEqual(result, expected)
+        self.assertFalse(self.app.application.celery_app.AsyncResult.called)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_ready(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> returns HTTP 200 once the vLAN is ready"""
+        fake_database.get_vlan_by_task.return_value = {'vlan_name': 'bob_vlanA', 'tag': 200, 'switch': 'someSwitch',
+                                                       'state': 'ready', 'error': None}
+        resp = self.app.get('/api/2/inf/vlan/task/asdf', headers={'X-Auth': self.token})
+
+        result = (resp.status_code, resp.json['content'], resp.json['params']['vlan_name'])
+        expected = (200, {'tag': 200, 'state': 'ready'}, 'vlanA')
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_failed(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> returns HTTP 400 and the error if the vLAN failed"""
+        fake_database.get_vlan_by_task.return_value = {'vlan_name': 'bob_vlanA', 'tag': 200, 'switch': 'someSwitch',
+                                                       'state': 'failed', 'error': 'some error'}
+        resp = self.app.get('/api/2/inf/vlan/task/asdf', headers={'X-Auth': self.token})
+
+        result = (resp.status_code, resp.json['error'])
+        expected = (400, 'some error')
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_celery(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> asks Celery about tasks that don't make a vLAN"""
+        fake_database.get_vlan_by_task.return_value = None
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PENDING'
+        resp = self.app.get('/api/2/inf/vlan/task/asdf', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue(self.app.application.celery_app.AsyncResult.called)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_db_error(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> asks Celery if the database is unreachable"""
+        fake_database.get_vlan_by_task.side_effect = vlan.psycopg2.OperationalError('testing')
+        self.app.application.celery_app.AsyncResult.return_value.status = 'PENDING'
+        resp = self.app.get('/api/2/inf/vlan/task/asdf', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+
+    def _record(self, state):
+        """Make a record like the ones from ``database.get_vlan_by_task``"""
+        return {'vlan_name': 'bob_vlanA', 'tag': 200, 'switch': 'someSwitch', 'state': state, 'error': None}
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_wait(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> with 'wait' answers once the vLAN is ready"""
+        fake_database.get_vlan_by_task.side_effect = [self._record('reserved'), self._record('provisioning'),
+                                                      self._record('ready')]
+        changes = vlan.queue.Queue()
+        changes.put({'event': 'changed', 'vlan_name': 'bob_vlanA', 'state': 'ready'})
+        fake_database.change_feed.subscribe.return_value = changes
+        resp = self.app.get('/api/2/inf/vlan/task/asdf?wait=10', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+        fake_database.change_feed.unsubscribe.assert_called_with(changes)
+        self.assertEqual(vlan._streams['open'], 0)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_wait_timeout(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> with 'wait' answers HTTP 202 if the vLAN is not made in time"""
+        fake_database.get_vlan_by_task.return_value = self._record('provisioning')
+        fake_database.change_feed.subscribe.return_value = vlan.queue.Queue()
+        resp = self.app.get('/api/2/inf/vlan/task/asdf?wait=0.1', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_wait_other_vlan(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> with 'wait' ignores changes to other vLANs"""
+        fake_database.get_vlan_by_task.return_value = self._record('provisioning')
+        changes = vlan.queue.Queue()
+        changes.put({'event': 'created', 'vlan_name': 'bob_vlanB', 'state': 'reserved'})
+        fake_database.change_feed.subscribe.return_value = changes
+        self.app.get('/api/2/inf/vlan/task/asdf?wait=0.1', headers={'X-Auth': self.token})
+
+        # To find the vLAN, after subscribing to the change feed, and when the wait runs out
+        self.assertEqual(fake_database.get_vlan_by_task.call_count, 3)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_wait_busy(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> answers right away if too many requests are already waiting"""
+        fake_database.get_vlan_by_task.return_value = self._record('provisioning')
+        with patch.dict(vlan._streams, {'open': vlan.const.VLAB_VLAN_EVENTS_MAX_STREAMS}):
+            resp = self.app.get('/api/2/inf/vlan/task/asdf?wait=10', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertFalse(fake_database.change_feed.subscribe.called)
+
+    @patch.object(flask_common, 'logger')
+    def test_task_wait_bad(self, fake_logger):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> returns HTTP 400 if 'wait' is not a number"""
+        resp = self.app.get('/api/2/inf/vlan/task/asdf?wait=forever', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    @patch.object(vlan.result_watcher, '_interval', 0.01)
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_task_wait_celery(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/task/<id> with 'wait' answers once the Celery task finishes"""
+        fake_database.get_vlan_by_task.return_value = None
+        result = MagicMock()
+        statuses = ['PENDING', 'PENDING']
+        type(result).status = property(lambda _: statuses.pop(0) if statuses else 'SUCCESS')
+        result.result = {'error': None, 'content': {'vlanA': 200}, 'params': {}}
+        self.app.application.celery_app.AsyncResult.return_value = result
+        resp = self.app.get('/api/2/inf/vlan/task/asdf?wait=10', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 200)
+
+    @patch.object(flask_common, 'logger')
+    def test_post_batch(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan with 'vlan-names' dispatches one batch task"""
+        self.app.post('/api/2/inf/vlan',
+                      json={'switch-name': 'SomeSwitch', 'vlan-names': ['vlanA', 'vlanB']},
+                      headers={'X-Auth': self.token})
+
+        the_args, the_kwargs = self.app.application.celery_app.send_task.call_args
+        sent = (the_args[0], the_kwargs['kwargs']['vlan_names'])
+        expected = ('vlan.create_batch', ['bob_vlanA', 'bob_vlanB'])
+
+        self.assertEqual(sent, expected)
+
+    @patch.object(flask_common, 'logger')
+    def test_post_batch_status_code(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan with 'vlan-names' returns HTTP 202"""
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-names': ['vlanA', 'vlanB']},
+                             headers={'X-Auth': self.token})
+
+        status_code = resp.status_code
+        expected = 202
+
+        self.assertEqual(status_code, expected)
+
+    @patch.object(flask_common, 'logger')
+    def test_post_batch_and_name(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan returns HTTP 400 if both 'vlan-name' and 'vlan-names' are supplied"""
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-name': 'vlanA', 'vlan-names': ['vlanB']},
+                             headers={'X-Auth': self.token})
+
+        status_code = resp.status_code
+        expected = 400
+
+        self.assertEqual(status_code, expected)
+
+    @patch.object(flask_common, 'logger')
+    def test_post_batch_empty(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan returns HTTP 400 if 'vlan-names' is empty"""
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-names': []},
+                             headers={'X-Auth': self.token})
+
+        status_code = resp.status_code
+        expected = 400
+
+        self.assertEqual(status_code, expected)
+
     @patch.object(flask_common, 'logger')
     def test_delete_task_id(self, fake_logger):
         """VlanView - DELETE on /api/2/inf/vlan returns a task-id"""
@@ -176,6 +665,382 @@ class TestVlanView(unittest.TestCase):
 
         self.assertEqual(link, expected)
 
+    @patch.object(flask_common, 'logger')
+    def test_delete_batch(self, fake_logger):
+        """VlanView - DELETE on /api/2/inf/vlan with 'vlan-names' dispatches one batch task"""
+        self.app.delete('/api/2/inf/vlan',
+                        json={'vlan-names': ['vlanA', 'vlanB']},
+                        headers={'X-Auth': self.token})
+
+        the_args, the_kwargs = self.app.application.celery_app.send_task.call_args
+        sent = (the_args[0], the_kwargs['kwargs']['vlan_names'])
+        expected = ('vlan.delete_batch', ['bob_vlanA', 'bob_vlanB'])
+
+        self.assertEqual(sent, expected)
+
+    @patch.object(flask_common, 'logger')
+    def test_delete_batch_and_name(self, fake_logger):
+        """VlanView - DELETE on /api/2/inf/vlan returns HTTP 400 if both 'vlan-name' and 'vlan-names' are supplied"""
+        resp = self.app.delete('/api/2/inf/vlan',
+                               json={'vlan-name': 'vlanA', 'vlan-names': ['vlanB']},
+                               headers={'X-Auth': self.token})
+
+        status_code = resp.status_code
+        expected = 400
+
+        self.assertEqual(status_code, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_callback(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan sends the 'callback-url' to the task that makes the vLAN"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='shh',
+                                                           VLAB_VLAN_CALLBACK_ALLOWED_HOSTS=['pipeline'])):
+            self.app.post('/api/2/inf/vlan',
+                          json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN', 'callback-url': 'http://pipeline/done'},
+                          headers={'X-Auth': self.token})
+
+        _, the_kwargs = self.app.application.celery_app.send_task.call_args
+        sent = the_kwargs['kwargs']['callback_url']
+        expected = 'http://pipeline/done'
+
+        self.assertEqual(sent, expected)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_callback_db_error(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan sends the 'callback-url' to the fallback task, if the database is unreachable"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.side_effect = vlan.psycopg2.OperationalError('testing')
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='shh',
+                                                           VLAB_VLAN_CALLBACK_ALLOWED_HOSTS=['pipeline'])):
+            self.app.post('/api/2/inf/vlan',
+                          json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN', 'callback-url': 'http://pipeline/done'},
+                          headers={'X-Auth': self.token})
+
+        the_args, the_kwargs = self.app.application.celery_app.send_task.call_args
+        sent = (the_args[0], the_kwargs['kwargs']['callback_url'])
+        expected = ('vlan.create', 'http://pipeline/done')
+
+        self.assertEqual(sent, expected)
+
+    @patch.object(flask_common, 'logger')
+    def test_post_batch_callback(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan with 'vlan-names' sends the 'callback-url' to the batch task"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='shh',
+                                                           VLAB_VLAN_CALLBACK_ALLOWED_HOSTS=['pipeline'])):
+            self.app.post('/api/2/inf/vlan',
+                          json={'switch-name': 'SomeSwitch', 'vlan-names': ['vlanA'], 'callback-url': 'https://pipeline/done'},
+                          headers={'X-Auth': self.token})
+
+        _, the_kwargs = self.app.application.celery_app.send_task.call_args
+
+        self.assertEqual(the_kwargs['kwargs']['callback_url'], 'https://pipeline/done')
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_no_callback(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan only sends a 'callback_url' to the task if the request has one"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
+        self.app.post('/api/2/inf/vlan',
+                      json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                      headers={'X-Auth': self.token})
+
+        _, the_kwargs = self.app.application.celery_app.send_task.call_args
+
+        self.assertFalse('callback_url' in the_kwargs['kwargs'])
+
+    @patch.object(flask_common, 'logger')
+    def test_post_callback_bad_url(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan returns HTTP 400 if the 'callback-url' is not an http URL"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='shh')):
+            resp = self.app.post('/api/2/inf/vlan',
+                                 json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN', 'callback-url': 'file:///etc/passwd'},
+                                 headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(flask_common, 'logger')
+    def test_post_callback_host_not_allowed(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan returns HTTP 400 if the host of the 'callback-url' is not allowed"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='shh',
+                                                           VLAB_VLAN_CALLBACK_ALLOWED_HOSTS=['pipeline'])):
+            resp = self.app.post('/api/2/inf/vlan',
+                                 json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN', 'callback-url': 'http://169.254.169.254/latest'},
+                                 headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
+    @patch.object(flask_common, 'logger')
+    def test_post_callback_subdomain(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan allows a 'callback-url' on a subdomain of an allowed entry that starts with a dot"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='shh',
+                                                           VLAB_VLAN_CALLBACK_ALLOWED_HOSTS=['.example.com'])):
+            ok = self.app.post('/api/2/inf/vlan',
+                               json={'switch-name': 'SomeSwitch', 'vlan-names': ['vlanA'], 'callback-url': 'https://CI.example.com/done'},
+                               headers={'X-Auth': self.token})
+            not_ok = self.app.post('/api/2/inf/vlan',
+                                   json={'switch-name': 'SomeSwitch', 'vlan-names': ['vlanA'], 'callback-url': 'https://badexample.com/done'},
+                                   headers={'X-Auth': self.token})
+
+        self.assertEqual((ok.status_code, not_ok.status_code), (202, 400))
+
+    @patch.object(flask_common, 'logger')
+    def test_post_duplicate_other_callback(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan sends a new task when a repeated request has a different 'callback-url'"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='shh',
+                                                           VLAB_VLAN_CALLBACK_ALLOWED_HOSTS=['pipeline'])):
+            for url in ('http://pipeline/one', 'http://pipeline/two'):
+                self.app.post('/api/2/inf/vlan',
+                              json={'switch-name': 'SomeSwitch', 'vlan-names': ['vlanA'], 'callback-url': url},
+                              headers={'X-Auth': self.token})
+
+        sent = [x[1]['kwargs']['callback_url'] for x in self.app.application.celery_app.send_task.call_args_list]
+        expected = ['http://pipeline/one', 'http://pipeline/two']
+
+        self.assertEqual(sent, expected)
+
+    @patch.object(flask_common, 'logger')
+    def test_post_callback_disabled(self, fake_logger):
+        """VlanView - POST on /api/2/inf/vlan returns HTTP 400 for a 'callback-url' if callbacks have no secret to sign them"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='')):
+            resp = self.app.post('/api/2/inf/vlan',
+                                 json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN', 'callback-url': 'http://pipeline/done'},
+                                 headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    @patch.object(flask_common, 'logger')
+    def test_delete_callback(self, fake_logger):
+        """VlanView - DELETE on /api/2/inf/vlan sends the 'callback-url' to the task"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='shh',
+                                                           VLAB_VLAN_CALLBACK_ALLOWED_HOSTS=['pipeline'])):
+            self.app.delete('/api/2/inf/vlan',
+                            json={'vlan-name': 'vlanA', 'callback-url': 'http://pipeline/done'},
+                            headers={'X-Auth': self.token})
+
+        the_args, the_kwargs = self.app.application.celery_app.send_task.call_args
+        sent = (the_args[0], the_kwargs['kwargs']['callback_url'])
+        expected = ('vlan.delete', 'http://pipeline/done')
+
+        self.assertEqual(sent, expected)
+
+    @patch.object(flask_common, 'logger')
+    def test_delete_callback_bad_url(self, fake_logger):
+        """VlanView - DELETE on /api/2/inf/vlan returns HTTP 400 if the 'callback-url' has no host"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_CALLBACK_SECRET='shh')):
+            resp = self.app.delete('/api/2/inf/vlan',
+                                   json={'vlan-names': ['vlanA'], 'callback-url': 'http:///done'},
+                                   headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_duplicate(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan returns the task-id of the first request, when the request is repeated"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
+        first = self.app.post('/api/2/inf/vlan',
+                              json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                              headers={'X-Auth': self.token})
+        second = self.app.post('/api/2/inf/vlan',
+                               json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                               headers={'X-Auth': self.token})
+
+        self.assertEqual(first.json['content']['task-id'], second.json['content']['task-id'])
+        self.assertEqual(second.status_code, 202)
+        self.assertEqual(fake_database.register_vlan.call_count, 1)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_idempotency_key(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan treats requests with different Idempotency-Key headers as different"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
+        for key in ('a', 'b'):
+            self.app.post('/api/2/inf/vlan',
+                          json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                          headers={'X-Auth': self.token, 'Idempotency-Key': key})
+
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 2)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_after_delete(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan is not a repeat if a delete was sent since"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.return_value = 200
+        self.app.post('/api/2/inf/vlan',
+                      json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                      headers={'X-Auth': self.token})
+        self.app.delete('/api/2/inf/vlan',
+                        json={'vlan-name': 'NewVLAN'},
+                        headers={'X-Auth': self.token})
+        self.app.post('/api/2/inf/vlan',
+                      json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                      headers={'X-Auth': self.token})
+
+        self.assertEqual(fake_database.register_vlan.call_count, 2)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_post_duplicate_after_error(self, fake_logger, fake_database):
+        """VlanView - POST on /api/2/inf/vlan can be repeated once the first request failed"""
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.side_effect = [ValueError('vLAN NewVLAN already exists'), 200]
+        for _ in range(2):
+            resp = self.app.post('/api/2/inf/vlan',
+                                 json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                                 headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+
+    @patch.object(flask_common, 'logger')
+    def test_delete_duplicate(self, fake_logger):
+        """VlanView - DELETE on /api/2/inf/vlan only sends one task when the request is repeated"""
+        for _ in range(2):
+            self.app.delete('/api/2/inf/vlan',
+                            json={'vlan-names': ['vlanA', 'vlanB']},
+                            headers={'X-Auth': self.token})
+
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+
+    @patch.object(vlan, 'inflight')
+    @patch.object(flask_common, 'logger')
+    def test_delete_cache_down(self, fake_logger, fake_inflight):
+        """VlanView - DELETE on /api/2/inf/vlan still sends the task if the duplicate check fails"""
+        fake_inflight.get.side_effect = RuntimeError('testing')
+        resp = self.app.delete('/api/2/inf/vlan',
+                               json={'vlan-name': 'vlanA'},
+                               headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue(self.app.application.celery_app.send_task.called)
+
+    @patch.object(vlan, 'inflight')
+    @patch.object(flask_common, 'logger')
+    def test_delete_cache_down_after_send(self, fake_logger, fake_inflight):
+        """VlanView - DELETE on /api/2/inf/vlan returns the task-id if the task is sent, but cannot be recorded"""
+        fake_inflight.add.return_value = True
+        fake_inflight.get.return_value = None
+        fake_inflight.set.side_effect = RuntimeError('testing')
+        resp = self.app.delete('/api/2/inf/vlan',
+                               json={'vlan-name': 'vlanA'},
+                               headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(resp.json['content']['task-id'], 'asdf-asdf-asdf')
+        self.assertEqual(self.app.application.celery_app.send_task.call_count, 1)
+
+    @patch.object(vlan, 'database')
+    @patch.object(vlan, 'inflight')
+    @patch.object(flask_common, 'logger')
+    def test_post_cache_down_after_error(self, fake_logger, fake_inflight, fake_database):
+        """VlanView - POST on /api/2/inf/vlan returns the error of the request, not of the cache, if both fail"""
+        fake_inflight.add.return_value = True
+        fake_inflight.get.return_value = None
+        fake_inflight.delete.side_effect = RuntimeError('testing')
+        fake_database.get_warm_pool_targets.return_value = {}
+        fake_database.register_vlan.side_effect = ValueError('vLAN NewVLAN already exists')
+        resp = self.app.post('/api/2/inf/vlan',
+                             json={'switch-name': 'SomeSwitch', 'vlan-name': 'NewVLAN'},
+                             headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 400)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_events(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/events streams the changes to the user's vLANs"""
+        changes = vlan.queue.Queue()
+        changes.put({'event': 'created', 'vlan_name': 'bob_vlanA', 'tag': 200, 'switch': 'someSwitch', 'state': 'reserved'})
+        fake_database.change_feed.subscribe.return_value = changes
+        fake_database.change_feed.is_subscribed.return_value = False
+
+        resp = self.app.get('/api/2/inf/vlan/events', headers={'X-Auth': self.token})
+        body = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        self.assertTrue('event: created\ndata: {"event":"created","vlan_name":"vlanA"' in body)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_events_resync(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/events tells the client to resync and ends, if it falls behind"""
+        fake_database.change_feed.subscribe.return_value = vlan.queue.Queue()
+        fake_database.change_feed.is_subscribed.return_value = False
+
+        resp = self.app.get('/api/2/inf/vlan/events', headers={'X-Auth': self.token})
+
+        self.assertTrue(resp.get_data(as_text=True).endswith('event: resync\ndata: {}\n\n'))
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_events_closed(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/events stops following changes once the stream closes"""
+        changes = vlan.queue.Queue()
+        fake_database.change_feed.subscribe.return_value = changes
+        fake_database.change_feed.is_subscribed.return_value = False
+
+        resp = self.app.get('/api/2/inf/vlan/events', headers={'X-Auth': self.token})
+        resp.close()
+
+        fake_database.change_feed.unsubscribe.assert_called_with(changes)
+        self.assertEqual(vlan._streams['open'], 0)
+
+    def test_after_request_streamed(self):
+        """VlanView - ``after_request`` does not read the body of a streamed response"""
+        def stream():
+            raise AssertionError('the stream was read')
+            yield ''
+        response = vlan.Response(stream(), mimetype='text/event-stream')
+
+        result = vlan.VlanView().after_request('events', response)
+
+        self.assertTrue(result is response)
+
+    @patch.object(vlan, 'database')
+    @patch.object(flask_common, 'logger')
+    def test_events_too_many(self, fake_logger, fake_database):
+        """VlanView - GET on /api/2/inf/vlan/events returns HTTP 503 when too many streams are open"""
+        with patch.dict(vlan._streams, {'open': vlan.const.VLAB_VLAN_EVENTS_MAX_STREAMS}):
+            resp = self.app.get('/api/2/inf/vlan/events', headers={'X-Auth': self.token})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertFalse(fake_database.change_feed.subscribe.called)
+
+    @patch.object(flask_common, 'logger')
+    def test_delete_user(self, fake_logger):
+        """VlanView - DELETE on /api/2/inf/vlan/user/<owner> dispatches a task to delete all of the owner's vLANs"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_ADMINS=['bob'])):
+            resp = self.app.delete('/api/2/inf/vlan/user/alice',
+                                   headers={'X-Auth': self.token})
+
+        the_args, the_kwargs = self.app.application.celery_app.send_task.call_args
+        sent = (resp.status_code, the_args[0], the_kwargs['args'])
+        expected = (202, 'vlan.delete_all', ['alice'])
+
+        self.assertEqual(sent, expected)
+
+    @patch.object(flask_common, 'logger')
+    def test_delete_user_not_admin(self, fake_logger):
+        """VlanView - DELETE on /api/2/inf/vlan/user/<owner> returns HTTP 403 if the caller is not an admin"""
+        with patch.object(vlan, 'const', vlan.const._replace(VLAB_VLAN_ADMINS=['sally'])):
+            resp = self.app.delete('/api/2/inf/vlan/user/alice',
+                                   headers={'X-Auth': self.token})
+
+        status_code = resp.status_code
+        expected = 403
+
+        self.assertEqual(status_code, expected)
+        self.assertFalse(self.app.application.celery_app.send_task.called)
+
     @patch.object(flask_common, 'logger')
     def test_v1_404(self, fake_logger):
         """VlanView - GET on /api/1/inf/vlan returns HTTP 404"""
@@ -187,5 +1052,56 @@ class TestVlanView(unittest.TestCase):
 
         self.assertEqual(status, expected)
 
+class TestResultWatcher(unittest.TestCase):
+    """A set of test cases for the ``ResultWatcher`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.watcher = vlan.ResultWatcher(interval=0.01)
+        self.celery_app = MagicMock()
+        self.statuses = {}
+        self.celery_app.AsyncResult.side_effect = lambda task_id: MagicMock(status=self.statuses.get(task_id, 'PENDING'))
+
+    def test_wait(self):
+        """ResultWatcher - ``wait`` returns True once the task finishes"""
+        timer = threading.Timer(0.05, self.statuses.update, args=({'task-1': 'SUCCESS'},))
+        timer.start()
+
+        result = self.watcher.wait(self.celery_app, 'task-1', timeout=5)
+
+        self.assertTrue(result)
+
+    def test_wait_timeout(self):
+        """ResultWatcher - ``wait`` returns False if the task does not finish in time"""
+        result = self.watcher.wait(self.celery_app, 'task-1', timeout=0.05)
+
+        self.assertFalse(result)
+
+    def test_wait_shared(self):
+        """ResultWatcher - requests waiting on the same task share each check of the result backend"""
+        waiters = [threading.Thread(target=self.watcher.wait, args=(self.celery_app, 'task-1', 0.3)) for _ in range(5)]
+        for waiter in waiters:
+            waiter.start()
+        for waiter in waiters:
+            waiter.join()
+
+        # A check every 0.01 seconds for 0.3 seconds, not one for each waiting request
+        self.assertTrue(self.celery_app.AsyncResult.call_count < 60)
+
+    def test_wait_error(self):
+        """ResultWatcher - ``wait`` keeps waiting if the result backend cannot be read"""
+        self.celery_app.AsyncResult.side_effect = [RuntimeError('testing'), MagicMock(status='SUCCESS')]
+
+        with patch.object(vlan, 'logger'):
+            result = self.watcher.wait(self.celery_app, 'task-1', timeout=5)
+
+        self.assertTrue(result)
+
+    def test_wait_forgets(self):
+        """ResultWatcher - tasks are no longer checked once nothing waits on them"""
+        self.watcher.wait(self.celery_app, 'task-1', timeout=0.05)
+
+        self.assertEqual(self.watcher._waiting, {})
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,12 +4,38 @@ A suite of tests for the functions in vmware.py
 """
 import unittest
 from unittest.mock import patch, MagicMock
+from concurrent.futures import Future
 
 from vlab_vlan.lib.worker import vmware
 
 
+def _future(error=None, result=None):
+    """Make a finished Future, like the ones returned by ``TaskWatcher.watch``"""
+    future = Future()
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+    return future
+
+
+def _prop(name, val):
+    """Make a property, like the ones returned by a PropertyCollector"""
+    prop = MagicMock()
+    prop.name = name
+    prop.val = val
+    return prop
+
+
 class TestVMware(unittest.TestCase):
     """A set of test cases for ``vmware.py``"""
+    @classmethod
+    def tearDown(cls):
+        """Runs after every test case"""
+        vmware.vcenter_session.close()
+        vmware.switch_cache.invalidate()
+        vmware.network_cache.invalidate()
+
     def test_spec(self):
         """vmware - ``get_dv_portgroup_spec`` returns vim.dvs.DistributedVirtualPortgroup.ConfigSpec"""
         spec = vmware.get_dv_portgroup_spec(name='myVlan', vlan_id=1234)
@@ -30,71 +56,962 @@ class TestVMware(unittest.TestCase):
         expected = 1234
         self.assertEqual(spec.defaultPortConfig.vlan.vlanId, expected)
 
-    @patch.object(vmware, 'consume_task')
+    def test_task_filter_spec(self):
+        """vmware - ``get_task_filter_spec`` follows the state of every task in the ListView"""
+        view = vmware.vim.view.ListView('session[1234]5678')
+        spec = vmware.get_task_filter_spec(view)
+
+        result = (spec.objectSet[0].obj, spec.propSet[0].type, 'info.state' in spec.propSet[0].pathSet)
+        expected = (view, vmware.vim.Task, True)
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
     @patch.object(vmware, 'vCenter')
-    def test_delete_network(self, fake_vCenter, fake_consume_task):
+    def test_delete_network(self, fake_vCenter, fake_task_watcher, fake_get_inventory):
         """vmware - ``delete_network`` returns None upon success"""
+        fake_task_watcher.watch.return_value = _future()
+        fake_network = MagicMock()
+        fake_network.name = 'someNetwork'
+        fake_get_inventory.return_value = {'someNetwork': fake_network}
         result = vmware.delete_network(name='someNetwork')
         expected = None
 
         self.assertEqual(result, expected)
 
+    @patch.object(vmware, 'get_inventory')
     @patch.object(vmware, 'vCenter')
-    def test_delete_network_not_exists(self, fake_vCenter):
+    def test_delete_network_not_exists(self, fake_vCenter, fake_get_inventory):
         """vmware - ``delete_network`` raises ValueError if the vLAN network does not exist"""
         fake_network = MagicMock()
-        fake_vCenter.return_value.__enter__.return_value.networks = {'someNetwork': fake_network}
+        fake_network.name = 'someNetwork'
+        fake_get_inventory.return_value = {'someNetwork': fake_network}
 
         with self.assertRaises(ValueError):
             vmware.delete_network(name='DerpNetwork')
 
-    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
     @patch.object(vmware, 'vCenter')
-    def test_delete_network_in_use(self, fake_vCenter, fake_consume_task):
+    def test_delete_network_in_use(self, fake_vCenter, fake_task_watcher, fake_get_inventory):
         """vmware - ``delete_network`` raises ValueError if the vLAN is still being used by VMs"""
-        fake_consume_task.side_effect = [RuntimeError()]
+        fake_network = MagicMock()
+        fake_network.name = 'someNetwork'
+        fake_get_inventory.return_value = {'someNetwork': fake_network}
+        fake_task_watcher.watch.return_value = _future(RuntimeError())
 
         with self.assertRaises(ValueError):
             vmware.delete_network(name='someNetwork')
 
+    @patch.object(vmware, 'get_portgroups')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
     @patch.object(vmware, 'vCenter')
-    def test_create_network(self, fake_vCenter):
-        """vmware - ``create_network`` returns an empty string when successful"""
-        fake_task = MagicMock()
-        fake_task.info.error = None
+    def test_create_network(self, fake_vCenter, fake_task_watcher, fake_get_inventory, fake_get_portgroups):
+        """vmware - ``create_network`` returns an empty error and the id of the new portgroup when successful"""
+        fake_task_watcher.watch.return_value = _future(result=vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-42'))
         fake_switch = MagicMock()
-        fake_switch.AddDVPortgroup_Task.return_value = fake_task
-        fake_vCenter.return_value.__enter__.return_value.dv_switches = {'someSwitch': fake_switch}
+        fake_get_inventory.return_value = {'someSwitch': fake_switch}
 
         result = vmware.create_network(name='myVlan', vlan_id=1234, switch_name='someSwitch')
-        expected = ''
+        expected = ('', 'dvportgroup-42')
 
         self.assertEqual(result, expected)
+        self.assertTrue(fake_switch.CreateDVPortgroup_Task.called)
+
+    @patch.object(vmware, 'get_portgroups')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_create_network_no_listing(self, fake_vCenter, fake_task_watcher, fake_get_inventory, fake_get_portgroups):
+        """vmware - ``create_network`` does not list the portgroups of the switch when the portgroup is made"""
+        fake_task_watcher.watch.return_value = _future(result=vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-42'))
+        fake_get_inventory.return_value = {'someSwitch': MagicMock()}
 
+        vmware.create_network(name='myVlan', vlan_id=1234, switch_name='someSwitch')
+
+        self.assertFalse(fake_get_portgroups.called)
+
+    @patch.object(vmware, 'get_inventory')
     @patch.object(vmware, 'vCenter')
-    def test_create_network_valueerror(self, fake_vCenter):
+    def test_create_network_valueerror(self, fake_vCenter, fake_get_inventory):
         """vmware - ``create_network`` raises ValueError if the switch does not exist"""
         fake_task = MagicMock()
         fake_task.info.error.msg = None
         fake_switch = MagicMock()
         fake_switch.AddDVPortgroup_Task.return_value = fake_task
-        fake_vCenter.return_value.__enter__.return_value.dv_switches = {'otherSwitch': fake_switch}
+        fake_get_inventory.return_value = {'otherSwitch': fake_switch}
 
         with self.assertRaises(ValueError):
             vmware.create_network(name='myVlan', vlan_id=1234, switch_name='someSwitch')
 
-    @patch.object(vmware, 'consume_task')
+    @patch.object(vmware, 'get_portgroups')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
     @patch.object(vmware, 'vCenter')
-    def test_create_network_error(self, fake_vCenter, fake_consume_task):
+    def test_create_network_error(self, fake_vCenter, fake_task_watcher, fake_get_inventory, fake_get_portgroups):
         """vmware - ``create_network`` returns the error message upon failure"""
-        fake_consume_task.side_effect = [RuntimeError('Some handy error message')]
+        fake_task_watcher.watch.return_value = _future(RuntimeError('Some handy error message'))
+        fake_get_inventory.return_value = {'someSwitch': MagicMock()}
+        fake_get_portgroups.return_value = {}
 
         result = vmware.create_network(name='myVlan', vlan_id=1234, switch_name='someSwitch')
-        expected = 'Some handy error message'
+        expected = ('Some handy error message', None)
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vmware, 'get_portgroups')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_create_networks(self, fake_vCenter, fake_task_watcher, fake_get_inventory, fake_get_portgroups):
+        """vmware - ``create_networks`` makes every portgroup with a single vCenter task"""
+        fake_task_watcher.watch.return_value = _future()
+        fake_switch = MagicMock()
+        fake_get_inventory.return_value = {'someSwitch': fake_switch}
+        fake_get_portgroups.return_value = {'vlanA': vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-1'),
+                                            'vlanB': vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-2')}
+
+        result = vmware.create_networks(vlans={'vlanA': 200, 'vlanB': 201}, switch_name='someSwitch')
+        expected = ({'vlanA': '', 'vlanB': ''}, {'vlanA': 'dvportgroup-1', 'vlanB': 'dvportgroup-2'})
+
+        self.assertEqual(result, expected)
+        self.assertEqual(fake_switch.AddDVPortgroup_Task.call_count, 1)
+        self.assertEqual(len(fake_switch.AddDVPortgroup_Task.call_args[0][0]), 2)
+
+    @patch.object(vmware, 'get_portgroups')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_create_networks_cached(self, fake_vCenter, fake_task_watcher, fake_get_inventory, fake_get_portgroups):
+        """vmware - ``create_networks`` adds the new portgroups to the index of networks"""
+        fake_task_watcher.watch.return_value = _future()
+        fake_get_inventory.return_value = {'someSwitch': MagicMock()}
+        new_portgroup = vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-1')
+        fake_get_portgroups.return_value = {'vlanA': new_portgroup}
+        vmware.network_cache.names(fake_vCenter.return_value)
+
+        vmware.create_networks(vlans={'vlanA': 200}, switch_name='someSwitch')
+        result = vmware.network_cache.get_many(fake_vCenter.return_value, ['vlanA'])
+
+        self.assertEqual(result, {'vlanA': new_portgroup})
+        # Once for the switches, and once for the networks before the portgroup was made
+        self.assertEqual(fake_get_inventory.call_count, 2)
+
+    @patch.object(vmware, 'get_portgroups')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_create_networks_error(self, fake_vCenter, fake_task_watcher, fake_get_inventory, fake_get_portgroups):
+        """vmware - ``create_networks`` only reports an error for the portgroups that were not made"""
+        fake_task_watcher.watch.return_value = _future(RuntimeError('some error'))
+        fake_get_inventory.return_value = {'someSwitch': MagicMock()}
+        fake_get_portgroups.return_value = {'vlanA': vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-1')}
+
+        result = vmware.create_networks(vlans={'vlanA': 200, 'vlanB': 201}, switch_name='someSwitch')
+        expected = ({'vlanA': '', 'vlanB': 'some error'}, {'vlanA': 'dvportgroup-1'})
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vmware, 'get_portgroups')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_create_networks_stale_switch(self, fake_vCenter, fake_task_watcher, fake_get_inventory, fake_get_portgroups):
+        """vmware - ``create_networks`` looks the switch up again if the cached one no longer exists"""
+        fake_task_watcher.watch.return_value = _future()
+        stale_switch = MagicMock()
+        stale_switch.CreateDVPortgroup_Task.side_effect = vmware.vmodl.fault.ManagedObjectNotFound()
+        new_switch = MagicMock()
+        fake_get_inventory.side_effect = [{'someSwitch': stale_switch}, {'someSwitch': new_switch}]
+        fake_get_portgroups.return_value = {'vlanA': vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-1')}
+
+        result = vmware.create_networks(vlans={'vlanA': 200}, switch_name='someSwitch')
+
+        self.assertEqual(result[0], {'vlanA': ''})
+        self.assertTrue(new_switch.CreateDVPortgroup_Task.called)
+
+    @patch.object(vmware, 'get_inventory_filter_spec')
+    def test_get_inventory(self, fake_get_inventory_filter_spec):
+        """vmware - ``get_inventory`` maps the name of every object to the object"""
+        fake_vcenter = MagicMock()
+        fake_obj = MagicMock()
+        fake_obj.propSet = [_prop('name', 'someSwitch')]
+        fake_vcenter.content.propertyCollector.RetrievePropertiesEx.return_value.objects = [fake_obj]
+        fake_vcenter.content.propertyCollector.RetrievePropertiesEx.return_value.token = None
+
+        result = vmware.get_inventory(fake_vcenter, vmware.vim.DistributedVirtualSwitch)
+        expected = {'someSwitch': fake_obj.obj}
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vmware, 'get_inventory_filter_spec')
+    def test_get_inventory_pages(self, fake_get_inventory_filter_spec):
+        """vmware - ``get_inventory`` reads every page of results, and cleans up the view"""
+        fake_vcenter = MagicMock()
+        collector = fake_vcenter.content.propertyCollector
+        first, second = MagicMock(), MagicMock()
+        first.propSet = [_prop('name', 'switchA')]
+        second.propSet = [_prop('name', 'switchB')]
+        collector.RetrievePropertiesEx.return_value.objects = [first]
+        collector.RetrievePropertiesEx.return_value.token = 'more'
+        collector.ContinueRetrievePropertiesEx.return_value.objects = [second]
+        collector.ContinueRetrievePropertiesEx.return_value.token = None
+
+        result = vmware.get_inventory(fake_vcenter, vmware.vim.DistributedVirtualSwitch)
+
+        self.assertEqual(sorted(result.keys()), ['switchA', 'switchB'])
+        self.assertTrue(fake_vcenter.content.viewManager.CreateContainerView.return_value.DestroyView.called)
+
+    def test_inventory_filter_spec(self):
+        """vmware - ``get_inventory_filter_spec`` only reads the name of each object"""
+        view = vmware.vim.view.ContainerView('session[1234]5678')
+        spec = vmware.get_inventory_filter_spec(view, vmware.vim.DistributedVirtualSwitch)
+
+        self.assertEqual(list(spec.propSet[0].pathSet), ['name'])
+
+    def test_portgroup_filter_spec(self):
+        """vmware - ``get_portgroup_filter_spec`` reads the name of every portgroup on the switch"""
+        switch = vmware.vim.DistributedVirtualSwitch('dvs-1')
+        spec = vmware.get_portgroup_filter_spec(switch)
+
+        result = (spec.objectSet[0].obj, spec.objectSet[0].selectSet[0].path, list(spec.propSet[0].pathSet))
+        expected = (switch, 'portgroup', ['name'])
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vmware, 'get_portgroup_filter_spec')
+    def test_get_portgroups(self, fake_get_portgroup_filter_spec):
+        """vmware - ``get_portgroups`` maps the name of every portgroup on a switch to the portgroup"""
+        fake_vcenter = MagicMock()
+        fake_obj = MagicMock()
+        fake_obj.propSet = [_prop('name', 'vlanA')]
+        fake_vcenter.content.propertyCollector.RetrievePropertiesEx.return_value.objects = [fake_obj]
+        fake_vcenter.content.propertyCollector.RetrievePropertiesEx.return_value.token = None
+
+        result = vmware.get_portgroups(fake_vcenter, MagicMock())
+        expected = {'vlanA': fake_obj.obj}
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vmware, '_retrieve_from_view')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'vCenter')
+    def test_find_portgroups(self, fake_vCenter, fake_get_inventory, fake_retrieve_from_view):
+        """vmware - ``find_portgroups`` returns the switch name and portgroup id of the networks asked for"""
+        switch = vmware.vim.DistributedVirtualSwitch('dvs-1')
+        fake_get_inventory.return_value = {'someSwitch': switch}
+        fake_retrieve_from_view.return_value = [
+            (vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-1'), {'name': 'vlanA', 'config.distributedVirtualSwitch': switch}),
+            (vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-2'), {'name': 'otherVlan', 'config.distributedVirtualSwitch': switch}),
+        ]
+
+        result = vmware.find_portgroups(['vlanA', 'vlanB'])
+        expected = {'vlanA': ('someSwitch', 'dvportgroup-1')}
+
+        self.assertEqual(result, expected)
+
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'vCenter')
+    def test_create_networks_valueerror(self, fake_vCenter, fake_get_inventory):
+        """vmware - ``create_networks`` raises ValueError if the switch does not exist"""
+        fake_get_inventory.return_value = {'otherSwitch': MagicMock()}
+
+        with self.assertRaises(ValueError):
+            vmware.create_networks(vlans={'vlanA': 200}, switch_name='someSwitch')
+
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_networks(self, fake_vCenter, fake_task_watcher, fake_get_inventory):
+        """vmware - ``delete_networks`` starts every destroy before waiting on any of them"""
+        fake_get_inventory.return_value = {'vlanA': MagicMock(), 'vlanB': MagicMock()}
+        started = []
+        for name, network in fake_get_inventory.return_value.items():
+            network.Destroy_Task.side_effect = lambda name=name: started.append(name)
+        fake_task_watcher.watch.return_value.result.side_effect = lambda: self.assertEqual(len(started), 2)
+
+        result = vmware.delete_networks(names=['vlanA', 'vlanB'])
+        expected = {'vlanA': '', 'vlanB': ''}
 
         self.assertEqual(result, expected)
 
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_networks_errors(self, fake_vCenter, fake_task_watcher, fake_get_inventory):
+        """vmware - ``delete_networks`` reports an error for each network it could not destroy"""
+        fake_network = MagicMock()
+        fake_network.name = 'vlanA'
+        fake_get_inventory.return_value = {'vlanA': fake_network}
+        fake_task_watcher.watch.return_value = _future(RuntimeError('in use'))
+
+        result = vmware.delete_networks(names=['vlanA', 'vlanB'])
+
+        self.assertTrue(result['vlanA'].startswith('Network vlanA in use'))
+        self.assertEqual(result['vlanB'], vmware.NO_SUCH_VLAN.format('vlanB'))
+
+
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_networks_indexed(self, fake_vCenter, fake_task_watcher, fake_get_inventory):
+        """vmware - ``delete_networks`` does not enumerate every network for each delete"""
+        fake_task_watcher.watch.return_value = _future()
+        fake_get_inventory.return_value = {'vlanA': MagicMock(), 'vlanB': MagicMock()}
+        vmware.delete_networks(names=['vlanA'])
+        vmware.delete_networks(names=['vlanB'])
+
+        self.assertEqual(fake_get_inventory.call_count, 1)
+
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_networks_forgets(self, fake_vCenter, fake_task_watcher, fake_get_inventory):
+        """vmware - ``delete_networks`` removes destroyed networks from the index"""
+        fake_task_watcher.watch.return_value = _future()
+        fake_get_inventory.return_value = {'vlanA': MagicMock()}
+        vmware.delete_networks(names=['vlanA'])
+        fake_get_inventory.return_value = {}
+
+        result = vmware.delete_networks(names=['vlanA'])
+
+        self.assertEqual(result, {'vlanA': vmware.NO_SUCH_VLAN.format('vlanA')})
+
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_networks_stale(self, fake_vCenter, fake_task_watcher, fake_get_inventory):
+        """vmware - ``delete_networks`` looks a network up again if the indexed one no longer exists"""
+        fake_task_watcher.watch.return_value = _future()
+        stale_network = MagicMock()
+        stale_network.Destroy_Task.side_effect = vmware.vmodl.fault.ManagedObjectNotFound()
+        new_network = MagicMock()
+        fake_get_inventory.side_effect = [{'vlanA': stale_network}, {'vlanA': new_network}]
+
+        result = vmware.delete_networks(names=['vlanA'])
+
+        self.assertEqual(result, {'vlanA': ''})
+        self.assertTrue(new_network.Destroy_Task.called)
+
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_networks_gone(self, fake_vCenter, fake_task_watcher, fake_get_inventory):
+        """vmware - ``delete_networks`` reports an indexed network that no longer exists"""
+        stale_network = MagicMock()
+        stale_network.Destroy_Task.side_effect = vmware.vmodl.fault.ManagedObjectNotFound()
+        fake_get_inventory.side_effect = [{'vlanA': stale_network}, {}]
+
+        result = vmware.delete_networks(names=['vlanA'])
+
+        self.assertEqual(result, {'vlanA': vmware.NO_SUCH_VLAN.format('vlanA')})
+
+    @patch.object(vmware, '_get_object')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_networks_by_id(self, fake_vCenter, fake_task_watcher, fake_get_inventory, fake_get_object):
+        """vmware - ``delete_networks`` does not look up networks whose portgroup id is known"""
+        fake_task_watcher.watch.return_value = _future()
+
+        result = vmware.delete_networks(names=['vlanA'], portgroups={'vlanA': 'dvportgroup-1'})
+
+        self.assertEqual(result, {'vlanA': ''})
+        self.assertFalse(fake_get_inventory.called)
+        self.assertTrue(fake_get_object.return_value.Destroy_Task.called)
+
+    @patch.object(vmware, '_get_object')
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_delete_networks_by_id_stale(self, fake_vCenter, fake_task_watcher, fake_get_inventory, fake_get_object):
+        """vmware - ``delete_networks`` treats a portgroup id that no longer exists as destroyed, and leaves networks with the same name alone"""
+        fake_task_watcher.watch.return_value = _future()
+        fake_get_object.return_value.Destroy_Task.side_effect = vmware.vmodl.fault.ManagedObjectNotFound()
+        fake_network = MagicMock()
+        fake_get_inventory.return_value = {'vlanA': fake_network}
+
+        result = vmware.delete_networks(names=['vlanA'], portgroups={'vlanA': 'dvportgroup-1'})
+
+        self.assertEqual(result, {'vlanA': ''})
+        self.assertFalse(fake_network.Destroy_Task.called)
+
+    @patch.object(vmware, '_get_object')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_rename_network(self, fake_vCenter, fake_task_watcher, fake_get_object):
+        """vmware - ``rename_network`` returns an empty string when successful"""
+        fake_task_watcher.watch.return_value = _future()
+
+        result = vmware.rename_network('dvportgroup-1', 'myVlan')
+
+        self.assertEqual(result, '')
+        fake_get_object.return_value.Rename_Task.assert_called_with(newName='myVlan')
+
+    @patch.object(vmware, '_get_object')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_rename_network_gone(self, fake_vCenter, fake_task_watcher, fake_get_object):
+        """vmware - ``rename_network`` returns an error if the portgroup no longer exists"""
+        fake_get_object.return_value.Rename_Task.side_effect = vmware.vmodl.fault.ManagedObjectNotFound()
+
+        result = vmware.rename_network('dvportgroup-1', 'myVlan')
+
+        self.assertEqual(result, 'No such portgroup: dvportgroup-1')
+
+    @patch.object(vmware, 'get_inventory')
+    @patch.object(vmware, '_get_object')
+    @patch.object(vmware, 'task_watcher')
+    @patch.object(vmware, 'vCenter')
+    def test_rename_network_cached(self, fake_vCenter, fake_task_watcher, fake_get_object, fake_get_inventory):
+        """vmware - ``rename_network`` moves the portgroup to its new name in the index of networks"""
+        fake_task_watcher.watch.return_value = _future()
+        fake_get_inventory.return_value = {'warm_200': vmware.vim.dvs.DistributedVirtualPortgroup('dvportgroup-1')}
+        fake_get_object.return_value = MagicMock(_moId='dvportgroup-1')
+        vmware.network_cache.names(fake_vCenter.return_value)
+
+        vmware.rename_network('dvportgroup-1', 'myVlan')
+        result = vmware.network_cache.names(fake_vCenter.return_value)
+
+        self.assertEqual(result, ['myVlan'])
+
+    def test_get_object(self):
+        """vmware - ``_get_object`` makes an object with the supplied managed object id"""
+        fake_vcenter = MagicMock()
+
+        result = vmware._get_object(fake_vcenter, vmware.vim.dvs.DistributedVirtualPortgroup, 'dvportgroup-1')
+
+        self.assertEqual(result._moId, 'dvportgroup-1')
+
+
+class TestInventoryCache(unittest.TestCase):
+    """A set of test cases for the ``InventoryCache`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.cache = vmware.InventoryCache(vmware.vim.DistributedVirtualSwitch, ttl=60)
+        self.vcenter = MagicMock()
+
+    @patch.object(vmware, 'get_inventory')
+    def test_get(self, fake_get_inventory):
+        """InventoryCache - ``get`` returns the object with the supplied name"""
+        fake_get_inventory.return_value = {'someSwitch': 'switch-1'}
+
+        result = self.cache.get(self.vcenter, 'someSwitch')
+
+        self.assertEqual(result, 'switch-1')
+
+    @patch.object(vmware, 'get_inventory')
+    def test_get_cached(self, fake_get_inventory):
+        """InventoryCache - ``get`` only reads the inventory once within the TTL"""
+        fake_get_inventory.return_value = {'someSwitch': 'switch-1'}
+        self.cache.get(self.vcenter, 'someSwitch')
+        self.cache.get(self.vcenter, 'someSwitch')
+
+        self.assertEqual(fake_get_inventory.call_count, 1)
+
+    @patch.object(vmware, 'get_inventory')
+    def test_get_expired(self, fake_get_inventory):
+        """InventoryCache - ``get`` reads the inventory again once the TTL is up"""
+        fake_get_inventory.return_value = {'someSwitch': 'switch-1'}
+        self.cache.get(self.vcenter, 'someSwitch')
+        self.cache._expires_at = 0
+        self.cache.get(self.vcenter, 'someSwitch')
+
+        self.assertEqual(fake_get_inventory.call_count, 2)
+
+    @patch.object(vmware, 'get_inventory')
+    def test_get_new_session(self, fake_get_inventory):
+        """InventoryCache - ``get`` reads the inventory again when the vCenter session changes"""
+        fake_get_inventory.return_value = {'someSwitch': 'switch-1'}
+        self.cache.get(self.vcenter, 'someSwitch')
+        self.cache.get(MagicMock(), 'someSwitch')
+
+        self.assertEqual(fake_get_inventory.call_count, 2)
+
+    @patch.object(vmware, 'get_inventory')
+    def test_get_miss(self, fake_get_inventory):
+        """InventoryCache - ``get`` reads the inventory again for a name it does not know"""
+        fake_get_inventory.side_effect = [{'someSwitch': 'switch-1'}, {'someSwitch': 'switch-1', 'newSwitch': 'switch-2'}]
+        self.cache.get(self.vcenter, 'someSwitch')
+
+        result = self.cache.get(self.vcenter, 'newSwitch')
+
+        self.assertEqual(result, 'switch-2')
+
+    @patch.object(vmware, 'get_inventory')
+    def test_get_keyerror(self, fake_get_inventory):
+        """InventoryCache - ``get`` raises KeyError if vCenter has no object by that name"""
+        fake_get_inventory.return_value = {'someSwitch': 'switch-1'}
+
+        with self.assertRaises(KeyError):
+            self.cache.get(self.vcenter, 'otherSwitch')
+        self.assertEqual(fake_get_inventory.call_count, 1)
+
+    @patch.object(vmware, 'get_inventory')
+    def test_get_many(self, fake_get_inventory):
+        """InventoryCache - ``get_many`` reads the inventory at most once for many unknown names"""
+        fake_get_inventory.return_value = {'a': 'switch-1'}
+        self.cache.get(self.vcenter, 'a')
+
+        result = self.cache.get_many(self.vcenter, ['a', 'b', 'c'])
+
+        self.assertEqual(result, {'a': 'switch-1'})
+        self.assertEqual(fake_get_inventory.call_count, 2)
+
+    @patch.object(vmware, 'get_inventory')
+    def test_remove(self, fake_get_inventory):
+        """InventoryCache - ``remove`` forgets the supplied objects"""
+        fake_get_inventory.side_effect = [{'a': 'switch-1', 'b': 'switch-2'}, {'b': 'switch-2'}]
+        self.cache.get(self.vcenter, 'a')
+        self.cache.remove(['a'])
+
+        result = self.cache.get_many(self.vcenter, ['a', 'b'])
+
+        self.assertEqual(result, {'b': 'switch-2'})
+
+    @patch.object(vmware, 'get_inventory')
+    def test_add(self, fake_get_inventory):
+        """InventoryCache - ``add`` remembers new objects without reading the inventory again"""
+        fake_get_inventory.return_value = {'a': 'switch-1'}
+        self.cache.get(self.vcenter, 'a')
+        self.cache.add(self.vcenter, {'b': 'switch-2'})
+
+        result = self.cache.get_many(self.vcenter, ['a', 'b'])
+
+        self.assertEqual(result, {'a': 'switch-1', 'b': 'switch-2'})
+        self.assertEqual(fake_get_inventory.call_count, 1)
+
+    @patch.object(vmware, 'get_inventory')
+    def test_add_other_session(self, fake_get_inventory):
+        """InventoryCache - ``add`` ignores objects from a different vCenter session"""
+        fake_get_inventory.return_value = {'a': 'switch-1'}
+        self.cache.get(self.vcenter, 'a')
+        self.cache.add(MagicMock(), {'b': 'switch-2'})
+
+        result = self.cache.names(self.vcenter)
+
+        self.assertEqual(result, ['a'])
+
+    @patch.object(vmware, 'get_inventory')
+    def test_invalidate(self, fake_get_inventory):
+        """InventoryCache - ``invalidate`` makes the next lookup read the inventory"""
+        fake_get_inventory.return_value = {'someSwitch': 'switch-1'}
+        self.cache.get(self.vcenter, 'someSwitch')
+        self.cache.invalidate()
+        self.cache.get(self.vcenter, 'someSwitch')
+
+        self.assertEqual(fake_get_inventory.call_count, 2)
+
+    @patch.object(vmware, 'get_inventory')
+    def test_names(self, fake_get_inventory):
+        """InventoryCache - ``names`` returns the name of every object"""
+        fake_get_inventory.return_value = {'b': 'switch-2', 'a': 'switch-1'}
+
+        result = self.cache.names(self.vcenter)
+
+        self.assertEqual(result, ['a', 'b'])
+
+
+class TestSessionManager(unittest.TestCase):
+    """A set of test cases for the ``SessionManager`` object"""
+    @classmethod
+    def setUp(cls):
+        """Runs before every test case"""
+        cls.session = vmware.SessionManager(host='localhost', user='alice', password='IloveCats')
+
+    @patch.object(vmware, 'vCenter')
+    def test_get(self, fake_vCenter):
+        """SessionManager - ``get`` logs into vCenter once, and reuses that session"""
+        self.session.get()
+        self.session.get()
+
+        self.assertEqual(fake_vCenter.call_count, 1)
+
+    @patch.object(vmware, 'vCenter')
+    def test_get_expired(self, fake_vCenter):
+        """SessionManager - ``get`` logs in again if an idle session has expired"""
+        fake_vCenter.return_value.content.sessionManager.currentSession = None
+        self.session.get()
+        self.session._last_used = 0
+        self.session.get()
+
+        self.assertEqual(fake_vCenter.call_count, 2)
+
+    @patch.object(vmware, 'vCenter')
+    def test_get_idle_ok(self, fake_vCenter):
+        """SessionManager - ``get`` reuses an idle session that is still valid"""
+        self.session.get()
+        self.session._last_used = 0
+        self.session.get()
+
+        self.assertEqual(fake_vCenter.call_count, 1)
+
+    @patch.object(vmware, 'vCenter')
+    def test_run(self, fake_vCenter):
+        """SessionManager - ``run`` passes the vCenter connection to the function"""
+        fake_func = MagicMock()
+        self.session.run(fake_func, 'foo', bar='baz')
+
+        fake_func.assert_called_with(fake_vCenter.return_value, 'foo', bar='baz')
+
+    @patch.object(vmware, 'vCenter')
+    def test_run_not_authenticated(self, fake_vCenter):
+        """SessionManager - ``run`` logs in again and retries if the session is no longer valid"""
+        fake_func = MagicMock()
+        fake_func.side_effect = [vmware.vim.fault.NotAuthenticated(), 'woot']
+        result = self.session.run(fake_func)
+
+        self.assertEqual(result, 'woot')
+        self.assertEqual(fake_vCenter.call_count, 2)
+
+    @patch.object(vmware, 'vCenter')
+    def test_reset(self, fake_vCenter):
+        """SessionManager - ``reset`` logs out of an expired session"""
+        vcenter = self.session.get()
+        self.session.reset(vcenter)
+        self.session.get()
+
+        self.assertEqual(fake_vCenter.call_count, 2)
+
+    @patch.object(vmware, 'vCenter')
+    def test_reset_replaced(self, fake_vCenter):
+        """SessionManager - ``reset`` keeps a session that already replaced the expired one"""
+        fake_vCenter.side_effect = [MagicMock(), MagicMock()]
+        old = self.session.get()
+        self.session.close()
+        new = self.session.get()
+        self.session.reset(old)
+
+        self.assertTrue(self.session.get() is new)
+
+    @patch.object(vmware, 'vCenter')
+    def test_close(self, fake_vCenter):
+        """SessionManager - ``close`` logs out of vCenter"""
+        self.session.get()
+        self.session.close()
+
+        self.assertTrue(fake_vCenter.return_value.close.called)
+
+    @patch.object(vmware, 'vCenter')
+    def test_close_error(self, fake_vCenter):
+        """SessionManager - ``close`` ignores errors from an already dead session"""
+        fake_vCenter.return_value.close.side_effect = RuntimeError('testing')
+        self.session.get()
+        self.session.close()
+        self.session.get()
+
+        self.assertEqual(fake_vCenter.call_count, 2)
+
+
+class TestTaskWatcher(unittest.TestCase):
+    """A set of test cases for the ``TaskWatcher`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.session = MagicMock()
+        self.vcenter = self.session.get.return_value
+        self.collector = self.vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        self.view = self.vcenter.content.viewManager.CreateListView.return_value
+        self.updates = []
+        self.collector.WaitForUpdatesEx.side_effect = self._wait_for_updates
+        self.spec_patcher = patch.object(vmware, 'get_task_filter_spec')
+        self.spec_patcher.start()
+        self.watcher = vmware.TaskWatcher(session=self.session, max_wait=1)
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.watcher.close()
+        self.spec_patcher.stop()
+
+    def _wait_for_updates(self, version, options):
+        """Stands in for ``WaitForUpdatesEx``; only reports on tasks being watched"""
+        for update in list(self.updates):
+            if update is None or update.filterSet[0].objectSet[0].obj._moId in self.watcher._watching:
+                self.updates.remove(update)
+                return update
+        vmware.time.sleep(0.01)
+        return None
+
+    def _task(self, moid, state, error=None, result=None):
+        """Make a fake vCenter task, and queue the update that reports its state"""
+        task = MagicMock()
+        task._moId = moid
+        obj_update = MagicMock()
+        obj_update.obj = task
+        obj_update.kind = 'enter'
+        obj_update.changeSet = []
+        for name, value in (('info.state', state), ('info.error', error), ('info.result', result)):
+            change = MagicMock()
+            change.name = name
+            change.val = value
+            obj_update.changeSet.append(change)
+        update = MagicMock()
+        update.filterSet = [MagicMock()]
+        update.filterSet[0].objectSet = [obj_update]
+        self.updates.append(update)
+        return task
+
+    def test_watch(self):
+        """TaskWatcher - ``watch`` returns a Future with the result of the vCenter task"""
+        task = self._task('task-1', 'success', result='woot')
+
+        result = self.watcher.watch(task).result(timeout=5)
+
+        self.assertEqual(result, 'woot')
+
+    def test_watch_error(self):
+        """TaskWatcher - ``watch`` returns a Future that raises RuntimeError if the vCenter task fails"""
+        error = MagicMock()
+        error.msg = 'some error'
+        task = self._task('task-1', 'error', error=error)
+
+        future = self.watcher.watch(task)
+
+        with self.assertRaises(RuntimeError) as err:
+            future.result(timeout=5)
+        self.assertEqual(str(err.exception), 'some error')
+
+    def test_watch_timeout(self):
+        """TaskWatcher - ``watch`` returns a Future that raises RuntimeError if the vCenter task takes too long"""
+        task = self._task('task-1', 'running')
+
+        future = self.watcher.watch(task, timeout=0)
+
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=5)
+
+    def test_watch_many(self):
+        """TaskWatcher - ``watch`` follows every vCenter task with one PropertyCollector filter"""
+        futures = [self.watcher.watch(self._task('task-{}'.format(x), 'success')) for x in range(3)]
+        for future in futures:
+            future.result(timeout=5)
+
+        self.assertEqual(self.collector.CreateFilter.call_count, 1)
+
+    def test_watch_running(self):
+        """TaskWatcher - ``watch`` does not complete the Future of a task that is still running"""
+        slow = self.watcher.watch(self._task('task-1', 'running'))
+        fast = self.watcher.watch(self._task('task-2', 'success'))
+        fast.result(timeout=5)
+
+        self.assertFalse(slow.done())
+
+    def test_watch_adds_to_view(self):
+        """TaskWatcher - ``watch`` adds new tasks to the ListView being followed"""
+        self.watcher.watch(self._task('task-1', 'running'))
+        for _ in range(500):
+            if self.watcher._view is not None:
+                break
+            vmware.time.sleep(0.01)
+        task = MagicMock()
+        task._moId = 'task-2'
+        self.watcher.watch(task)
+
+        self.view.ModifyListView.assert_any_call(add=[task])
+
+    def test_forget(self):
+        """TaskWatcher - tasks that finish are removed from the ListView being followed"""
+        task = self._task('task-1', 'success')
+        self.watcher.watch(task).result(timeout=5)
+
+        self.view.ModifyListView.assert_any_call(remove=[task])
+
+    def test_session_expired(self):
+        """TaskWatcher - a new PropertyCollector is made if vCenter expires the session"""
+        self.updates.append(None)
+        first = True
+        def wait_for_updates(version, options):
+            nonlocal first
+            if first:
+                first = False
+                raise vmware.vim.fault.NotAuthenticated()
+            return self._wait_for_updates(version, options)
+        self.collector.WaitForUpdatesEx.side_effect = wait_for_updates
+        task = self._task('task-1', 'success')
+
+        self.watcher.watch(task).result(timeout=5)
+
+        self.session.reset.assert_called_with(self.vcenter)
+        self.assertEqual(self.collector.CreateFilter.call_count, 2)
+
+    def test_close(self):
+        """TaskWatcher - ``close`` fails the Futures of tasks still being tracked"""
+        future = self.watcher.watch(self._task('task-1', 'running'))
+
+        self.watcher.close()
+
+        with self.assertRaises(RuntimeError):
+            future.result(timeout=5)
+
+    def test_thread_exits(self):
+        """TaskWatcher - the background thread stops once there is nothing to track"""
+        self.watcher.watch(self._task('task-1', 'success')).result(timeout=5)
+        for _ in range(500):
+            if self.watcher._thread is None:
+                break
+            vmware.time.sleep(0.01)
+
+        self.assertTrue(self.watcher._thread is None)
+
+
+class TestPortgroupMirror(unittest.TestCase):
+    """A set of test cases for the ``PortgroupMirror`` object"""
+    def setUp(self):
+        """Runs before every test case"""
+        self.vcenter = MagicMock()
+        self.collector = self.vcenter.content.propertyCollector.CreatePropertyCollector.return_value
+        self.updates = []
+        self.collector.WaitForUpdatesEx.side_effect = lambda version, options: self.updates.pop(0) if self.updates else None
+        switch = MagicMock()
+        switch._moId = 'dvs-1'
+        self.switch = switch
+        self.spec_patcher = patch.object(vmware, 'get_inventory_filter_spec')
+        self.spec_patcher.start()
+        self.inventory_patcher = patch.object(vmware, 'get_inventory')
+        self.fake_get_inventory = self.inventory_patcher.start()
+        self.fake_get_inventory.return_value = {'someSwitch': switch}
+        self.mirror = vmware.PortgroupMirror()
+
+    def tearDown(self):
+        """Runs after every test case"""
+        self.spec_patcher.stop()
+        self.inventory_patcher.stop()
+
+    def _update(self, *portgroups, truncated=False):
+        """Queue an update from vCenter. Each portgroup is a tuple of (moid, name, tag),
+        and a name of None means the portgroup was destroyed"""
+        update = MagicMock()
+        update.version = str(len(self.updates) + 1)
+        update.truncated = truncated
+        update.filterSet = [MagicMock()]
+        update.filterSet[0].objectSet = []
+        for moid, name, tag in portgroups:
+            obj_update = MagicMock()
+            obj_update.obj._moId = moid
+            obj_update.kind = 'leave' if name is None else 'enter'
+            obj_update.changeSet = []
+            vlan = MagicMock()
+            vlan.vlanId = tag
+            for path, value in (('name', name), ('config.defaultPortConfig.vlan', vlan),
+                                ('config.distributedVirtualSwitch', self.switch)):
+                change = MagicMock()
+                change.name = path
+                change.op = 'assign'
+                change.val = value
+                obj_update.changeSet.append(change)
+            update.filterSet[0].objectSet.append(obj_update)
+        self.updates.append(update)
+
+    def test_sync(self):
+        """PortgroupMirror - the first ``sync`` reads every portgroup"""
+        self._update(('dvportgroup-1', 'someVlan', 200))
+
+        full, changes = self.mirror.sync(self.vcenter)
+        expected = {'dvportgroup-1': {'name': 'someVlan', 'tag': 200, 'switch': 'someSwitch'}}
+
+        self.assertTrue(full)
+        self.assertEqual(changes, expected)
+
+    def test_sync_changes(self):
+        """PortgroupMirror - later calls to ``sync`` only report what changed"""
+        self._update(('dvportgroup-1', 'someVlan', 200), ('dvportgroup-2', 'otherVlan', 201))
+        self.mirror.sync(self.vcenter)
+        self._update(('dvportgroup-2', None, None))
+
+        full, changes = self.mirror.sync(self.vcenter)
+
+        self.assertFalse(full)
+        self.assertEqual(changes, {'dvportgroup-2': None})
+
+    def test_sync_version(self):
+        """PortgroupMirror - ``sync`` passes the version from the last update to vCenter"""
+        self._update(('dvportgroup-1', 'someVlan', 200))
+        self.mirror.sync(self.vcenter)
+
+        self.mirror.sync(self.vcenter)
+        version = self.collector.WaitForUpdatesEx.call_args[0][0]
+
+        self.assertEqual(version, '1')
+
+    def test_sync_truncated(self):
+        """PortgroupMirror - ``sync`` keeps reading while vCenter truncates the updates"""
+        self._update(('dvportgroup-1', 'someVlan', 200), truncated=True)
+        self._update(('dvportgroup-2', 'otherVlan', 201))
+
+        _, changes = self.mirror.sync(self.vcenter)
+
+        self.assertEqual(set(changes.keys()), {'dvportgroup-1', 'dvportgroup-2'})
+
+    def test_sync_error(self):
+        """PortgroupMirror - ``sync`` reads every portgroup again after an error"""
+        self._update(('dvportgroup-1', 'someVlan', 200))
+        self.mirror.sync(self.vcenter)
+        self.collector.WaitForUpdatesEx.side_effect = RuntimeError('testing')
+        with self.assertRaises(RuntimeError):
+            self.mirror.sync(self.vcenter)
+        self.collector.WaitForUpdatesEx.side_effect = None
+        self.collector.WaitForUpdatesEx.return_value = None
+
+        full, _ = self.mirror.sync(self.vcenter)
+
+        self.assertTrue(full)
+
+    def test_sync_new_session(self):
+        """PortgroupMirror - ``sync`` reads every portgroup again when the vCenter session changes"""
+        self.mirror.sync(self.vcenter)
+        other_vcenter = MagicMock()
+        other_vcenter.content.propertyCollector.CreatePropertyCollector.return_value.WaitForUpdatesEx.return_value = None
+
+        full, _ = self.mirror.sync(other_vcenter)
+
+        self.assertTrue(full)
+
+    def test_sync_trunk(self):
+        """PortgroupMirror - ``sync`` has no tag for portgroups that trunk many vLANs"""
+        self._update(('dvportgroup-1', 'someTrunk', [MagicMock()]))
+
+        _, changes = self.mirror.sync(self.vcenter)
+
+        self.assertTrue(changes['dvportgroup-1']['tag'] is None)
+
+    def test_get(self):
+        """PortgroupMirror - ``get`` leaves out portgroups that do not exist"""
+        self._update(('dvportgroup-1', 'someVlan', 200))
+        self.mirror.sync(self.vcenter)
+
+        found = self.mirror.get(['dvportgroup-1', 'dvportgroup-2'])
+
+        self.assertEqual(list(found.keys()), ['dvportgroup-1'])
+
+    def test_find(self):
+        """PortgroupMirror - ``find`` looks up portgroups by name"""
+        self._update(('dvportgroup-1', 'someVlan', 200))
+        self.mirror.sync(self.vcenter)
+
+        found = self.mirror.find(['someVlan', 'otherVlan'])
+        expected = {'someVlan': ('dvportgroup-1', {'name': 'someVlan', 'tag': 200, 'switch': 'someSwitch'})}
+
+        self.assertEqual(found, expected)
+
+    def test_find_renamed(self):
+        """PortgroupMirror - ``find`` forgets the old name of a renamed portgroup"""
+        self._update(('dvportgroup-1', 'someVlan', 200))
+        self.mirror.sync(self.vcenter)
+        self._update(('dvportgroup-1', 'otherVlan', 200))
+        self.mirror.sync(self.vcenter)
+
+        found = self.mirror.find(['someVlan'])
+
+        self.assertEqual(found, {})
+
+    def test_close(self):
+        """PortgroupMirror - ``close`` destroys the PropertyCollector"""
+        self.mirror.sync(self.vcenter)
+
+        self.mirror.close()
 
+        self.assertTrue(self.collector.DestroyPropertyCollector.called)
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,12 +2,13 @@
 from flask import Flask
 from celery import Celery
 
-from vlab_vlan.lib import const
+from vlab_vlan.lib import const, queues
 from vlab_vlan.lib.views import VlanView, HealthView
 
 app = Flask(__name__)
 app.celery_app = Celery('vlan', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
 app.celery_app.conf.broker_heartbeat = 0 #https://github.com/celery/celery/issues/4895
+queues.configure(app.celery_app)
 
 VlanView.register(app)
 HealthView.register(app)
@@ -0,0 +1,253 @@
+# -*- coding: UTF-8 -*-
+"""
+Caches for data that is read far more often than it changes, like the vLANs a
+user owns. The in-process ``MemoryCache`` is used by default. Set
+``VLAB_VLAN_CACHE_URL`` to a ``redis://`` URL to share one cache between every
+API and worker process; that requires the optional ``redis`` package.
+"""
+import time
+import threading
+from collections import OrderedDict
+
+import ujson
+
+from vlab_vlan.lib import const
+
+
+class MemoryCache(object):
+    """A cache that lives within a single process. Entries expire after a TTL,
+    and the least recently used entry is evicted once the cache is full.
+
+    :param max_size: The most entries to hold at once
+    :type max_size: Integer
+
+    :param ttl: How many seconds an entry is valid for
+    :type ttl: Integer
+    """
+    def __init__(self, max_size=1024, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Look up an entry.
+
+        :Returns: The cached value, or None if there's no valid entry
+
+        :param key: The entry to look up
+        :type key: String
+        """
+        with self._lock:
+            try:
+                expires_at, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires_at < time.time():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Create or replace an entry.
+
+        :Returns: None
+
+        :param key: The name of the entry
+        :type key: String
+
+        :param value: What to store
+        :type value: Object
+
+        :param ttl: Override the default number of seconds the entry is valid for
+        :type ttl: Integer
+        """
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Create an entry, but only if there is not already a valid one.
+
+        :Returns: Boolean - True if the entry was created
+
+        :param key: The name of the entry
+        :type key: String
+
+        :param value: What to store
+        :type value: Object
+
+        :param ttl: Override the default number of seconds the entry is valid for
+        :type ttl: Integer
+        """
+        with self._lock:
+            current = self._data.get(key, None)
+            if current is not None and current[0] >= time.time():
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def _store(self, key, value, ttl):
+        """Save an entry, evicting the least recently used entries if the cache
+        is full. The caller must hold the lock.
+
+        :Returns: None
+        """
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (time.time() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove an entry, if it exists.
+
+        :Returns: None
+
+        :param key: The name of the entry
+        :type key: String
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        """Remove every entry, and reset the hit/miss counters.
+
+        :Returns: None
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Report how well the cache is working.
+
+        :Returns: Dictionary
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+class RedisCache(object):
+    """A cache stored in Redis, so every process sees the same entries. Values
+    must be JSON serializable. The hit/miss counters are per-process.
+
+    :param url: The Redis server to use, like ``redis://vlan-cache:6379/0``
+    :type url: String
+
+    :param ttl: How many seconds an entry is valid for
+    :type ttl: Integer
+
+    :param prefix: Prepended to every key, to avoid colliding with other users of the Redis server
+    :type prefix: String
+    """
+    def __init__(self, url, ttl=30, prefix='vlab-vlan:'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('The redis package is required to use {}'.format(url))
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._prefix = prefix
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        """Look up an entry.
+
+        :Returns: The cached value, or None if there's no valid entry
+
+        :param key: The entry to look up
+        :type key: String
+        """
+        value = self._redis.get(self._prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ujson.loads(value)
+
+    def set(self, key, value, ttl=None):
+        """Create or replace an entry.
+
+        :Returns: None
+
+        :param key: The name of the entry
+        :type key: String
+
+        :param value: What to store
+        :type value: Object
+
+        :param ttl: Override the default number of seconds the entry is valid for
+        :type ttl: Integer
+        """
+        ttl = self.ttl if ttl is None else ttl
+        self._redis.set(self._prefix + key, ujson.dumps(value), ex=ttl)
+
+    def add(self, key, value, ttl=None):
+        """Create an entry, but only if there is not already a valid one.
+
+        :Returns: Boolean - True if the entry was created
+
+        :param key: The name of the entry
+        :type key: String
+
+        :param value: What to store
+        :type value: Object
+
+        :param ttl: Override the default number of seconds the entry is valid for
+        :type ttl: Integer
+        """
+        ttl = self.ttl if ttl is None else ttl
+        return bool(self._redis.set(self._prefix + key, ujson.dumps(value), ex=ttl, nx=True))
+
+    def delete(self, key):
+        """Remove an entry, if it exists.
+
+        :Returns: None
+
+        :param key: The name of the entry
+        :type key: String
+        """
+        self._redis.delete(self._prefix + key)
+
+    def clear(self):
+        """Reset the hit/miss counters. Entries are left to expire, since other
+        processes share them.
+
+        :Returns: None
+        """
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Report how well the cache is working.
+
+        :Returns: Dictionary
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def get_cache(url=const.VLAB_VLAN_CACHE_URL, max_size=const.VLAB_VLAN_CACHE_SIZE,
+              ttl=const.VLAB_VLAN_CACHE_TTL):
+    """A factory for the configured kind of cache.
+
+    :Returns: MemoryCache or RedisCache
+
+    :param url: Where a shared cache lives. Empty means use an in-process cache.
+    :type url: String
+
+    :param max_size: The most entries an in-process cache will hold
+    :type max_size: Integer
+
+    :param ttl: How many seconds an entry is valid for
+    :type ttl: Integer
+    """
+    if url:
+        return RedisCache(url, ttl=ttl)
+    return MemoryCache(max_size=max_size, ttl=ttl)
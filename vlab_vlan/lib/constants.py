@@ -9,11 +9,49 @@ DEFINED = OrderedDict([
             ('INF_VCENTER_PORT', int(environ.get('INFO_VCENTER_PORT', 443))),
             ('INF_VCENTER_USER', environ.get('INF_VCENTER_USER', 'tester')),
             ('INF_VCENTER_PASSWORD', environ.get('INF_VCENTER_PASSWORD', 'a')),
+            ('INF_VCENTER_SESSION_CHECK_INTERVAL', int(environ.get('INF_VCENTER_SESSION_CHECK_INTERVAL', 600))),
+            ('INF_VCENTER_SWITCH_CACHE_TTL', int(environ.get('INF_VCENTER_SWITCH_CACHE_TTL', 3600))),
+            ('INF_VCENTER_NETWORK_CACHE_TTL', int(environ.get('INF_VCENTER_NETWORK_CACHE_TTL', 3600))),
             ('VLAB_VLAN_LOG_LEVEL', environ.get('VLAB_VLAN_LOG_LEVEL', 'INFO')),
             ('VLAB_MESSAGE_BROKER', environ.get('VLAB_MESSAGE_BROKER', 'vlan-broker')),
+            ('VLAB_VLAN_READ_QUEUE', environ.get('VLAB_VLAN_READ_QUEUE', 'vlan-read')),
+            ('VLAB_VLAN_VCENTER_QUEUE', environ.get('VLAB_VLAN_VCENTER_QUEUE', 'vlan-vcenter')),
             ('INF_DB_HOSTNAME', environ.get('INF_DB_HOSTNAME', 'vlan-db')),
             ('POSTGRES_PASSWORD', environ.get('POSTGRES_PASSWORD', 'testing')),
+            ('INF_DB_POOL_MIN', int(environ.get('INF_DB_POOL_MIN', 1))),
+            ('INF_DB_POOL_MAX', int(environ.get('INF_DB_POOL_MAX', 4))),
+            ('INF_DB_POOL_PING_INTERVAL', int(environ.get('INF_DB_POOL_PING_INTERVAL', 60))),
+            ('INF_DB_POOL_TIMEOUT', int(environ.get('INF_DB_POOL_TIMEOUT', 10))),
+            ('VLAB_VLAN_ID_MIN', int(environ.get('VLAB_VLAN_ID_MIN', 100))),
+            ('VLAB_VLAN_ID_MAX', int(environ.get('VLAB_VLAN_ID_MAX', 4000))),
+            ('VLAB_VLAN_SWITCHES', [x for x in environ.get('VLAB_VLAN_SWITCHES', '').split(',') if x]),
+            ('VLAB_VLAN_WARM_POOL_SIZE', int(environ.get('VLAB_VLAN_WARM_POOL_SIZE', 0))),
+            ('VLAB_VLAN_WARM_POOL_SWITCHES', [x for x in environ.get('VLAB_VLAN_WARM_POOL_SWITCHES', '').split(',') if x]),
+            ('VLAB_VLAN_WARM_POOL_INTERVAL', int(environ.get('VLAB_VLAN_WARM_POOL_INTERVAL', 60))),
+            ('VLAB_VLAN_WARM_POOL_METRICS', environ.get('VLAB_VLAN_WARM_POOL_METRICS', 'true').lower() == 'true'),
+            ('VLAB_VLAN_REAP_BATCH', int(environ.get('VLAB_VLAN_REAP_BATCH', 20))),
+            ('VLAB_VLAN_REAP_RATE', environ.get('VLAB_VLAN_REAP_RATE', '6/m')),
+            ('VLAB_VLAN_REAP_INTERVAL', int(environ.get('VLAB_VLAN_REAP_INTERVAL', 30))),
+            ('VLAB_VLAN_REAP_BACKOFF_MAX', int(environ.get('VLAB_VLAN_REAP_BACKOFF_MAX', 3600))),
+            ('VLAB_VLAN_RECONCILE_INTERVAL', int(environ.get('VLAB_VLAN_RECONCILE_INTERVAL', 300))),
+            ('VLAB_VLAN_RECONCILE_REPAIR', environ.get('VLAB_VLAN_RECONCILE_REPAIR', 'false').lower() == 'true'),
+            ('VLAB_VLAN_RECONCILE_STUCK_AFTER', int(environ.get('VLAB_VLAN_RECONCILE_STUCK_AFTER', 900))),
             ('VLAB_VERIFY_TOKEN', environ.get('VLAB_VERIFY_TOKEN', False)),
+            ('VLAB_VLAN_SYNC_LIST', environ.get('VLAB_VLAN_SYNC_LIST', False)),
+            ('VLAB_VLAN_CACHE_URL', environ.get('VLAB_VLAN_CACHE_URL', '')),
+            ('VLAB_VLAN_CACHE_TTL', int(environ.get('VLAB_VLAN_CACHE_TTL', 30))),
+            ('VLAB_VLAN_CACHE_SIZE', int(environ.get('VLAB_VLAN_CACHE_SIZE', 1024))),
+            ('VLAB_VLAN_IDEMPOTENCY_TTL', int(environ.get('VLAB_VLAN_IDEMPOTENCY_TTL', 60))),
+            ('VLAB_VLAN_EVENTS_MAX_STREAMS', int(environ.get('VLAB_VLAN_EVENTS_MAX_STREAMS', 24))),
+            ('VLAB_VLAN_EVENTS_KEEPALIVE', int(environ.get('VLAB_VLAN_EVENTS_KEEPALIVE', 15))),
+            ('VLAB_VLAN_EVENTS_BACKLOG', int(environ.get('VLAB_VLAN_EVENTS_BACKLOG', 100))),
+            ('VLAB_VLAN_TASK_MAX_WAIT', int(environ.get('VLAB_VLAN_TASK_MAX_WAIT', 30))),
+            ('VLAB_VLAN_CALLBACK_SECRET', environ.get('VLAB_VLAN_CALLBACK_SECRET', '')),
+            ('VLAB_VLAN_CALLBACK_ALLOWED_HOSTS', [x.strip().lower() for x in environ.get('VLAB_VLAN_CALLBACK_ALLOWED_HOSTS', '').split(',') if x.strip()]),
+            ('VLAB_VLAN_CALLBACK_MAX_PENDING', int(environ.get('VLAB_VLAN_CALLBACK_MAX_PENDING', 1000))),
+            ('VLAB_VLAN_CALLBACK_RETRIES', int(environ.get('VLAB_VLAN_CALLBACK_RETRIES', 5))),
+            ('VLAB_VLAN_CALLBACK_TIMEOUT', int(environ.get('VLAB_VLAN_CALLBACK_TIMEOUT', 10))),
+            ('VLAB_VLAN_ADMINS', [x for x in environ.get('VLAB_VLAN_ADMINS', '').split(',') if x]),
           ])
 
 Constants = namedtuple('Constants', list(DEFINED.keys()))
@@ -0,0 +1,39 @@
+# -*- coding: UTF-8 -*-
+"""
+Decides which Celery queue each task is sent to. Tasks that only use the
+database finish in milliseconds, while tasks that change vCenter can block for
+minutes. Keeping them on separate queues lets each have its own pool of workers,
+so listing vLANs is never stuck behind a burst of creates.
+
+Both the API and the workers must use the same routes; call ``configure`` on
+every Celery app.
+"""
+from kombu import Queue
+
+from vlab_vlan.lib import const
+
+# Any task not listed here goes to the vCenter queue. Deleting only marks the
+# records; ``vlan.reap`` destroys the networks later.
+READ_TASKS = ('vlan.show', 'vlan.delete', 'vlan.delete_batch', 'vlan.delete_all')
+
+
+def configure(celery_app, read_queue=const.VLAB_VLAN_READ_QUEUE,
+              vcenter_queue=const.VLAB_VLAN_VCENTER_QUEUE):
+    """Route the tasks of a Celery app to the read and vCenter queues.
+
+    A worker started without ``--queues`` consumes from both.
+
+    :Returns: None
+
+    :param celery_app: The Celery app to configure
+    :type celery_app: celery.Celery
+
+    :param read_queue: The queue for tasks that only use the database
+    :type read_queue: String
+
+    :param vcenter_queue: The queue for tasks that change vCenter
+    :type vcenter_queue: String
+    """
+    celery_app.conf.task_queues = (Queue(read_queue), Queue(vcenter_queue))
+    celery_app.conf.task_default_queue = vcenter_queue
+    celery_app.conf.task_routes = {name: {'queue': read_queue} for name in READ_TASKS}
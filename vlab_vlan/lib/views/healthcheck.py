@@ -6,9 +6,12 @@ from time import time
 import pkg_resources
 
 import ujson
+import psycopg2
 from flask_classy import FlaskView, Response
 from vlab_inf_common.vmware import vCenter
 
+from vlab_vlan.lib import const
+from vlab_vlan.lib.worker import database
 
 
 class HealthView(FlaskView):
@@ -22,6 +25,13 @@ class HealthView(FlaskView):
         """End point for health checks"""
         resp = {}
         resp['version'] = pkg_resources.get_distribution('vlab-vlan').version
+        resp['cache'] = database.vlan_cache.stats()
+        if const.VLAB_VLAN_WARM_POOL_SWITCHES and const.VLAB_VLAN_WARM_POOL_METRICS:
+            try:
+                resp['warm_pool'] = database.get_warm_pool_stats()
+            except psycopg2.Error:
+                # The service is still alive if its database is not
+                resp['warm_pool'] = None
         response = Response(ujson.dumps(resp))
         response.status_code = 200
         response.headers['Content-Type'] = 'application/json'
@@ -2,7 +2,16 @@
 """
 Defines the HTTP API for working with vLANs in vLab
 """
+import time
+import uuid
+import queue
+import hashlib
+import threading
+from urllib.parse import urlparse
+
 import ujson
+import psycopg2
+from celery import states
 from flask import current_app
 from flask_classy import request, route, Response
 from jsonschema import validate, ValidationError
@@ -10,8 +19,20 @@ from vlab_inf_common.views import TaskView
 from vlab_api_common import describe, get_logger, requires, validate_input
 
 from vlab_vlan.lib import const
+from vlab_vlan.lib.cache import get_cache
+from vlab_vlan.lib.worker import database
 
 logger = get_logger(__name__, loglevel=const.VLAB_VLAN_LOG_LEVEL)
+# The task ids of create/delete requests that were recently sent; see ``_single_flight``
+inflight = get_cache(ttl=const.VLAB_VLAN_IDEMPOTENCY_TTL)
+# Event streams, and requests waiting on a task, hold a uWSGI thread while they're open
+_streams = {'open': 0}
+_STREAMS_LOCK = threading.Lock()
+# The Celery result backend is not safe to use from many threads at once; waiting
+# requests do not read it themselves, see ``ResultWatcher``
+_RESULTS_LOCK = threading.Lock()
+# The most seconds a request waiting on a task goes without reading the database
+_RECHECK_INTERVAL = 5
 
 
 class VlanView(TaskView):
@@ -24,56 +45,173 @@ class VlanView(TaskView):
                             "description": "The base name of the new vLAN",
                             "type": "string"
                         },
+                        "vlan-names": {
+                            "description": "The base names of many new vLANs to create at once",
+                            "type": "array",
+                            "items": {
+                                "type": "string"
+                            },
+                            "minItems": 1,
+                            "uniqueItems": True
+                        },
                         "switch-name": {
                             "description": "The switch to configure for the new vLAN",
                             "type": "string"
+                        },
+                        "callback-url": {
+                            "description": "Where to POST the result of the task once it's done",
+                            "type": "string"
                         }
                     },
                     "required":[
-                        "vlan-name",
                         "switch-name"
+                    ],
+                    "oneOf": [
+                        {"required": ["vlan-name"]},
+                        {"required": ["vlan-names"]}
                     ]
                   }
+    GET_ARGS_SCHEMA = { "$schema": "http://json-schema.org/draft-04/schema#",
+                        "type": "object",
+                        "properties": {
+                            "sync": {
+                                "description": "Set to 'true' to get the vLANs in the response, instead of a task-id",
+                                "type": "string"
+                            },
+                            "details": {
+                                "description": "Set to 'true' to include the switch and state of each vLAN, not only its tag",
+                                "type": "string"
+                            }
+                        }
+                      }
     DELETE_SCHEMA = { "$schema": "http://json-schema.org/draft-04/schema#",
                       "type": "object",
                       "properties": {
                           "vlan-name": {
                               "description": "The base name of the vlan to destroy",
                               "type": "string"
+                          },
+                          "vlan-names": {
+                              "description": "The base names of many vlans to destroy at once",
+                              "type": "array",
+                              "items": {
+                                  "type": "string"
+                              },
+                              "minItems": 1,
+                              "uniqueItems": True
+                          },
+                          "callback-url": {
+                              "description": "Where to POST the result of the task once it's done",
+                              "type": "string"
                           }
                       },
-                      "required":[
-                        "vlan-name"
+                      "oneOf": [
+                          {"required": ["vlan-name"]},
+                          {"required": ["vlan-names"]}
                       ]
                     }
+    TASK_ARGS = { "$schema": "http://json-schema.org/draft-04/schema#",
+                  "type": "object",
+                  "properties": {
+                      "task-id": TaskView.TASK_ARGS['properties']['task-id'],
+                      "wait": {
+                          "description": "Wait up to this many seconds for the task to finish before answering",
+                          "type": "string"
+                      }
+                  },
+                  "required": [
+                      "task-id"
+                  ]
+                }
+
+    def after_request(self, name, response):
+        """Send event streams as they are; making them fit the API contract reads
+        the whole body, which would wait until the stream ends"""
+        if response.is_streamed:
+            return response
+        return super(VlanView, self).after_request(name, response)
 
     @requires(verify=False, version=2)
-    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get_args={})
+    @describe(post=POST_SCHEMA, delete=DELETE_SCHEMA, get_args=GET_ARGS_SCHEMA)
     def get(self, *args, **kwargs):
         """Obtain a info about the vlans a user owns"""
         username = kwargs['token']['username']
         resp_data = {'user' : username}
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
-        task = current_app.celery_app.send_task('vlan.show', [username, txn_id])
+        try:
+            # The ETag is the version of the user's records; it changes every
+            # time one of their vLANs is created or deleted.
+            version = database.get_version(username)
+        except psycopg2.Error as doh:
+            logger.error('Unable to look up version of vLANs, skipping ETag: {}'.format(doh))
+            version = None
+        details = request.args.get('details', '').lower() == 'true'
+        # The listing with details is a different body, so it gets a different ETag
+        etag = None if version is None else '{}{}'.format(version, '-d' if details else '')
+        if etag is not None and request.if_none_match.contains(etag):
+            resp = Response()
+            resp.status_code = 304
+            resp.set_etag(etag)
+            return resp
+        if const.VLAB_VLAN_SYNC_LIST or request.args.get('sync', '').lower() == 'true':
+            # Listing is a single SELECT; skip the round trip through Celery
+            try:
+                if details:
+                    vlans = database.get_vlan_details(username, min_version=version)
+                    vlans = {name: {'tag': x['tag'], 'switch': x['switch'], 'state': x['state']} for name, x in vlans.items()}
+                else:
+                    vlans = database.get_vlan(username, min_version=version)
+            except psycopg2.Error as doh:
+                logger.error('Unable to list vLANs from database, falling back to task: {}'.format(doh))
+            else:
+                USER_TAG = '{}_'.format(username)
+                resp_data['content'] = {name.replace(USER_TAG, '', 1): value for name, value in vlans.items()}
+                resp = Response(ujson.dumps(resp_data))
+                resp.status_code = 200
+                if etag is not None:
+                    resp.set_etag(etag)
+                return resp
+        task = current_app.celery_app.send_task('vlan.show', [username, txn_id], kwargs={'min_version': version, 'details': details})
         resp_data['content'] = {'task-id': task.id}
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
+        # No ETag; it would mark this task-id as the listing it stands for
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task.id))
         return resp
 
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
     @validate_input(schema=POST_SCHEMA)
     def post(self, *args, **kwargs):
-        """Create a new vlan"""
+        """Create a new vlan, or many new vlans on the same switch"""
         username = kwargs['token']['username']
-        vlan_name = '{}_{}'.format(username, kwargs['body']['vlan-name'])
         switch_name = kwargs['body']['switch-name']
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
-        resp_data, task_id =  _dispatch_modify(username=username,
-                                               the_task='vlan.create',
-                                               vlan_name=vlan_name,
-                                               switch_name=switch_name,
-                                               txn_id=txn_id)
+        try:
+            callbacks = _callback_kwargs(kwargs['body'])
+        except ValueError as doh:
+            return _error_response(username, doh, 400)
+        if 'vlan-names' in kwargs['body']:
+            vlan_names = ['{}_{}'.format(username, x) for x in kwargs['body']['vlan-names']]
+            resp_data, task_id = _single_flight(username, 'vlan.create_batch', vlan_names,
+                                                lambda task_id: _dispatch_modify(username=username,
+                                                                                 the_task='vlan.create_batch',
+                                                                                 task_id=task_id,
+                                                                                 vlan_names=vlan_names,
+                                                                                 switch_name=switch_name,
+                                                                                 txn_id=txn_id,
+                                                                                 **callbacks),
+                                                callback_url=callbacks.get('callback_url'))
+        else:
+            vlan_name = '{}_{}'.format(username, kwargs['body']['vlan-name'])
+            try:
+                resp_data, task_id = _single_flight(username, 'vlan.create', [vlan_name],
+                                                    lambda task_id: _create_vlan(username, vlan_name, switch_name, txn_id, task_id,
+                                                                                 **callbacks),
+                                                    callback_url=callbacks.get('callback_url'))
+            except ValueError as doh:
+                return _error_response(username, doh, 400)
+            except RuntimeError as doh:
+                return _error_response(username, doh, 503)
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
@@ -82,24 +220,535 @@ class VlanView(TaskView):
     @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
     @validate_input(schema=DELETE_SCHEMA)
     def delete(self, *args, **kwargs):
-        """Delete a lvan"""
+        """Delete a lvan, or many vlans"""
+        username = kwargs['token']['username']
+        txn_id = request.headers.get('X-REQUEST-ID', 'noId')
+        try:
+            callbacks = _callback_kwargs(kwargs['body'])
+        except ValueError as doh:
+            return _error_response(username, doh, 400)
+        if 'vlan-names' in kwargs['body']:
+            vlan_names = ['{}_{}'.format(username, x) for x in kwargs['body']['vlan-names']]
+            resp_data, task_id = _single_flight(username, 'vlan.delete_batch', vlan_names,
+                                                lambda task_id: _dispatch_modify(username=username,
+                                                                                 the_task='vlan.delete_batch',
+                                                                                 task_id=task_id,
+                                                                                 vlan_names=vlan_names,
+                                                                                 txn_id=txn_id,
+                                                                                 **callbacks),
+                                                callback_url=callbacks.get('callback_url'))
+        else:
+            vlan_name = '{}_{}'.format(username, kwargs['body']['vlan-name'])
+            resp_data, task_id = _single_flight(username, 'vlan.delete', [vlan_name],
+                                                lambda task_id: _dispatch_modify(username=username,
+                                                                                 the_task='vlan.delete',
+                                                                                 task_id=task_id,
+                                                                                 vlan_name=vlan_name,
+                                                                                 txn_id=txn_id,
+                                                                                 **callbacks),
+                                                callback_url=callbacks.get('callback_url'))
+        resp = Response(ujson.dumps(resp_data))
+        resp.status_code = 202
+        resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
+        return resp
+
+    @route('/task', methods=["GET"])
+    @route('/task/<tid>', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    @describe(get_args=TASK_ARGS)
+    def handle_task(self, *args, **kwargs):
+        """Check on a task; the status of creating a vLAN comes from the database.
+        Supply ``wait`` to hold the request until the task finishes, for up to
+        ``VLAB_VLAN_TASK_MAX_WAIT`` seconds."""
         username = kwargs['token']['username']
-        vlan_name = '{}_{}'.format(username, kwargs['body']['vlan-name'])
+        task_id = request.args.get('task-id', kwargs.get('tid', None))
+        try:
+            wait = min(max(float(request.args.get('wait', 0)), 0), const.VLAB_VLAN_TASK_MAX_WAIT)
+        except ValueError:
+            return _error_response(username, 'wait must be a number of seconds', 400)
+        deadline = time.time() + wait
+        record = None
+        if not task_id or (request.args.get('task-id', None) and kwargs.get('tid', None)):
+            # TaskView answers HTTP 400 when there's no task id, or one in both the URL and the query
+            wait = 0
+        else:
+            try:
+                record = database.get_vlan_by_task(username, task_id)
+            except psycopg2.Error as doh:
+                logger.error('Unable to look up vLAN of task, falling back to Celery: {}'.format(doh))
+        if wait and not _hold_thread():
+            # Every thread that can be held is; answer right away instead
+            wait = 0
+        if record is None:
+            try:
+                if wait:
+                    result_watcher.wait(current_app.celery_app, task_id, deadline - time.time())
+                with _RESULTS_LOCK:
+                    return TaskView.handle_task(self, *args, **kwargs)
+            finally:
+                if wait:
+                    _release_thread()
+        try:
+            if wait:
+                record = _wait_for_record(username, task_id, record, deadline)
+        finally:
+            if wait:
+                _release_thread()
+        USER_TAG = '{}_'.format(username)
+        params = {'vlan_name': record['vlan_name'].replace(USER_TAG, '', 1), 'switch_name': record['switch']}
+        content = {'tag': record['tag'], 'state': record['state']}
+        if record['state'] == 'ready':
+            resp = {'error': None, 'content': content, 'params': params}
+            return ujson.dumps(resp), 200
+        elif record['state'] == 'failed':
+            resp = {'user': username, 'error': record['error'], 'content': content, 'params': params}
+            return ujson.dumps(resp), 400
+        content['status'] = 'PENDING' if record['state'] == 'reserved' else 'STARTED'
+        resp = {'user': username, 'content': content}
+        return ujson.dumps(resp), 202
+
+    @route('/events', methods=["GET"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def events(self, *args, **kwargs):
+        """Stream the changes to the user's vLANs, as Server-Sent Events"""
+        username = kwargs['token']['username']
+        if not _hold_thread():
+            return _error_response(username, 'Too many event streams are open; try again later', 503)
+        changes = database.change_feed.subscribe(username)
+        resp = Response(_stream_events(username, changes), mimetype='text/event-stream')
+        resp.headers['Cache-Control'] = 'no-cache'
+        # Stop proxies like nginx from holding events back
+        resp.headers['X-Accel-Buffering'] = 'no'
+        resp.call_on_close(lambda: _close_stream(changes))
+        return resp
+
+    @route('/user/<owner>', methods=["DELETE"])
+    @requires(verify=const.VLAB_VERIFY_TOKEN, version=2)
+    def delete_user(self, owner, *args, **kwargs):
+        """Delete every vlan a user owns; only for vLab admins"""
+        username = kwargs['token']['username']
+        if username not in const.VLAB_VLAN_ADMINS:
+            resp_data = {'user': username, 'error': 'Only admins can delete the vLANs of other users'}
+            resp = Response(ujson.dumps(resp_data))
+            resp.status_code = 403
+            return resp
         txn_id = request.headers.get('X-REQUEST-ID', 'noId')
-        resp_data, task_id = _dispatch_modify(username=username,
-                                              the_task='vlan.delete',
-                                              vlan_name=vlan_name,
-                                              txn_id=txn_id)
+        resp_data, task_id = _single_flight(owner, 'vlan.delete_all', [],
+                                            lambda task_id: _dispatch_modify(username=owner,
+                                                                             the_task='vlan.delete_all',
+                                                                             task_id=task_id,
+                                                                             txn_id=txn_id))
         resp = Response(ujson.dumps(resp_data))
         resp.status_code = 202
         resp.headers.add('Link', '<{0}{1}/task/{2}>; rel=status'.format(const.VLAB_URL, self.route_base, task_id))
         return resp
 
 
-def _dispatch_modify(username, the_task, **kwargs):
+def _create_vlan(username, vlan_name, switch_name, txn_id, task_id, callback_url=None):
+    """Make a new vlan, reserving its tag right away if the database is reachable.
+
+    :Returns: Tuple - http body, task id
+
+    :Raises: ValueError if the vlan already exists or the switch is unknown,
+             or RuntimeError if there are no tags left
+
+    :param task_id: The id to give the task that makes the vlan
+    :type task_id: String
+
+    :param callback_url: Where the task sends its result once it's done
+    :type callback_url: String
+    """
+    callbacks = {'callback_url': callback_url} if callback_url else {}
+    try:
+        return _reserve_vlan(username, vlan_name, switch_name, txn_id, task_id=task_id, **callbacks)
+    except psycopg2.Error as doh:
+        logger.error('Unable to reserve vLAN tag, falling back to task: {}'.format(doh))
+        return _dispatch_modify(username=username,
+                                the_task='vlan.create',
+                                task_id=task_id,
+                                vlan_name=vlan_name,
+                                switch_name=switch_name,
+                                txn_id=txn_id,
+                                **callbacks)
+
+
+def _callback_kwargs(body):
+    """Check the ``callback-url`` of a request, if it has one.
+
+    :Returns: Dictionary - the extra arguments for the task, which are none
+              unless the request has a ``callback-url``
+
+    :Raises: ValueError if the callback URL cannot be used
+
+    :param body: The body of the request
+    :type body: Dictionary
+    """
+    callback_url = body.get('callback-url', None)
+    if callback_url is None:
+        return {}
+    if not const.VLAB_VLAN_CALLBACK_SECRET:
+        raise ValueError('Callbacks are not enabled on this server')
+    url = urlparse(callback_url)
+    if url.scheme not in ('http', 'https') or not url.hostname:
+        raise ValueError('callback-url must be an http or https URL, not {}'.format(callback_url))
+    if not _callback_host_allowed(url.hostname):
+        # Otherwise the worker could be made to POST to the database, broker, etc.
+        raise ValueError('callback-url host {} is not allowed'.format(url.hostname))
+    return {'callback_url': callback_url}
+
+
+def _callback_host_allowed(hostname):
+    """Determine if callbacks can be sent to a host. Entries in
+    ``VLAB_VLAN_CALLBACK_ALLOWED_HOSTS`` that start with a dot allow every
+    subdomain, i.e. ``.example.com`` allows ``ci.example.com``.
+
+    :Returns: Boolean
+
+    :param hostname: The host of the callback URL
+    :type hostname: String
+    """
+    hostname = hostname.lower()
+    for allowed in const.VLAB_VLAN_CALLBACK_ALLOWED_HOSTS:
+        if allowed.startswith('.'):
+            if hostname.endswith(allowed):
+                return True
+        elif hostname == allowed:
+            return True
+    return False
+
+
+def _stream_events(username, changes):
+    """Turn the changes to a user's vLANs into Server-Sent Events. A comment is
+    sent every ``VLAB_VLAN_EVENTS_KEEPALIVE`` seconds without a change, so proxies
+    keep the stream open, and so a client that went away is noticed.
+
+    :Returns: Generator - of Strings
+
+    :param username: The owner of the vLANs
+    :type username: String
+
+    :param changes: The changes, from ``database.change_feed.subscribe``
+    :type changes: queue.Queue
+    """
+    USER_TAG = '{}_'.format(username)
+    yield ': connected\n\n'
+    while True:
+        if changes.empty() and not database.change_feed.is_subscribed(changes):
+            # Fell too far behind; the client has to list its vLANs again
+            change = {'event': 'resync'}
+        else:
+            try:
+                change = changes.get(timeout=const.VLAB_VLAN_EVENTS_KEEPALIVE)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+        if change['event'] == 'resync':
+            yield 'event: resync\ndata: {}\n\n'
+            return
+        data = dict(change, vlan_name=change['vlan_name'].replace(USER_TAG, '', 1))
+        yield 'event: {}\ndata: {}\n\n'.format(change['event'], ujson.dumps(data))
+
+
+def _close_stream(changes):
+    """Stop following changes once the client is done with an event stream
+
+    :Returns: None
+
+    :param changes: The changes, from ``database.change_feed.subscribe``
+    :type changes: queue.Queue
+    """
+    database.change_feed.unsubscribe(changes)
+    _release_thread()
+
+
+def _hold_thread():
+    """Count a request that holds its uWSGI thread, like an event stream, unless
+    ``VLAB_VLAN_EVENTS_MAX_STREAMS`` of them are already open. Call
+    ``_release_thread`` once the request is done.
+
+    :Returns: Boolean - True if the request can hold its thread
+    """
+    with _STREAMS_LOCK:
+        if _streams['open'] >= const.VLAB_VLAN_EVENTS_MAX_STREAMS:
+            return False
+        _streams['open'] += 1
+        return True
+
+
+def _release_thread():
+    """Stop counting a request from ``_hold_thread``
+
+    :Returns: None
+    """
+    with _STREAMS_LOCK:
+        _streams['open'] -= 1
+
+
+def _wait_for_record(username, task_id, record, deadline):
+    """Wait for a vLAN to be made, or to fail. Rather than reading the database
+    over and over, this waits on the change feed, and reads the vLAN's record
+    again only when the vLAN changes.
+
+    :Returns: Dictionary - the latest record of the vLAN, from ``database.get_vlan_by_task``
+
+    :param username: The owner of the vLAN
+    :type username: String
+
+    :param task_id: The id of the task making the vLAN
+    :type task_id: String
+
+    :param record: The record of the vLAN
+    :type record: Dictionary
+
+    :param deadline: When to stop waiting, from ``time.time``
+    :type deadline: Float
+    """
+    changes = database.change_feed.subscribe(username)
+    try:
+        # The vLAN might have changed before the subscription started
+        check = True
+        while True:
+            if check:
+                try:
+                    latest = database.get_vlan_by_task(username, task_id)
+                except psycopg2.Error as doh:
+                    logger.error('Unable to look up vLAN of task: {}'.format(doh))
+                    break
+                if latest is None:
+                    # Deleted while being made
+                    break
+                record = latest
+            remaining = deadline - time.time()
+            if record['state'] not in ('reserved', 'provisioning') or remaining <= 0:
+                break
+            try:
+                change = changes.get(timeout=min(remaining, _RECHECK_INTERVAL))
+            except queue.Empty:
+                # Also covers a subscription dropped for falling behind
+                check = True
+            else:
+                # A resync has no vlan_name
+                check = change.get('vlan_name', record['vlan_name']) == record['vlan_name']
+    finally:
+        database.change_feed.unsubscribe(changes)
+    return record
+
+
+class ResultWatcher(object):
+    """Waits on many Celery tasks at once, using a single background thread.
+
+    The result backend can only be read by one thread at a time. Instead of
+    every waiting request polling it, the background thread checks each task
+    that is being waited on once every ``interval`` seconds, and wakes up the
+    requests waiting on the tasks that finished. Requests that only check the
+    status of a task then wait on a few quick reads, not on every waiting request.
+
+    :param interval: The seconds between checks of the same task
+    :type interval: Float
+    """
+    def __init__(self, interval=0.5):
+        self._interval = interval
+        # Maps the task id to [Event set when the task finishes, how many requests are waiting]
+        self._waiting = {}
+        self._celery_app = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def wait(self, celery_app, task_id, timeout):
+        """Block until a Celery task finishes.
+
+        :Returns: Boolean - False if the task did not finish within ``timeout``
+
+        :param celery_app: The Celery app the task was sent with
+        :type celery_app: celery.Celery
+
+        :param task_id: The id of the Celery task
+        :type task_id: String
+
+        :param timeout: The most seconds to wait
+        :type timeout: Float
+        """
+        with self._lock:
+            entry = self._waiting.setdefault(task_id, [threading.Event(), 0])
+            entry[1] += 1
+            self._celery_app = celery_app
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='vlan-result-watcher')
+                self._thread.daemon = True
+                self._thread.start()
+        try:
+            return entry[0].wait(max(timeout, 0))
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1] and self._waiting.get(task_id) is entry:
+                    del self._waiting[task_id]
+
+    def _run(self):
+        """Check on the tasks until none are being waited on.
+
+        :Returns: None
+        """
+        while True:
+            with self._lock:
+                if not self._waiting:
+                    self._thread = None
+                    return
+                task_ids = list(self._waiting.keys())
+                celery_app = self._celery_app
+            for task_id in task_ids:
+                try:
+                    with _RESULTS_LOCK:
+                        status = celery_app.AsyncResult(task_id).status
+                except Exception as doh:
+                    # The requests answer with the task's status once their wait runs out
+                    logger.error('Unable to check on task {}: {}'.format(task_id, doh))
+                    continue
+                if status in states.READY_STATES:
+                    with self._lock:
+                        entry = self._waiting.pop(task_id, None)
+                    if entry is not None:
+                        entry[0].set()
+            time.sleep(self._interval)
+
+
+result_watcher = ResultWatcher()
+
+
+def _reserve_vlan(username, vlan_name, switch_name, txn_id, task_id=None, callback_url=None):
+    """Allocate the tag of a new vlan right away, then send the task to Celery
+    that makes its portgroup in vCenter.
+
+    :Returns: Tuple - http body, task id
+
+    :Raises: ValueError if the vlan already exists or the switch is unknown,
+             RuntimeError if there are no tags left, or psycopg2.Error if the
+             database is unreachable
+
+    :param username: The name of the caller performing the action
+    :type username: String
+
+    :param vlan_name: The full name of the new vlan
+    :type vlan_name: String
+
+    :param switch_name: The switch to configure for the new vlan
+    :type switch_name: String
+
+    :param txn_id: A client-supplied transaction id - makes debugging easier
+    :type txn_id: String
+
+    :param task_id: The id to give the task that makes the portgroup. A new one is made if not supplied.
+    :type task_id: String
+
+    :param callback_url: Where the task sends its result once it's done
+    :type callback_url: String
+    """
+    task_id = task_id or str(uuid.uuid4())
+    tag = None
+    if switch_name in database.get_warm_pool_targets():
+        claimed = database.claim_warm_portgroup(username, vlan_name, switch_name, state='reserved', task_id=task_id)
+        if claimed:
+            tag = claimed[0]
+    if tag is None:
+        tag = database.register_vlan(username, vlan_name, logger, switch_name, state='reserved', task_id=task_id)
+    database.invalidate_vlan_cache(username)
+    try:
+        task_kwargs = {'vlan_name': vlan_name, 'switch_name': switch_name, 'txn_id': txn_id}
+        if callback_url:
+            task_kwargs['callback_url'] = callback_url
+        current_app.celery_app.send_task('vlan.provision', args=[username], kwargs=task_kwargs, task_id=task_id)
+    except Exception as doh:
+        logger.error('Unable to send task to make vLAN {}: {}'.format(vlan_name, doh))
+        database.fail_vlan(username, vlan_name, 'Unable to start making the vLAN')
+        raise RuntimeError('Unable to start making vLAN {}; try again later'.format(vlan_name))
+    resp = {'user': username, 'content': {'task-id': task_id, 'tag': tag, 'state': 'reserved'}}
+    return resp, task_id
+
+
+def _error_response(username, error, status_code):
+    """Build the response for a request that cannot be done
+
+    :Returns: flask.Response
+
+    :param username: The name of the caller performing the action
+    :type username: String
+
+    :param error: Why the request cannot be done
+    :type error: Exception
+
+    :param status_code: The HTTP status code of the response
+    :type status_code: Integer
+    """
+    resp = Response(ujson.dumps({'user': username, 'error': '{}'.format(error)}))
+    resp.status_code = status_code
+    return resp
+
+
+def _single_flight(username, the_task, vlan_names, dispatch, callback_url=None):
+    """Send a task that makes or destroys vlans, unless the same request was
+    sent moments ago. Clients retry requests that time out, so without this the
+    same vLAN would be made (or destroyed) by several tasks at once.
+
+    Requests are the same if they are for the same user, task, vlan names,
+    ``callback-url`` and ``Idempotency-Key`` header. A repeated request gets the task id of the first
+    one, for ``VLAB_VLAN_IDEMPOTENCY_TTL`` seconds, or until a request of the
+    opposite kind (delete vs create) is sent for the same user.
+
+    :Returns: Tuple - http body, task id
+
+    :param username: The owner of the vlans
+    :type username: String
+
+    :param the_task: The name of the task to dispatch
+    :type the_task: String
+
+    :param vlan_names: The full names of the vlans the request is for
+    :type vlan_names: List
+
+    :param dispatch: Sends the task with the task id it's given, and returns the http body and task id
+    :type dispatch: Function
+
+    :param callback_url: Where the task sends its result, if the request has a ``callback-url``
+    :type callback_url: String
+    """
+    kind, opposite = ('create', 'delete') if the_task.startswith('vlan.create') else ('delete', 'create')
+    task_id = str(uuid.uuid4())
+    try:
+        generation = inflight.get('generation:{}:{}'.format(username, kind)) or ''
+        # A repeat with a different callback-url would never be told the result
+        key_parts = [username, the_task, sorted(vlan_names), generation, callback_url or '',
+                     request.headers.get('Idempotency-Key', '')]
+        key = 'inflight:{}'.format(hashlib.sha1(ujson.dumps(key_parts).encode()).hexdigest())
+        sent = inflight.get(key) if not inflight.add(key, {'task-id': task_id}) else None
+    except Exception as doh:
+        logger.error('Unable to check for a duplicate request, sending task: {}'.format(doh))
+        return dispatch(task_id)
+    if sent is not None:
+        logger.info('Request already sent as task {}'.format(sent['task-id']))
+        return {'user': username, 'content': sent}, sent['task-id']
+    try:
+        resp_data, task_id = dispatch(task_id)
+    except Exception:
+        try:
+            inflight.delete(key)
+        except Exception as doh:
+            # The request can be sent again once VLAB_VLAN_IDEMPOTENCY_TTL is up
+            logger.error('Unable to forget request that was not sent: {}'.format(doh))
+        raise
+    try:
+        inflight.set(key, resp_data['content'])
+        # Repeating a create after a delete (or the reverse) is a new request
+        inflight.set('generation:{}:{}'.format(username, opposite), task_id)
+    except Exception as doh:
+        # The task was sent; failing the request now would only get it sent again
+        logger.error('Unable to record task {} as sent: {}'.format(task_id, doh))
+    return resp_data, task_id
+
+
+def _dispatch_modify(username, the_task, task_id=None, **kwargs):
     """Send the task to Celery that makes or destroys a vlan
 
-    :Returns: Tuple - http body, http status
+    :Returns: Tuple - http body, task id
 
     :param username: The name of the caller performing the action
     :type username: String
@@ -107,11 +756,15 @@ def _dispatch_modify(username, the_task, **kwargs):
     :param the_task: The name of the task to dispatch
     :type the_task: String
 
+    :param task_id: The id to give the task. Celery makes one if not supplied.
+    :type task_id: String
+
     :param kwargs: The arguments to send to the back-end task, by key-word.
     :type kwargs:
     """
-    assert the_task in ('vlan.create', 'vlan.delete')
+    assert the_task in ('vlan.create', 'vlan.create_batch', 'vlan.delete',
+                        'vlan.delete_batch', 'vlan.delete_all')
     resp = {'user': username}
-    task = current_app.celery_app.send_task(the_task, args=[username], kwargs=kwargs)
+    task = current_app.celery_app.send_task(the_task, args=[username], kwargs=kwargs, task_id=task_id)
     resp['content'] = {'task-id': task.id}
     return resp, task.id
@@ -0,0 +1,196 @@
+# -*- coding: UTF-8 -*-
+"""
+Sends the results of tasks to the callback URLs that clients supplied
+"""
+import hmac
+import time
+import heapq
+import queue
+import hashlib
+import threading
+import urllib.error
+import urllib.request
+
+import ujson
+
+from vlab_vlan.lib import const
+
+# Responses that mean the receiver might take the callback if it's sent again
+_RETRY_CODES = (408, 429)
+
+
+class _NoRedirects(urllib.request.HTTPRedirectHandler):
+    """The API only checked the host of the callback URL, not where it redirects to"""
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        """Fail instead of following the redirect"""
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirects)
+
+
+class CallbackSender(object):
+    """Delivers callbacks with a single background thread, so a slow or
+    unreachable receiver never holds up a task.
+
+    Each callback is a JSON ``POST``, signed with an HMAC-SHA256 of the body in
+    the ``X-Vlab-Signature`` header. A callback that cannot be delivered is sent
+    again after a delay that doubles each time, up to ``retries`` more times.
+    At most ``max_pending`` callbacks are held at once; more than that are
+    dropped, instead of letting a receiver that is down use up the worker's memory.
+
+    :param secret: The key used to sign every callback
+    :type secret: String
+
+    :param max_pending: The most callbacks waiting to be delivered at once
+    :type max_pending: Integer
+
+    :param retries: How many more times to send a callback that was not delivered
+    :type retries: Integer
+
+    :param timeout: The most seconds to wait on the receiver for each attempt
+    :type timeout: Integer
+
+    :param backoff: The seconds to wait before sending a callback the first time it fails
+    :type backoff: Float
+
+    :param backoff_max: The most seconds to wait before sending a callback again
+    :type backoff_max: Float
+    """
+    def __init__(self, secret, max_pending=1000, retries=5, timeout=10, backoff=1, backoff_max=60):
+        self._secret = secret.encode()
+        self._max_pending = max_pending
+        self._retries = retries
+        self._timeout = timeout
+        self._backoff = backoff
+        self._backoff_max = backoff_max
+        self._queue = queue.Queue()
+        # The callbacks waiting to be sent again, as (when, sequence, url, body, attempt)
+        self._retrying = []
+        self._sequence = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def send(self, url, payload):
+        """Queue a callback to be delivered.
+
+        :Returns: Boolean - False if the callback was dropped, because too many are waiting
+
+        :param url: Where to ``POST`` the callback
+        :type url: String
+
+        :param payload: The body of the callback
+        :type payload: Dictionary
+        """
+        body = ujson.dumps(payload).encode()
+        with self._lock:
+            if self._pending >= self._max_pending:
+                return False
+            self._pending += 1
+            self._closed = False
+            self._queue.put((url, body, 0))
+            # A forked worker process inherits a thread object, but not the thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='vlan-callback-sender')
+                self._thread.daemon = True
+                self._thread.start()
+        return True
+
+    def close(self, timeout=5):
+        """Stop delivering callbacks, after giving the ones already queued up to
+        ``timeout`` seconds to be sent.
+
+        :Returns: Integer - how many callbacks were never delivered
+
+        :param timeout: The most seconds to wait for queued callbacks
+        :type timeout: Float
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._lock:
+                if not self._pending:
+                    break
+            time.sleep(0.05)
+        with self._lock:
+            self._closed = True
+            thread, self._thread = self._thread, None
+            dropped, self._pending = self._pending, 0
+            self._retrying = []
+            self._queue = queue.Queue()
+        if thread is not None:
+            thread.join(max(deadline - time.time(), 0.1))
+        return dropped
+
+    def sign(self, body):
+        """Compute the signature a receiver can use to check that a callback came from vLab
+
+        :Returns: String
+
+        :param body: The body of the callback
+        :type body: Bytes
+        """
+        return 'sha256={}'.format(hmac.new(self._secret, body, hashlib.sha256).hexdigest())
+
+    def _run(self):
+        """Deliver callbacks until there are none left, or ``close`` is called.
+
+        :Returns: None
+        """
+        while True:
+            with self._lock:
+                if self._closed or (not self._retrying and self._queue.empty()):
+                    if self._thread is threading.current_thread():
+                        self._thread = None
+                    return
+                job, wait, waiting = None, None, self._queue
+                if self._retrying and self._retrying[0][0] <= time.time():
+                    job = heapq.heappop(self._retrying)[2:]
+                elif self._retrying:
+                    wait = self._retrying[0][0] - time.time()
+            if job is None:
+                try:
+                    job = waiting.get(timeout=wait)
+                except queue.Empty:
+                    # A callback is due to be sent again
+                    continue
+            self._deliver(*job)
+
+    def _deliver(self, url, body, attempt):
+        """Make one attempt to send a callback, and schedule the next attempt if it fails.
+
+        :Returns: None
+
+        :param url: Where to ``POST`` the callback
+        :type url: String
+
+        :param body: The body of the callback
+        :type body: Bytes
+
+        :param attempt: How many times the callback was already sent
+        :type attempt: Integer
+        """
+        headers = {'Content-Type': 'application/json', 'X-Vlab-Signature': self.sign(body)}
+        req = urllib.request.Request(url, data=body, headers=headers, method='POST')
+        try:
+            with _opener.open(req, timeout=self._timeout):
+                retry = False
+        except urllib.error.HTTPError as doh:
+            retry = doh.code >= 500 or doh.code in _RETRY_CODES
+        except Exception:
+            # Unreachable, timed out, or a bad URL
+            retry = True
+        with self._lock:
+            if retry and attempt < self._retries and not self._closed:
+                delay = min(self._backoff * 2 ** attempt, self._backoff_max)
+                self._sequence += 1
+                heapq.heappush(self._retrying, (time.time() + delay, self._sequence, url, body, attempt + 1))
+            else:
+                self._pending = max(self._pending - 1, 0)
+
+
+callback_sender = CallbackSender(secret=const.VLAB_VLAN_CALLBACK_SECRET,
+                                 max_pending=const.VLAB_VLAN_CALLBACK_MAX_PENDING,
+                                 retries=const.VLAB_VLAN_CALLBACK_RETRIES,
+                                 timeout=const.VLAB_VLAN_CALLBACK_TIMEOUT)
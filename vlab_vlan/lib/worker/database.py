@@ -2,87 +2,484 @@
 """
 This module contains all the logic for interacting with the vLAN database
 """
-import random
+import time
+import queue
+import select
+import threading
 
+import ujson
 import psycopg2
+from psycopg2 import pool
 
 from vlab_vlan.lib import const
+from vlab_vlan.lib.cache import get_cache
+from vlab_vlan.lib.worker.migrations import MIGRATIONS
+
+# Each worker process gets its own pool; connections cannot be shared across a fork
+_POOL = None
+_POOL_LOCK = threading.Lock()
+# Maps id(connection) -> when the connection was last handed back to the pool
+_LAST_USED = {}
+# One slot per connection the pool may open; callers wait on it instead of
+# getting a PoolError when every connection is checked out
+_SLOTS = None
+# Maps id(connection) -> the slots it was checked out against
+_CHECKED_OUT = {}
+# The vLANs each user owns; read by every listing and ownership check
+vlan_cache = get_cache()
+
+
+def init_pool(minconn=const.INF_DB_POOL_MIN, maxconn=const.INF_DB_POOL_MAX):
+    """Create the pool of database connections for this process. Any existing
+    pool is closed first.
+
+    Call this after a worker process forks; a connection must never be shared
+    between processes.
+
+    :Returns: None
+
+    :param minconn: The number of idle connections to keep open
+    :type minconn: Integer
+
+    :param maxconn: The most connections the process may have open at once
+    :type maxconn: Integer
+    """
+    with _POOL_LOCK:
+        _make_pool(minconn, maxconn)
+
+
+def _make_pool(minconn, maxconn):
+    """Replace the process's connection pool. The caller must hold ``_POOL_LOCK``.
+
+    :Returns: None
+    """
+    global _POOL, _SLOTS
+    if _POOL is not None:
+        _POOL.closeall()
+    _LAST_USED.clear()
+    _POOL = pool.ThreadedConnectionPool(minconn, maxconn, database='vlans',
+                                        host=const.INF_DB_HOSTNAME, user='postgres',
+                                        password=const.POSTGRES_PASSWORD)
+    _SLOTS = threading.BoundedSemaphore(maxconn)
+
+
+def close_pool():
+    """Close every connection in this process's pool.
+
+    :Returns: None
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None:
+            _POOL.closeall()
+            _POOL = None
+        _LAST_USED.clear()
+
+
+# An arbitrary key for the advisory lock held while migrating the schema
+_MIGRATION_LOCK = 7263001
+
+
+def migrate(migrations=MIGRATIONS):
+    """Apply the changes to the schema that the database does not have yet, in
+    order of their version. Each one is applied and recorded in the
+    ``schema_migrations`` table in a single transaction. Processes that run this
+    at the same time take turns, so each change is applied once.
+
+    Uses its own connection, so it's safe to call before a worker process forks.
+
+    :Returns: List - the versions that were applied
+
+    :Raises: RuntimeError if the database does not have the ``records`` table that ``setup-db.sh`` makes
+
+    :param migrations: The (version, description, SQL) of every change to the schema
+    :type migrations: List
+    """
+    table_sql = """CREATE TABLE IF NOT EXISTS schema_migrations( \
+                     version INT PRIMARY KEY NOT NULL, \
+                     description TEXT NOT NULL, \
+                     applied_at TIMESTAMPTZ NOT NULL DEFAULT now() \
+                   );"""
+    applied_sql = """SELECT version FROM schema_migrations;"""
+    record_sql = """INSERT INTO schema_migrations(version, description) VALUES (%s, %s);"""
+    conn = psycopg2.connect(database='vlans', host=const.INF_DB_HOSTNAME, user='postgres',
+                            password=const.POSTGRES_PASSWORD)
+    applied = []
+    try:
+        cur = conn.cursor()
+        # Held until the connection closes
+        cur.execute("""SELECT pg_advisory_lock(%s);""", (_MIGRATION_LOCK,))
+        cur.execute("""SELECT to_regclass('records');""")
+        if cur.fetchone()[0] is None:
+            raise RuntimeError('Database has no records table; run setup-db.sh before migrating it')
+        cur.execute(table_sql)
+        cur.execute(applied_sql)
+        done = set([x[0] for x in cur.fetchall()])
+        conn.commit()
+        for version, description, sql in sorted(migrations):
+            if version in done:
+                continue
+            cur.execute(sql)
+            cur.execute(record_sql, (version, description))
+            conn.commit()
+            applied.append(version)
+    finally:
+        conn.close()
+    return applied
+
+
+def _get_pool():
+    """Obtain this process's connection pool, creating it if needed.
+
+    :Returns: psycopg2.pool.ThreadedConnectionPool
+    """
+    if _POOL is None:
+        with _POOL_LOCK:
+            # Another thread may have made the pool while we waited on the lock
+            if _POOL is None:
+                _make_pool(const.INF_DB_POOL_MIN, const.INF_DB_POOL_MAX)
+    return _POOL
+
+
+def _is_healthy(conn):
+    """Determine if a pooled connection is still usable. Connections that have
+    sat idle longer than ``INF_DB_POOL_PING_INTERVAL`` are pinged first.
+
+    :Returns: Boolean
+
+    :param conn: The connection to check
+    :type conn: psycopg2.extensions.connection
+    """
+    if conn.closed:
+        return False
+    last_used = _LAST_USED.get(id(conn), None)
+    if last_used is None or (time.time() - last_used) < const.INF_DB_POOL_PING_INTERVAL:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT 1;')
+        conn.rollback()
+    except psycopg2.Error:
+        return False
+    return True
 
 
 def get_db_connection():
     """A connection factory to centralize database connection parameters.
 
+    The connection is checked out of a per-process pool, so it *MUST* be handed
+    back via ``release_db_connection`` once the caller is done with it. Dead
+    connections are discarded and replaced with a fresh one.
+
+    When every connection is checked out, this waits up to ``INF_DB_POOL_TIMEOUT``
+    seconds for one to be handed back.
+
     :Returns: Tuple - (conn, cur)
+
+    :Raises: psycopg2.OperationalError - If no healthy connection can be made,
+             or none is handed back in time
     """
-    conn = psycopg2.connect(database='vlans', host=const.INF_DB_HOSTNAME,
-               user='postgres', password=const.POSTGRES_PASSWORD)
-    cur = conn.cursor()
-    return conn, cur
+    the_pool = _get_pool()
+    slots = _SLOTS
+    if not slots.acquire(timeout=const.INF_DB_POOL_TIMEOUT):
+        raise psycopg2.OperationalError('Timed out waiting for a database connection')
+    try:
+        # One attempt per slot, so a pool full of dead connections gets flushed
+        for _ in range(the_pool.maxconn + 1):
+            conn = the_pool.getconn()
+            if _is_healthy(conn):
+                cur = conn.cursor()
+                _CHECKED_OUT[id(conn)] = slots
+                return conn, cur
+            _LAST_USED.pop(id(conn), None)
+            the_pool.putconn(conn, close=True)
+    except Exception:
+        slots.release()
+        raise
+    slots.release()
+    raise psycopg2.OperationalError('Unable to obtain a healthy database connection')
+
+
+def release_db_connection(conn):
+    """Hand a connection obtained from ``get_db_connection`` back to the pool.
+    Uncommitted work is rolled back, and broken connections are discarded.
 
+    :Returns: None
 
-def register_vlan(username, vlan_name, logger):
+    :param conn: The connection to return to the pool
+    :type conn: psycopg2.extensions.connection
+    """
+    _LAST_USED[id(conn)] = time.time()
+    try:
+        _get_pool().putconn(conn, close=bool(conn.closed))
+    except pool.PoolError:
+        # The pool was closed or replaced while the connection was checked out
+        conn.close()
+    if conn.closed:
+        # Broken, or more connections than the pool keeps idle
+        _LAST_USED.pop(id(conn), None)
+    slots = _CHECKED_OUT.pop(id(conn), None)
+    if slots is not None:
+        slots.release()
+
+
+def register_vlan(username, vlan_name, logger, switch_name, state='provisioning', task_id=None):
     """Create a new record for tracking which vLAN owns which tag id.
 
-    Every vLAN requires a unique vLAN tag in order to maintain network isolation.
-    This function guarantees the returned vLAN tag id to be unique, regardless
-    of how many callers there are at any time.
+    Every vLAN requires a vLAN tag that's unique on its switch in order to maintain
+    network isolation. This function guarantees the returned vLAN tag id to be
+    unique on the switch, regardless of how many callers there are at any time.
+
+    Tags are claimed from the switch's pool in the ``free_tags`` table in the same
+    statement that creates the record. The ``SKIP LOCKED`` clause lets concurrent
+    callers each claim a different tag without waiting on (or retrying against)
+    one another. The first vLAN on a switch in ``VLAB_VLAN_SWITCHES`` creates the
+    switch's pool.
 
     :Returns: Integer
 
-    :Raises: RuntimeError - If no vLANs tags are available
+    :Raises: RuntimeError - If no vLANs tags are available on the switch
 
-    :Raises: ValueError - If vLAN name is already taken
+    :Raises: ValueError - If vLAN name is already taken, or the switch is unknown
 
     :param username: The vLab user who wants to create a new vLAN
     :type username: String
 
     :param vlan_name: The name of the new vLAN being created
     :type vlan_name: String
+
+    :param switch_name: The name of the switch the vLAN is being created on
+    :type switch_name: String
+
+    :param state: Where the new vLAN is in being made; ``reserved`` or ``provisioning``
+    :type state: String
+
+    :param task_id: The id of the task that will make the vLAN's portgroup
+    :type task_id: String
     """
-    tags_sql = """SELECT all_tags as available_tags FROM \
-                  generate_series((SELECT MIN(tag) FROM records), (SELECT MAX(tag) FROM records)) all_tags \
-                  EXCEPT \
-                  SELECT tag from records;"""
     # Remeber to escape the input to avoid SQL injection
-    add_sql = """INSERT INTO records(tag, person, vlan_name) VALUES (%(tag)s, %(person)s, %(vlan_name)s);"""
-    lvan_name_exists_sql = """SELECT person, vlan_name, tag FROM records WHERE vlan_name LIKE %s;"""
-    add_dict = {'tag': None, 'person': username, 'vlan_name': vlan_name}
+    add_sql = _CLAIM_TAG_SQL
+    lvan_name_exists_sql = """SELECT person, vlan_name, tag FROM records WHERE vlan_name = %s AND state <> 'deleting';"""
+    add_dict = {'person': username, 'vlan_name': vlan_name, 'switch_name': switch_name,
+                'state': state, 'task_id': task_id}
 
     conn, cur = get_db_connection()
-    cur.execute(tags_sql)
-
-    available_tags = set([x[0] for x in cur.fetchall()]) # x[0] b/c result is tuple of 1 element
-    record_created = False
-    while available_tags:
+    try:
         try:
-            # Avoid contention if many users try to create a vlan at the same time
-            vlan_tag = random.sample(available_tags, k=1)[0] # k is the number of items to return
-            add_dict['tag'] = vlan_tag
-            cur.execute(add_sql, add_dict)
+            row = _claim_tag(cur, add_sql, add_dict)
         except psycopg2.IntegrityError as doh:
+            # Rolling back also returns the claimed tag to the free_tags table
+            conn.rollback()
             if doh.pgcode != '23505': # 23505 means unique_violation; vlan already registered
-                conn.close()
                 raise
-            conn.rollback()
             cur.execute(lvan_name_exists_sql, (vlan_name,))
             if cur.rowcount > 0:
                 msg = 'vLAN {} already exits'.format(vlan_name)
                 logger.error(msg + ': DB results: {}'.format(str(cur.fetchall())))
-                conn.close()
                 raise ValueError(msg)
-            available_tags.remove(vlan_tag) # so we don't try the same tag twice
-            continue
+            raise
+        if row is None:
+            msg = 'Unable to register vLan; no more tags available on switch {}'.format(switch_name)
+            raise RuntimeError(msg)
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    vlan_tag = row[0]
+    return vlan_tag
+
+
+def register_vlans(username, vlan_names, logger, switch_name, state='provisioning'):
+    """Create records for many vLANs at once, all within a single transaction.
+
+    Each vLAN is registered under its own savepoint, so one vLAN with a name
+    that's already taken (or running out of tags) does not prevent the others
+    from being registered.
+
+    :Returns: Tuple - (Dictionary of vLAN name -> tag id, Dictionary of vLAN name -> error message)
+
+    :param username: The vLab user who wants to create the new vLANs
+    :type username: String
+
+    :param vlan_names: The names of the new vLANs being created
+    :type vlan_names: List
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+
+    :param switch_name: The name of the switch the vLANs are being created on
+    :type switch_name: String
+
+    :param state: Where the new vLANs are in being made
+    :type state: String
+    """
+    # Setting the savepoint in the same call as the insert saves a round trip per vLAN
+    add_sql = """SAVEPOINT register_vlans; """ + _CLAIM_TAG_SQL
+    rollback_sql = """ROLLBACK TO SAVEPOINT register_vlans;"""
+    tags = {}
+    errors = {}
+    conn, cur = get_db_connection()
+    try:
+        for vlan_name in vlan_names:
+            try:
+                row = _claim_tag(cur, add_sql, {'person': username, 'vlan_name': vlan_name, 'switch_name': switch_name,
+                                                'state': state, 'task_id': None})
+            except psycopg2.IntegrityError as doh:
+                cur.execute(rollback_sql)
+                if doh.pgcode != '23505': # 23505 means unique_violation; vlan already registered
+                    raise
+                errors[vlan_name] = 'vLAN {} already exits'.format(vlan_name)
+                logger.error(errors[vlan_name])
+                continue
+            except ValueError as doh:
+                # The switch is unknown; nothing was written, so there's nothing to roll back
+                errors[vlan_name] = '{}'.format(doh)
+                logger.error(errors[vlan_name])
+                continue
+            if row is None:
+                errors[vlan_name] = 'Unable to register vLan; no more tags available on switch {}'.format(switch_name)
+            else:
+                tags[vlan_name] = row[0]
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    return tags, errors
+
+
+# Lists the vLANs a user owns. Order of the columns matters. Reads only the
+# user's rows of the person_vlans index, so the cost does not grow with the
+# number of records.
+_LIST_SQL = """SELECT vlan_name, tag, switch_name, portgroup_moid, state FROM records \
+               WHERE person = %s AND state <> 'deleting';"""
+
+# Claims a tag from the switch's pool, and records it in the same statement.
+# Only the switch's rows of the free_tags primary key are read, so the cost
+# does not grow with the number of switches.
+_CLAIM_TAG_SQL = """WITH claimed AS ( \
+                      DELETE FROM free_tags \
+                      WHERE switch_name = %(switch_name)s AND tag = ( \
+                        SELECT tag FROM free_tags WHERE switch_name = %(switch_name)s \
+                        LIMIT 1 FOR UPDATE SKIP LOCKED) \
+                      RETURNING tag \
+                    ) \
+                    INSERT INTO records(tag, person, vlan_name, switch_name, state, task_id) \
+                    SELECT tag, %(person)s, %(vlan_name)s, %(switch_name)s, %(state)s, %(task_id)s FROM claimed \
+                    RETURNING tag;"""
+
+
+def _claim_tag(cur, claim_sql, params):
+    """Run the SQL that claims a tag, creating the pool of tags for the switch
+    if this is the first vLAN on it.
+
+    :Returns: Tuple, or None if the switch has no free tags
+
+    :Raises: ValueError - If the switch is unknown
+
+    :param cur: The cursor to run the SQL with
+    :type cur: psycopg2.extensions.cursor
+
+    :param claim_sql: The SQL that claims a tag and makes the record
+    :type claim_sql: String
+
+    :param params: The values for the claim SQL; must include ``switch_name``
+    :type params: Dictionary
+    """
+    cur.execute(claim_sql, params)
+    row = cur.fetchone()
+    if row is None and _add_pool(cur, params['switch_name']):
+        # Claim again even if another transaction made the pool. Its insert makes
+        # ours wait until it commits, and the next statement sees its free tags.
+        cur.execute(claim_sql, params)
+        row = cur.fetchone()
+    return row
+
+
+def _add_pool(cur, switch_name):
+    """Create the pool of tags of a switch in ``VLAB_VLAN_SWITCHES``, unless it
+    already has one. A switch that is not listed must already have a pool, so
+    a typo in a request cannot fill ``free_tags`` with a pool nobody uses.
+
+    :Returns: Boolean - True if the pool of a listed switch was added, or another transaction added it
+
+    :Raises: ValueError - If the switch is not listed, and has no pool of tags
+
+    :param cur: The cursor to run the SQL with
+    :type cur: psycopg2.extensions.cursor
+
+    :param switch_name: The switch that needs a pool of tags
+    :type switch_name: String
+    """
+    # A trigger on tag_pools fills free_tags with the new pool's tags
+    add_pool_sql = """INSERT INTO tag_pools(switch_name, tag_min, tag_max) VALUES (%s, %s, %s) \
+                      ON CONFLICT (switch_name) DO NOTHING;"""
+    pool_exists_sql = """SELECT 1 FROM tag_pools WHERE switch_name = %s;"""
+    pools = get_switch_pools()
+    if switch_name in pools:
+        tag_min, tag_max = pools[switch_name]
+        cur.execute(add_pool_sql, (switch_name, tag_min, tag_max))
+        return True
+    cur.execute(pool_exists_sql, (switch_name,))
+    if cur.fetchone() is None:
+        raise ValueError('No such switch: {}'.format(switch_name))
+    return False
+
+
+def get_switch_pools(switches=const.VLAB_VLAN_SWITCHES, tag_min=const.VLAB_VLAN_ID_MIN, tag_max=const.VLAB_VLAN_ID_MAX):
+    """Parse the switches that vLANs can be made on, like ``switchA,switchB:2-4094``.
+    Switches without a range use the default range.
+
+    :Returns: Dictionary - maps the switch name to its (smallest tag, largest tag)
+
+    :param switches: The switch names, each with an optional range of tags
+    :type switches: List
+
+    :param tag_min: The smallest tag of a switch without a range
+    :type tag_min: Integer
+
+    :param tag_max: The largest tag of a switch without a range
+    :type tag_max: Integer
+    """
+    pools = {}
+    for entry in switches:
+        name, _, tags = entry.partition(':')
+        if tags:
+            low, _, high = tags.partition('-')
+            pools[name] = (int(low), int(high))
         else:
-            conn.commit()
-            conn.close()
-            record_created = True
-            break
+            pools[name] = (tag_min, tag_max)
+    return pools
+
+
+def delete_vlans(vlan_names, username):
+    """Remove many vLANs owned by a user from the database records, using a
+    single statement. Names the user does not own are ignored.
 
-    if record_created:
-        return vlan_tag
-    else:
-        msg = 'Unable to register vLan; no more tags available'
-        raise RuntimeError(msg)
+    :Returns: Dictionary - maps the name of every deleted vLAN to its old tag id
+
+    :param vlan_names: The names of the vLANs to delete
+    :type vlan_names: List
+
+    :param username: The vLab user who owns the vLANs
+    :type username: String
+    """
+    # The deleted records' tags go back into their switch's pool of free tags
+    nuke_sql = """WITH gone AS ( \
+                    DELETE FROM records WHERE person = %s AND vlan_name = ANY(%s) AND state <> 'deleting' \
+                    RETURNING vlan_name, tag, switch_name \
+                  ), freed AS ( \
+                    INSERT INTO free_tags(switch_name, tag) \
+                    SELECT gone.switch_name, gone.tag FROM gone JOIN tag_pools ON tag_pools.switch_name = gone.switch_name \
+                    WHERE gone.tag BETWEEN tag_pools.tag_min AND tag_pools.tag_max \
+                  ) \
+                  SELECT vlan_name, tag FROM gone;"""
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(nuke_sql, (username, list(vlan_names)))
+        # x[0] should be the vlan name, x[1] should be the tag id
+        result = {x[0]:x[1] for x in cur.fetchall()}
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    return result
 
 
 def delete_vlan(vlan_name, username):
@@ -98,7 +495,16 @@ def delete_vlan(vlan_name, username):
     :param username: The vLab user who wants to delete a new vLAN
     :type username: String
     """
-    nuke_sql = """DELETE FROM records WHERE vlan_name LIKE %s and person LIKE %s;"""
+    # The deleted record's tag goes back into its switch's pool of free tags
+    nuke_sql = """WITH gone AS ( \
+                    DELETE FROM records WHERE vlan_name = %s AND person = %s AND state <> 'deleting' \
+                    RETURNING tag, switch_name \
+                  ), freed AS ( \
+                    INSERT INTO free_tags(switch_name, tag) \
+                    SELECT gone.switch_name, gone.tag FROM gone JOIN tag_pools ON tag_pools.switch_name = gone.switch_name \
+                    WHERE gone.tag BETWEEN tag_pools.tag_min AND tag_pools.tag_max \
+                  ) \
+                  SELECT tag FROM gone;"""
     conn, cur = get_db_connection()
     try:
         cur.execute(nuke_sql, (vlan_name, username))
@@ -111,25 +517,800 @@ def delete_vlan(vlan_name, username):
             msg = 'Expected 1 or zero records, found {}. Owner {}, vLAN name: {}'.format(cur.rowcount, username, vlan_name)
             raise RuntimeError(msg)
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+
+def mark_deleting(username, vlan_names=None):
+    """Mark vLANs to be destroyed by ``claim_deleting``. Marked vLANs are left
+    out of listings, and their names can be used again right away. A failed
+    vLAN that never got a portgroup is removed at once, since there's nothing
+    in vCenter to destroy.
+
+    Only vLANs that are ready or failed can be deleted; vLANs that are still
+    being made are skipped. Checking who owns each vLAN, and what state it's
+    in, happens in the same statement as marking it, so nothing can change
+    in between.
+
+    :Returns: Dictionary - maps the name of each vLAN the user owns to ``deleted``
+              if it was removed at once, ``deleting`` if it was marked, or its
+              state if it's still being made. Names the user does not own are
+              left out.
+
+    :param username: The vLab user who owns the vLANs
+    :type username: String
+
+    :param vlan_names: The names of the vLANs to delete. Every vLAN the user owns if not supplied.
+    :type vlan_names: List
+    """
+    # The CTEs all see the same snapshot, so the UPDATE has to skip the rows the DELETE removes
+    mark_sql = """WITH unmade AS ( \
+                    DELETE FROM records WHERE person = %(person)s \
+                    AND (%(vlan_names)s::text[] IS NULL OR vlan_name = ANY(%(vlan_names)s)) \
+                    AND state = 'failed' AND portgroup_moid IS NULL \
+                    RETURNING vlan_name, tag, switch_name \
+                  ), freed AS ( \
+                    INSERT INTO free_tags(switch_name, tag) \
+                    SELECT unmade.switch_name, unmade.tag FROM unmade JOIN tag_pools ON tag_pools.switch_name = unmade.switch_name \
+                    WHERE unmade.tag BETWEEN tag_pools.tag_min AND tag_pools.tag_max \
+                  ), marked AS ( \
+                    UPDATE records SET state = 'deleting', error = NULL, attempts = 0, next_attempt = now() \
+                    WHERE person = %(person)s \
+                    AND (%(vlan_names)s::text[] IS NULL OR vlan_name = ANY(%(vlan_names)s)) \
+                    AND (state = 'ready' OR (state = 'failed' AND portgroup_moid IS NOT NULL)) \
+                    RETURNING vlan_name \
+                  ), busy AS ( \
+                    SELECT vlan_name, state FROM records WHERE person = %(person)s \
+                    AND (%(vlan_names)s::text[] IS NULL OR vlan_name = ANY(%(vlan_names)s)) \
+                    AND state IN ('reserved', 'provisioning') \
+                  ) \
+                  SELECT vlan_name, 'deleted' FROM unmade UNION ALL \
+                  SELECT vlan_name, 'deleting' FROM marked UNION ALL \
+                  SELECT vlan_name, state FROM busy;"""
+    params = {'person': username, 'vlan_names': list(vlan_names) if vlan_names is not None else None}
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(mark_sql, params)
+        result = {x[0]: x[1] for x in cur.fetchall()}
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    return result
+
+
+def claim_deleting(limit=const.VLAB_VLAN_REAP_BATCH, lease=600, vlan_names=None):
+    """Take the marked vLANs that are due to be destroyed. Each one is leased
+    for a while, so concurrent callers never take the same vLAN, and a vLAN
+    taken by a worker that dies is tried again once the lease runs out.
 
+    :Returns: List - a dictionary for each vLAN, for ``release_deleted`` and ``retry_deleting``
 
-def get_vlan(username):
+    :param limit: The most vLANs to take
+    :type limit: Integer
+
+    :param lease: How many seconds until the vLANs can be taken again
+    :type lease: Integer
+
+    :param vlan_names: Only take vLANs with these names. Default is any vLAN.
+    :type vlan_names: List
+    """
+    # There's no primary key on records, and the ctid only has to hold for this statement
+    claim_sql = """UPDATE records SET next_attempt = now() + %(lease)s * interval '1 second' \
+                   WHERE ctid = ANY(ARRAY( \
+                     SELECT ctid FROM records WHERE state = 'deleting' AND next_attempt <= now() \
+                     AND (%(vlan_names)s::text[] IS NULL OR vlan_name = ANY(%(vlan_names)s)) \
+                     ORDER BY next_attempt LIMIT %(limit)s FOR UPDATE SKIP LOCKED \
+                   )) \
+                   RETURNING vlan_name, person, switch_name, tag, portgroup_moid, attempts;"""
+    params = {'lease': lease, 'limit': limit, 'vlan_names': list(vlan_names) if vlan_names is not None else None}
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(claim_sql, params)
+        rows = cur.fetchall()
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    return [{'vlan_name': x[0], 'person': x[1], 'switch': x[2], 'tag': x[3], 'portgroup': x[4], 'attempts': x[5]}
+            for x in rows]
+
+
+def release_deleted(deleted):
+    """Remove the records of vLANs that were destroyed in vCenter, and free
+    their tags, using a single statement.
+
+    :Returns: Integer - the number of records removed
+
+    :param deleted: The vLANs, as returned by ``claim_deleting``
+    :type deleted: List
+    """
+    release_sql = """WITH gone AS ( \
+                       DELETE FROM records \
+                       USING unnest(%s::text[], %s::text[], %s::int[]) AS v(vlan_name, switch_name, tag) \
+                       WHERE records.state = 'deleting' AND records.vlan_name = v.vlan_name \
+                       AND records.tag = v.tag AND records.switch_name IS NOT DISTINCT FROM v.switch_name \
+                       RETURNING records.tag, records.switch_name \
+                     ), freed AS ( \
+                       INSERT INTO free_tags(switch_name, tag) \
+                       SELECT gone.switch_name, gone.tag FROM gone JOIN tag_pools ON tag_pools.switch_name = gone.switch_name \
+                       WHERE gone.tag BETWEEN tag_pools.tag_min AND tag_pools.tag_max \
+                     ) \
+                     SELECT tag FROM gone;"""
+    params = ([x['vlan_name'] for x in deleted], [x['switch'] for x in deleted], [x['tag'] for x in deleted])
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(release_sql, params)
+        released = cur.rowcount
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    return released
+
+
+def retry_deleting(failed, backoff=const.VLAB_VLAN_REAP_INTERVAL, backoff_max=const.VLAB_VLAN_REAP_BACKOFF_MAX):
+    """Save why vLANs could not be destroyed, and when to try again. The wait
+    doubles after every failed attempt.
+
+    :Returns: None
+
+    :param failed: Pairs of (vLAN, error message), with the vLAN as returned by ``claim_deleting``
+    :type failed: List
+
+    :param backoff: How many seconds to wait after the first failure
+    :type backoff: Integer
+
+    :param backoff_max: The most seconds to wait
+    :type backoff_max: Integer
+    """
+    retry_sql = """UPDATE records SET attempts = records.attempts + 1, error = v.error, \
+                   next_attempt = now() + LEAST(%s * power(2, records.attempts), %s) * interval '1 second' \
+                   FROM unnest(%s::text[], %s::text[], %s::int[], %s::text[]) AS v(vlan_name, switch_name, tag, error) \
+                   WHERE records.state = 'deleting' AND records.vlan_name = v.vlan_name \
+                   AND records.tag = v.tag AND records.switch_name IS NOT DISTINCT FROM v.switch_name;"""
+    params = (backoff, backoff_max,
+              [x[0]['vlan_name'] for x in failed], [x[0]['switch'] for x in failed],
+              [x[0]['tag'] for x in failed], [x[1] for x in failed])
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(retry_sql, params)
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+
+
+def get_vlan(username, use_cache=True, min_version=None):
     """Obtain all the different vLANs given person owns. The returned dictionary
     maps the vLAN name to its tag id.
 
+    Answers are cached per user for ``VLAB_VLAN_CACHE_TTL`` seconds. Anything
+    that changes a user's vLANs should call ``invalidate_vlan_cache``.
+
     :Returns: Dictionary
 
     :param username: The owner of the vLANs
     :type username: String
+
+    :param use_cache: Set to False to skip the cache, and read from the database.
+    :type use_cache: Boolean
+
+    :param min_version: Ignore cached answers older than this version of the
+                        user's records. See ``get_version``.
+    :type min_version: Integer
+    """
+    records = get_vlan_details(username, use_cache=use_cache, min_version=min_version)
+    return {name: record['tag'] for name, record in records.items()}
+
+
+def get_vlan_details(username, use_cache=True, min_version=None):
+    """Like ``get_vlan``, but each vLAN name maps to a dictionary with the
+    ``tag``, the name of the ``switch`` the vLAN is on, the managed object
+    id of its ``portgroup`` in vCenter, and its ``state``. The switch and
+    portgroup are None for records made before they were tracked, until they
+    are backfilled.
+
+    :Returns: Dictionary
+
+    :param username: The owner of the vLANs
+    :type username: String
+
+    :param use_cache: Set to False to skip the cache, and read from the database.
+    :type use_cache: Boolean
+
+    :param min_version: Ignore cached answers older than this version of the
+                        user's records. See ``get_version``.
+    :type min_version: Integer
     """
-    # Order of vlan_name, tag matters
-    get_sql = """SELECT vlan_name, tag FROM records WHERE person LIKE %s;"""
+    cache_key = 'vlans:{}'.format(username)
+    if use_cache:
+        cached = vlan_cache.get(cache_key)
+        if cached is not None and (min_version is None or cached['version'] >= min_version):
+            return {name: dict(record) for name, record in cached['vlans'].items()}
+    version_sql = """SELECT version FROM versions WHERE person = %s;"""
+    get_sql = _LIST_SQL
     conn, cur = get_db_connection()
     try:
+        # Read the version first; the records can only be newer than it, which
+        # means a cached answer is never labeled newer than it really is.
+        cur.execute(version_sql, (username,))
+        row = cur.fetchone()
+        version = row[0] if row else 0
         cur.execute(get_sql, (username,))
-        # x[0] should be the vlan name, x[1] should be the tag id
-        result = {x[0]:x[1] for x in cur.fetchall()}
+        result = {x[0]: {'tag': x[1], 'switch': x[2], 'portgroup': x[3], 'state': x[4]} for x in cur.fetchall()}
     finally:
-        conn.close()
+        release_db_connection(conn)
+    vlan_cache.set(cache_key, {'version': version, 'vlans': result})
+    return {name: dict(record) for name, record in result.items()}
+
+
+def record_portgroups(portgroups):
+    """Save which switch each vLAN is on, and the managed object id of its
+    portgroup in vCenter, using a single statement. Recording them marks the
+    vLANs as ready.
+
+    :Returns: Integer - the number of records updated
+
+    :param portgroups: Maps a vLAN name to a tuple of (switch name, portgroup id)
+    :type portgroups: Dictionary
+    """
+    update_sql = """UPDATE records SET switch_name = v.switch_name, portgroup_moid = v.portgroup_moid, \
+                    state = 'ready', error = NULL \
+                    FROM unnest(%s::text[], %s::text[], %s::text[]) AS v(vlan_name, switch_name, portgroup_moid) \
+                    WHERE records.vlan_name = v.vlan_name AND records.state <> 'deleting';"""
+    names = list(portgroups.keys())
+    switches = [portgroups[x][0] for x in names]
+    moids = [portgroups[x][1] for x in names]
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(update_sql, (names, switches, moids))
+        updated = cur.rowcount
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    return updated
+
+
+def get_unmapped_vlans():
+    """Find the vLANs with no record of their portgroup in vCenter, like ones
+    made before portgroups were tracked.
+
+    :Returns: Dictionary - maps the vLAN name to its owner
+    """
+    # The 'noone' records only mark the ends of the vLAN tag range
+    find_sql = """SELECT vlan_name, person FROM records \
+                  WHERE portgroup_moid IS NULL AND state = 'ready' AND person <> 'noone';"""
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(find_sql)
+        result = {x[0]: x[1] for x in cur.fetchall()}
+    finally:
+        release_db_connection(conn)
     return result
+
+
+def start_provisioning(username, vlan_name):
+    """Move a reserved vLAN to the provisioning state. Only one caller can do
+    this for a vLAN, so a task that's delivered twice only makes the vLAN once.
+
+    :Returns: Tuple - (Integer tag, String portgroup managed object id), or None
+              if the vLAN is not reserved. The portgroup id is None unless the
+              tag came with a warm portgroup.
+
+    :param username: The vLab user who owns the vLAN
+    :type username: String
+
+    :param vlan_name: The name of the vLAN
+    :type vlan_name: String
+    """
+    start_sql = """UPDATE records SET state = 'provisioning' \
+                   WHERE person = %s AND vlan_name = %s AND state = 'reserved' \
+                   RETURNING tag, portgroup_moid;"""
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(start_sql, (username, vlan_name))
+        row = cur.fetchone()
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    if row is None:
+        return None
+    return row[0], row[1]
+
+
+def fail_vlan(username, vlan_name, error):
+    """Mark a vLAN as failed. The record, and its tag, are kept until the user
+    deletes the vLAN, so they can see why it failed.
+
+    :Returns: None
+
+    :param username: The vLab user who owns the vLAN
+    :type username: String
+
+    :param vlan_name: The name of the vLAN
+    :type vlan_name: String
+
+    :param error: Why the vLAN could not be made
+    :type error: String
+    """
+    fail_sql = """UPDATE records SET state = 'failed', error = %s WHERE person = %s AND vlan_name = %s \
+                 AND state <> 'deleting';"""
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(fail_sql, (error, username, vlan_name))
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+
+
+def get_vlan_by_task(username, task_id):
+    """Look up the vLAN a task is making.
+
+    :Returns: Dictionary, or None if the user has no vLAN made by the task
+
+    :param username: The vLab user who owns the vLAN
+    :type username: String
+
+    :param task_id: The id of the task that makes the vLAN
+    :type task_id: String
+    """
+    find_sql = """SELECT vlan_name, tag, switch_name, state, error FROM records \
+                  WHERE task_id = %s AND person = %s AND state <> 'deleting';"""
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(find_sql, (task_id, username))
+        row = cur.fetchone()
+    finally:
+        release_db_connection(conn)
+    if row is None:
+        return None
+    return {'vlan_name': row[0], 'tag': row[1], 'switch': row[2], 'state': row[3], 'error': row[4]}
+
+
+def get_warm_pool_targets(switches=const.VLAB_VLAN_WARM_POOL_SWITCHES, default_size=const.VLAB_VLAN_WARM_POOL_SIZE):
+    """Parse the switches that have a warm pool, like ``switchA,switchB:10``.
+    Switches without a size use the default size.
+
+    :Returns: Dictionary - maps the switch name to how many warm portgroups to keep ready
+
+    :param switches: The switch names, each with an optional size
+    :type switches: List
+
+    :param default_size: How many warm portgroups to keep on a switch without a size
+    :type default_size: Integer
+    """
+    targets = {}
+    for entry in switches:
+        name, _, size = entry.partition(':')
+        targets[name] = int(size) if size else default_size
+    return {name: size for name, size in targets.items() if size > 0}
+
+
+def claim_warm_portgroup(username, vlan_name, switch_name, state='provisioning', task_id=None,
+                         record_stats=const.VLAB_VLAN_WARM_POOL_METRICS):
+    """Create the record of a new vLAN by claiming a portgroup from the switch's
+    warm pool, in a single statement.
+
+    :Returns: Tuple - (Integer tag, String portgroup managed object id), or None
+              if the switch has no warm portgroups ready
+
+    :Raises: ValueError - If vLAN name is already taken
+
+    :param username: The vLab user who wants to create a new vLAN
+    :type username: String
+
+    :param vlan_name: The name of the new vLAN being created
+    :type vlan_name: String
+
+    :param switch_name: The name of the switch the vLAN is being created on
+    :type switch_name: String
+
+    :param state: Where the new vLAN is in being made; ``reserved`` or ``provisioning``
+    :type state: String
+
+    :param task_id: The id of the task that will make the vLAN's portgroup
+    :type task_id: String
+
+    :param record_stats: Count the claim as a hit or miss in ``warm_pool_stats``
+    :type record_stats: Boolean
+    """
+    claim_sql = """WITH claimed AS ( \
+                     DELETE FROM warm_portgroups \
+                     WHERE switch_name = %(switch_name)s AND tag = ( \
+                       SELECT tag FROM warm_portgroups \
+                       WHERE switch_name = %(switch_name)s AND portgroup_moid IS NOT NULL \
+                       LIMIT 1 FOR UPDATE SKIP LOCKED) \
+                     RETURNING tag, portgroup_moid \
+                   ), made AS ( \
+                     INSERT INTO records(tag, person, vlan_name, switch_name, portgroup_moid, state, task_id) \
+                     SELECT tag, %(person)s, %(vlan_name)s, %(switch_name)s, portgroup_moid, %(state)s, %(task_id)s \
+                     FROM claimed \
+                     RETURNING tag, portgroup_moid \
+                   )"""
+    stats_sql = """, counted AS ( \
+                     INSERT INTO warm_pool_stats(switch_name, hits, misses) \
+                     SELECT %(switch_name)s, COUNT(*), 1 - COUNT(*) FROM made \
+                     ON CONFLICT (switch_name) DO UPDATE \
+                     SET hits = warm_pool_stats.hits + EXCLUDED.hits, \
+                         misses = warm_pool_stats.misses + EXCLUDED.misses \
+                   )"""
+    select_sql = """ SELECT tag, portgroup_moid FROM made;"""
+    sql = claim_sql + stats_sql + select_sql if record_stats else claim_sql + select_sql
+    conn, cur = get_db_connection()
+    try:
+        try:
+            cur.execute(sql, {'person': username, 'vlan_name': vlan_name, 'switch_name': switch_name,
+                              'state': state, 'task_id': task_id})
+            row = cur.fetchone()
+        except psycopg2.IntegrityError as doh:
+            # Rolling back also puts the warm portgroup back in the pool
+            conn.rollback()
+            if doh.pgcode != '23505': # 23505 means unique_violation; vlan already registered
+                raise
+            raise ValueError('vLAN {} already exits'.format(vlan_name))
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    if row is None:
+        return None
+    return row[0], row[1]
+
+
+def unclaim_warm_portgroup(username, vlan_name):
+    """Undo ``claim_warm_portgroup`` when vCenter could not rename the portgroup.
+
+    The record is deleted, and the tag goes back to the warm pool with no
+    portgroup id, so it's not claimed again until the portgroup is checked.
+
+    :Returns: None
+
+    :param username: The vLab user who owns the vLAN
+    :type username: String
+
+    :param vlan_name: The name of the vLAN
+    :type vlan_name: String
+    """
+    unclaim_sql = """WITH gone AS ( \
+                       DELETE FROM records WHERE person = %s AND vlan_name = %s AND state <> 'deleting' \
+                       RETURNING switch_name, tag \
+                     ) \
+                     INSERT INTO warm_portgroups(switch_name, tag) SELECT switch_name, tag FROM gone;"""
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(unclaim_sql, (username, vlan_name))
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+
+
+def reserve_warm_tags(switch_name, target):
+    """Take enough tags from the switch's pool to bring its warm pool up to the
+    target size. The tags are held in ``warm_portgroups`` until their portgroups
+    are made.
+
+    :Returns: List - the reserved tags
+
+    :Raises: ValueError - If the switch is unknown
+
+    :param switch_name: The switch to reserve tags on
+    :type switch_name: String
+
+    :param target: How many warm portgroups the switch should have
+    :type target: Integer
+    """
+    # The lock stops two replenishers from both seeing the same shortfall.
+    # It's released at commit, so it's only held while the tags are claimed.
+    # ARRAY() runs the LIMIT once; as an IN (...) semi-join, Postgres can run it
+    # again for every free tag, and take all of them.
+    reserve_sql = """SELECT pg_advisory_xact_lock(hashtext('warm_portgroups'), hashtext(%(switch_name)s)); \
+                     WITH claimed AS ( \
+                       DELETE FROM free_tags \
+                       WHERE switch_name = %(switch_name)s AND tag = ANY(ARRAY( \
+                         SELECT tag FROM free_tags WHERE switch_name = %(switch_name)s \
+                         LIMIT GREATEST(%(target)s - (SELECT COUNT(*) FROM warm_portgroups \
+                                                      WHERE switch_name = %(switch_name)s), 0) \
+                         FOR UPDATE SKIP LOCKED)) \
+                       RETURNING tag \
+                     ) \
+                     INSERT INTO warm_portgroups(switch_name, tag) \
+                     SELECT %(switch_name)s, tag FROM claimed RETURNING tag;"""
+    params = {'switch_name': switch_name, 'target': target}
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(reserve_sql, params)
+        tags = [x[0] for x in cur.fetchall()]
+        if not tags and _add_pool(cur, switch_name):
+            # Reserve again even if another transaction made the pool; see ``_claim_tag``
+            cur.execute(reserve_sql, params)
+            tags = [x[0] for x in cur.fetchall()]
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+    return sorted(tags)
+
+
+def fill_warm_portgroups(switch_name, portgroups):
+    """Save the ids of newly made warm portgroups, which makes them ready to claim.
+
+    :Returns: None
+
+    :param switch_name: The switch the portgroups are on
+    :type switch_name: String
+
+    :param portgroups: Maps a reserved tag to the managed object id of its portgroup
+    :type portgroups: Dictionary
+    """
+    fill_sql = """UPDATE warm_portgroups SET portgroup_moid = v.portgroup_moid \
+                  FROM unnest(%s::int[], %s::text[]) AS v(tag, portgroup_moid) \
+                  WHERE warm_portgroups.switch_name = %s AND warm_portgroups.tag = v.tag;"""
+    tags = list(portgroups.keys())
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(fill_sql, (tags, [portgroups[x] for x in tags], switch_name))
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+
+
+def release_warm_tags(switch_name, tags):
+    """Return reserved tags to the switch's pool of free tags, when their warm
+    portgroups could not be made.
+
+    :Returns: None
+
+    :param switch_name: The switch the tags were reserved on
+    :type switch_name: String
+
+    :param tags: The tags to give back
+    :type tags: List
+    """
+    release_sql = """WITH gone AS ( \
+                       DELETE FROM warm_portgroups WHERE switch_name = %s AND tag = ANY(%s) RETURNING switch_name, tag \
+                     ) \
+                     INSERT INTO free_tags(switch_name, tag) SELECT switch_name, tag FROM gone;"""
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(release_sql, (switch_name, list(tags)))
+        conn.commit()
+    finally:
+        release_db_connection(conn)
+
+
+def get_warm_pool_stats():
+    """Report how well the warm pool of each switch is keeping up.
+
+    :Returns: Dictionary - maps the switch name to the number of creates that
+              found a warm portgroup (hits), the number that had to make one
+              (misses), and the number of warm portgroups that are ready or
+              still being made (pending)
+    """
+    stats_sql = """SELECT switch_name, SUM(hits), SUM(misses), SUM(ready), SUM(pending) FROM ( \
+                     SELECT switch_name, hits, misses, 0 AS ready, 0 AS pending FROM warm_pool_stats \
+                     UNION ALL \
+                     SELECT switch_name, 0, 0, COUNT(portgroup_moid), COUNT(*) - COUNT(portgroup_moid) \
+                     FROM warm_portgroups GROUP BY switch_name \
+                   ) AS pools GROUP BY switch_name;"""
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(stats_sql)
+        rows = cur.fetchall()
+    finally:
+        release_db_connection(conn)
+    return {x[0]: {'hits': int(x[1]), 'misses': int(x[2]), 'ready': int(x[3]), 'pending': int(x[4])} for x in rows}
+
+
+def get_reconcile_state(since=None, moids=(), names=(), stuck_after=const.VLAB_VLAN_RECONCILE_STUCK_AFTER):
+    """Read what the reconciler needs to compare the records against vCenter.
+
+    :Returns: Dictionary - with these keys:
+
+              - ``records`` the records that changed since ``since``, or every
+                record if ``since`` is None, along with the records of the given
+                portgroup ids and names
+              - ``warm`` maps (switch name, tag) of each warm portgroup to its id
+              - ``pools`` maps each switch name to its (smallest, largest) tag
+              - ``stuck`` the records that have been reserved or provisioning
+                for longer than ``stuck_after`` seconds
+              - ``token`` pass as ``since`` next time, to only read what changed
+
+    :param since: The ``token`` from the last call
+    :type since: datetime.datetime
+
+    :param moids: Also read the records of these portgroups
+    :type moids: Iterable
+
+    :param names: Also read the records with these names
+    :type names: Iterable
+
+    :param stuck_after: How many seconds a vLAN can take to be made
+    :type stuck_after: Integer
+    """
+    columns = """vlan_name, person, tag, switch_name, portgroup_moid, state"""
+    # The minute of overlap catches records changed by transactions that were
+    # still open during the last read
+    records_sql = """SELECT {} FROM records WHERE person <> 'noone' AND ( \
+                       %(since)s::timestamptz IS NULL \
+                       OR changed_at > %(since)s::timestamptz - interval '1 minute' \
+                       OR portgroup_moid = ANY(%(moids)s) OR vlan_name = ANY(%(names)s));""".format(columns)
+    stuck_sql = """SELECT {} FROM records WHERE state IN ('reserved', 'provisioning') \
+                   AND changed_at < now() - %s * interval '1 second';""".format(columns)
+    warm_sql = """SELECT switch_name, tag, portgroup_moid FROM warm_portgroups;"""
+    pools_sql = """SELECT switch_name, tag_min, tag_max FROM tag_pools;"""
+    params = {'since': since, 'moids': list(moids), 'names': list(names)}
+    conn, cur = get_db_connection()
+    try:
+        cur.execute("""SELECT now();""")
+        token = cur.fetchone()[0]
+        cur.execute(records_sql, params)
+        records = [_reconcile_record(x) for x in cur.fetchall()]
+        cur.execute(stuck_sql, (stuck_after,))
+        stuck = [_reconcile_record(x) for x in cur.fetchall()]
+        cur.execute(warm_sql)
+        warm = {(x[0], x[1]): x[2] for x in cur.fetchall()}
+        cur.execute(pools_sql)
+        pools = {x[0]: (x[1], x[2]) for x in cur.fetchall()}
+    finally:
+        release_db_connection(conn)
+    return {'records': records, 'warm': warm, 'pools': pools, 'stuck': stuck, 'token': token}
+
+
+def _reconcile_record(row):
+    """Turn a row read by ``get_reconcile_state`` into a dictionary.
+
+    :Returns: Dictionary
+    """
+    return {'vlan_name': row[0], 'person': row[1], 'tag': row[2], 'switch': row[3],
+            'portgroup': row[4], 'state': row[5]}
+
+
+def get_version(username):
+    """Obtain the version number of a user's records. The number goes up every
+    time one of the user's vLANs is created, changed, or deleted.
+
+    :Returns: Integer
+
+    :param username: The owner of the vLANs
+    :type username: String
+    """
+    version_sql = """SELECT version FROM versions WHERE person = %s;"""
+    conn, cur = get_db_connection()
+    try:
+        cur.execute(version_sql, (username,))
+        row = cur.fetchone()
+    finally:
+        release_db_connection(conn)
+    if row is None:
+        # The user has never had a vLAN
+        return 0
+    return row[0]
+
+
+def invalidate_vlan_cache(username):
+    """Discard the cached vLANs of a user, so the next lookup reads the database.
+
+    :Returns: None
+
+    :param username: The owner of the vLANs
+    :type username: String
+    """
+    vlan_cache.delete('vlans:{}'.format(username))
+
+
+class ChangeFeed(object):
+    """Hands the changes to each user's vLANs to subscribers as they happen.
+
+    A trigger on ``records`` sends a NOTIFY on the ``vlan_changes`` channel
+    whenever a vLAN is created, changes state, or is deleted. One background
+    thread per process LISTENs on its own connection, and copies each change
+    to the queue of every subscriber of that vLAN's owner. The thread only runs
+    while there are subscribers.
+
+    A subscriber that falls ``backlog`` changes behind is dropped, instead of
+    holding changes in memory forever. Changes made while the connection is
+    being remade are lost. In both cases the subscriber gets a ``resync``
+    change, and should list the user's vLANs again.
+
+    :param backlog: The most changes to hold for a subscriber
+    :type backlog: Integer
+
+    :param poll_interval: The most seconds to wait for a NOTIFY before checking for subscribers
+    :type poll_interval: Integer
+    """
+    CHANNEL = 'vlan_changes'
+
+    def __init__(self, backlog=const.VLAB_VLAN_EVENTS_BACKLOG, poll_interval=1):
+        self.backlog = backlog
+        self.poll_interval = poll_interval
+        # Maps each subscriber's queue to the user it follows
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, username):
+        """Start following the changes to a user's vLANs.
+
+        :Returns: queue.Queue - of dictionaries with the ``event``, ``vlan_name``,
+                  ``tag``, ``switch`` and ``state``
+
+        :param username: The owner of the vLANs
+        :type username: String
+        """
+        changes = queue.Queue(maxsize=self.backlog)
+        with self._lock:
+            self._subscribers[changes] = username
+            # A forked process inherits a thread object, but not the thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._listen, name='vlan-change-feed')
+                self._thread.daemon = True
+                self._thread.start()
+        return changes
+
+    def unsubscribe(self, changes):
+        """Stop following changes.
+
+        :Returns: None
+
+        :param changes: The queue from ``subscribe``
+        :type changes: queue.Queue
+        """
+        with self._lock:
+            self._subscribers.pop(changes, None)
+
+    def is_subscribed(self, changes):
+        """Check if a subscriber is still getting changes. Subscribers that fall
+        too far behind are dropped.
+
+        :Returns: Boolean
+
+        :param changes: The queue from ``subscribe``
+        :type changes: queue.Queue
+        """
+        with self._lock:
+            return changes in self._subscribers
+
+    def _listen(self):
+        """Runs in the background thread; LISTENs for changes until there are no subscribers.
+
+        :Returns: None
+        """
+        conn = None
+        while True:
+            with self._lock:
+                if not self._subscribers:
+                    self._thread = None
+                    break
+            try:
+                if conn is None:
+                    conn = psycopg2.connect(database='vlans', host=const.INF_DB_HOSTNAME, user='postgres',
+                                            password=const.POSTGRES_PASSWORD)
+                    conn.autocommit = True
+                    conn.cursor().execute("""LISTEN {};""".format(self.CHANNEL))
+                if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self._publish(ujson.loads(conn.notifies.pop(0).payload))
+            except Exception:
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                    # Changes sent before the connection is remade are never seen
+                    self._publish({'event': 'resync', 'person': None})
+                time.sleep(self.poll_interval)
+        if conn is not None:
+            conn.close()
+
+    def _publish(self, change):
+        """Copy a change to the queue of each subscriber of the vLAN's owner.
+        A change without an owner goes to every subscriber.
+
+        :Returns: None
+        """
+        person = change.pop('person')
+        with self._lock:
+            for changes, username in list(self._subscribers.items()):
+                if person is not None and username != person:
+                    continue
+                try:
+                    changes.put_nowait(change)
+                except queue.Full:
+                    self._subscribers.pop(changes)
+
+
+change_feed = ChangeFeed()
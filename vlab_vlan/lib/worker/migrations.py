@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 -*-
+"""
+Versioned changes to the database schema. ``setup-db.sh`` only makes the
+``records`` table when the database container is first made; everything after
+it is here, where ``database.migrate`` applies it to new and existing databases
+alike. Each worker runs ``database.migrate`` when it starts.
+
+Each entry is a tuple of (version, description, SQL). Never change an entry once
+it is released; add a new one with a higher version instead. Databases made
+before this module existed have some of these changes already, so each one must
+be safe to apply again.
+"""
+
+MIGRATIONS = [
+    (1, 'Build the pool of unused vLAN tags from the records table',
+     """CREATE TABLE IF NOT EXISTS free_tags(
+          tag INT PRIMARY KEY NOT NULL
+        );
+
+        INSERT INTO free_tags(tag)
+        SELECT unused.tag FROM (
+          SELECT all_tags AS tag FROM
+          generate_series((SELECT MIN(tag) FROM records), (SELECT MAX(tag) FROM records)) all_tags
+          EXCEPT
+          SELECT tag FROM records
+        ) unused
+        -- Once tags are pooled per switch, version 4 fills free_tags instead
+        WHERE NOT EXISTS (SELECT 1 FROM information_schema.columns
+                          WHERE table_name = 'free_tags' AND column_name = 'switch_name')
+        ON CONFLICT DO NOTHING;"""),
+    (2, 'Give each user a version number that goes up every time their records change',
+     """CREATE TABLE IF NOT EXISTS versions(
+          person TEXT PRIMARY KEY NOT NULL,
+          version BIGINT NOT NULL
+        );
+
+        CREATE OR REPLACE FUNCTION bump_version() RETURNS trigger AS $$
+        BEGIN
+          IF TG_OP <> 'INSERT' THEN
+            INSERT INTO versions(person, version) VALUES (OLD.person, 1)
+            ON CONFLICT (person) DO UPDATE SET version = versions.version + 1;
+          END IF;
+          IF TG_OP <> 'DELETE' THEN
+            INSERT INTO versions(person, version) VALUES (NEW.person, 1)
+            ON CONFLICT (person) DO UPDATE SET version = versions.version + 1;
+          END IF;
+          RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS records_version ON records;
+        CREATE TRIGGER records_version
+          AFTER INSERT OR UPDATE OR DELETE ON records
+          FOR EACH ROW EXECUTE PROCEDURE bump_version();"""),
+    (3, 'Track which switch each vLAN is on, and its portgroup in vCenter',
+     # Existing records are filled in by the vlan.backfill task
+     """ALTER TABLE records
+          ADD COLUMN IF NOT EXISTS switch_name TEXT,
+          ADD COLUMN IF NOT EXISTS portgroup_moid TEXT;"""),
+    (4, 'Give each switch its own pool of vLAN tags',
+     # Tags only need to be unique per switch. Adding a row to tag_pools fills
+     # free_tags with that switch's range, leaving out the tags of records
+     # without a switch_name.
+     """CREATE TABLE IF NOT EXISTS tag_pools(
+          switch_name TEXT PRIMARY KEY NOT NULL,
+          tag_min INT NOT NULL,
+          tag_max INT NOT NULL,
+          CHECK (tag_min <= tag_max)
+        );
+
+        ALTER TABLE free_tags
+          ADD COLUMN IF NOT EXISTS switch_name TEXT REFERENCES tag_pools(switch_name) ON DELETE CASCADE;
+        DELETE FROM free_tags WHERE switch_name IS NULL;
+        ALTER TABLE free_tags ALTER COLUMN switch_name SET NOT NULL;
+        ALTER TABLE free_tags DROP CONSTRAINT IF EXISTS free_tags_pkey;
+        ALTER TABLE free_tags ADD PRIMARY KEY (switch_name, tag);
+
+        ALTER TABLE records DROP CONSTRAINT IF EXISTS records_pkey;
+        CREATE UNIQUE INDEX IF NOT EXISTS switch_tags on records (switch_name, tag);
+
+        CREATE OR REPLACE FUNCTION fill_tag_pool() RETURNS trigger AS $$
+        BEGIN
+          INSERT INTO free_tags(switch_name, tag)
+          SELECT NEW.switch_name, all_tags FROM generate_series(NEW.tag_min, NEW.tag_max) all_tags
+          EXCEPT
+          SELECT NEW.switch_name, tag FROM records
+          WHERE switch_name = NEW.switch_name OR switch_name IS NULL;
+          RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS tag_pools_fill ON tag_pools;
+        CREATE TRIGGER tag_pools_fill
+          AFTER INSERT ON tag_pools
+          FOR EACH ROW EXECUTE PROCEDURE fill_tag_pool();"""),
+    (5, 'Keep portgroups made ahead of time, so creating a vLAN only has to rename one',
+     # A row's tag is taken out of free_tags when it's reserved; the
+     # portgroup_moid is NULL until vCenter has made the portgroup.
+     """CREATE TABLE IF NOT EXISTS warm_portgroups(
+          switch_name TEXT NOT NULL REFERENCES tag_pools(switch_name),
+          tag INT NOT NULL,
+          portgroup_moid TEXT,
+          PRIMARY KEY (switch_name, tag)
+        );
+
+        CREATE TABLE IF NOT EXISTS warm_pool_stats(
+          switch_name TEXT PRIMARY KEY NOT NULL,
+          hits BIGINT NOT NULL DEFAULT 0,
+          misses BIGINT NOT NULL DEFAULT 0
+        );"""),
+    (6, 'Track where each vLAN is in being made: reserved, provisioning, ready, or failed',
+     """ALTER TABLE records
+          ADD COLUMN IF NOT EXISTS state TEXT NOT NULL DEFAULT 'ready',
+          ADD COLUMN IF NOT EXISTS error TEXT,
+          ADD COLUMN IF NOT EXISTS task_id TEXT;
+        ALTER TABLE records DROP CONSTRAINT IF EXISTS records_state;
+        ALTER TABLE records ADD CONSTRAINT records_state
+          CHECK (state IN ('reserved', 'provisioning', 'ready', 'failed'));
+
+        CREATE INDEX IF NOT EXISTS task_ids on records (task_id);"""),
+    (7, 'Only mark a deleted vLAN, so the worker can destroy its portgroup and free its tag later',
+     # The name can be re-used as soon as the record is marked
+     """ALTER TABLE records
+          ADD COLUMN IF NOT EXISTS attempts INT NOT NULL DEFAULT 0,
+          ADD COLUMN IF NOT EXISTS next_attempt TIMESTAMPTZ;
+        ALTER TABLE records DROP CONSTRAINT IF EXISTS records_state;
+        ALTER TABLE records ADD CONSTRAINT records_state
+          CHECK (state IN ('reserved', 'provisioning', 'ready', 'failed', 'deleting'));
+
+        CREATE UNIQUE INDEX IF NOT EXISTS live_vlan_names on records (vlan_name) WHERE state <> 'deleting';
+        DROP INDEX IF EXISTS vlan_names;
+
+        CREATE INDEX IF NOT EXISTS pending_deletes on records (next_attempt) WHERE state = 'deleting';"""),
+    (8, 'Note when each record last changed, so the reconciler only looks at what changed',
+     """ALTER TABLE records ADD COLUMN IF NOT EXISTS changed_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+        CREATE OR REPLACE FUNCTION touch_record() RETURNS trigger AS $$
+        BEGIN
+          NEW.changed_at := now();
+          RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS touch_records ON records;
+        CREATE TRIGGER touch_records BEFORE UPDATE ON records
+          FOR EACH ROW EXECUTE PROCEDURE touch_record();
+
+        CREATE INDEX IF NOT EXISTS changed_records on records (changed_at);
+        CREATE INDEX IF NOT EXISTS portgroup_moids on records (portgroup_moid);"""),
+    (9, 'Index the records by owner, for listing and deleting vLANs',
+     """CREATE INDEX IF NOT EXISTS person_vlans on records (person, vlan_name);"""),
+    (10, 'Send a NOTIFY on the vlan_changes channel when a vLAN is created, changes state, or is deleted',
+     """CREATE OR REPLACE FUNCTION notify_record() RETURNS trigger AS $$
+        DECLARE
+          rec RECORD;
+          event TEXT;
+        BEGIN
+          IF TG_OP = 'INSERT' THEN
+            rec := NEW;
+            event := 'created';
+          ELSE
+            -- vLANs are reported deleted when they are marked, not when they are reaped
+            IF OLD.state = 'deleting' THEN
+              RETURN NULL;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+              rec := OLD;
+              event := 'deleted';
+            ELSIF NEW.state = OLD.state THEN
+              RETURN NULL;
+            ELSE
+              rec := NEW;
+              event := CASE WHEN NEW.state = 'deleting' THEN 'deleted' ELSE 'changed' END;
+            END IF;
+          END IF;
+          IF rec.person = 'noone' THEN
+            RETURN NULL;
+          END IF;
+          PERFORM pg_notify('vlan_changes', json_build_object('event', event, 'person', rec.person,
+                                                              'vlan_name', rec.vlan_name, 'tag', rec.tag,
+                                                              'switch', rec.switch_name, 'state', rec.state)::text);
+          RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        DROP TRIGGER IF EXISTS records_notify ON records;
+        CREATE TRIGGER records_notify
+          AFTER INSERT OR UPDATE OR DELETE ON records
+          FOR EACH ROW EXECUTE PROCEDURE notify_record();"""),
+]
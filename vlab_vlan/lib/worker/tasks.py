@@ -25,19 +25,113 @@ Example:
    }
 
 """
-from celery import Celery
+import time
+
+from celery import Celery, states
+from celery.signals import task_postrun, worker_init, worker_process_init, worker_process_shutdown, worker_shutdown
 from vlab_inf_common.vmware import vCenter
 from vlab_api_common import get_task_logger
 
 from vlab_vlan.lib.worker import database
-from vlab_vlan.lib.worker.vmware import create_network, delete_network
-from vlab_vlan.lib import const
+from vlab_vlan.lib.worker.callbacks import callback_sender
+from vlab_vlan.lib.worker.vmware import (NO_SUCH_VLAN, create_network, create_networks, delete_networks, find_portgroups,
+                                         get_portgroup_changes, portgroup_mirror, rename_network,
+                                         vcenter_session, task_watcher)
+from vlab_vlan.lib import const, queues
 
 app = Celery('vlan', backend='rpc://', broker=const.VLAB_MESSAGE_BROKER)
+queues.configure(app)
+# Slow vCenter tasks should not sit prefetched behind another slow task
+app.conf.worker_prefetch_multiplier = 1
+# Only runs with ``celery beat``, or a worker started with ``--beat``
+app.conf.beat_schedule = {'reap-deleted-vlans': {'task': 'vlan.reap',
+                                                 'schedule': const.VLAB_VLAN_REAP_INTERVAL,
+                                                 'kwargs': {'txn_id': 'beat'}},
+                          'reconcile': {'task': 'vlan.reconcile',
+                                        'schedule': const.VLAB_VLAN_RECONCILE_INTERVAL,
+                                        'kwargs': {'txn_id': 'beat'}}}
+# When the database side of the last ``vlan.reconcile`` was read
+_reconcile_token = {'since': None}
+# How many times a worker tries to migrate the database before it gives up
+_MIGRATE_ATTEMPTS = 5
+if const.VLAB_VLAN_WARM_POOL_SWITCHES:
+    app.conf.beat_schedule['replenish-warm-pool'] = {'task': 'vlan.replenish',
+                                                     'schedule': const.VLAB_VLAN_WARM_POOL_INTERVAL,
+                                                     'kwargs': {'txn_id': 'beat'}}
+
+
+@worker_init.connect
+def init_worker(**kwargs):
+    """Bring the database schema up to date, before the worker takes any tasks.
+    The worker exits if it cannot, since tasks (and the API's event stream) rely
+    on the newer schema."""
+    logger = get_task_logger(txn_id='worker-init', task_id='worker-init', loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+    for attempt in range(_MIGRATE_ATTEMPTS):
+        try:
+            applied = database.migrate()
+        except Exception as doh:
+            # The database may still be starting up
+            logger.error('Unable to migrate database schema: {}'.format(doh))
+            time.sleep(2 ** attempt)
+        else:
+            if applied:
+                logger.info('Migrated database schema to version {}'.format(applied[-1]))
+            return
+    # Celery only logs an Exception raised by a signal handler, and starts anyway
+    raise SystemExit('Unable to migrate database schema after {} attempts'.format(_MIGRATE_ATTEMPTS))
+
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Give each worker process its own pool of database connections"""
+    database.init_pool()
+
+
+@worker_shutdown.connect
+@worker_process_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    """Close the process's database connections and vCenter session before it exits.
+    Also runs when a worker using ``-P threads`` exits, since it has no child processes.
+    """
+    task_watcher.close()
+    portgroup_mirror.close()
+    dropped = callback_sender.close()
+    if dropped:
+        logger = get_task_logger(txn_id='worker-shutdown', task_id='worker-shutdown', loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+        logger.error('Unable to deliver {} callbacks before exiting'.format(dropped))
+    database.close_pool()
+    vcenter_session.close()
+
+
+@task_postrun.connect
+def send_callback(task_id=None, task=None, args=None, kwargs=None, retval=None, state=None, **extra):
+    """Send the result of a task to the ``callback_url`` the client supplied, if
+    there is one. Delivery happens in the background; see ``CallbackSender``.
+
+    The callback body is the result of the task, plus the ``task-id``, ``user``,
+    and ``status`` (i.e. SUCCESS or FAILURE) of the task.
+
+    :Returns: None
+    """
+    kwargs = kwargs or {}
+    callback_url = kwargs.get('callback_url', None)
+    if not callback_url or state not in states.READY_STATES:
+        return
+    if isinstance(retval, dict):
+        payload = dict(retval)
+    else:
+        # The task raised an exception
+        payload = {'error': 'Task failed: {}'.format(retval), 'content': {}, 'params': {}}
+    payload['task-id'] = task_id
+    payload['user'] = args[0] if args else kwargs.get('username', None)
+    payload['status'] = state
+    if not callback_sender.send(callback_url, payload):
+        logger = get_task_logger(txn_id=kwargs.get('txn_id', 'noId'), task_id=task_id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+        logger.error('Too many callbacks waiting to be delivered; dropped callback to {}'.format(callback_url))
 
 
 @app.task(name='vlan.show', bind=True)
-def list(self, username, txn_id):
+def list(self, username, txn_id, min_version=None, details=False):
     """List all vLANs owned by the user
 
     :Returns: Dictionary
@@ -47,23 +141,34 @@ def list(self, username, txn_id):
 
     :param txn_id: A client-supplied transaction id - makes debugging easier
     :type txn_id: String
+
+    :param min_version: Do not answer with a cached list older than this version
+    :type min_version: Integer
+
+    :param details: Include the switch of each vLAN, instead of only the tag
+    :type details: Boolean
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
     resp = {'content' : {}, 'error' : None, 'params' : {}}
     logger.info('Task Starting')
     USER_TAG = '{}_'.format(username)
-    vlans = database.get_vlan(username)
+    if details:
+        vlans = database.get_vlan_details(username, min_version=min_version)
+        vlans = {name: {'tag': x['tag'], 'switch': x['switch']} for name, x in vlans.items()}
+    else:
+        vlans = database.get_vlan(username, min_version=min_version)
     answer = {}
-    for name, tag in vlans.items():
-        answer[name.replace(USER_TAG, '')] = tag
+    for name, value in vlans.items():
+        answer[name.replace(USER_TAG, '')] = value
     resp['content'] = answer
     logger.info('Task Completed')
     return resp
 
 
 @app.task(name='vlan.delete', bind=True)
-def delete(self, username, vlan_name, txn_id):
-    """Delete a vLAN owned by the user.
+def delete(self, username, vlan_name, txn_id, callback_url=None):
+    """Delete a vLAN owned by the user. The vLAN is only marked as deleted;
+    ``vlan.reap`` destroys its network later.
 
     :Returns: Dictionary
 
@@ -72,31 +177,22 @@ def delete(self, username, vlan_name, txn_id):
 
     :param vlan_name: The kind of vLAN to make, like FrontEnd or BackEnd
     :type vlan_name: String
+
+    :param callback_url: Where to send the result once the task is done; see ``send_callback``
+    :type callback_url: String
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
     resp = {'error' : None, 'content': {}, 'params': {'vlan_name': vlan_name}}
     logger.info('Task Starting')
-    owns = database.get_vlan(username).get(vlan_name, None)
-    if not owns:
-        error = "Unable to delete vLAN you do not own"
-        resp['error'] = error
-        return resp
-    try:
-        delete_network(vlan_name)
-    except ValueError as doh:
-        logger.exception(doh)
-        resp['error'] = '{}'.format(doh)
-        return resp
-    try:
-        database.delete_vlan(username=username, vlan_name=vlan_name)
-    except (RuntimeError, ValueError) as doh:
-        resp['error'] = '{}'.format(doh)
+    errors = {}
+    _mark_deleting(username, [vlan_name], errors, txn_id, logger)
+    resp['error'] = errors.get(vlan_name, None)
     logger.info('Task Completed')
     return resp
 
 
 @app.task(name='vlan.create', bind=True)
-def create(self, username, vlan_name, switch_name, txn_id):
+def create(self, username, vlan_name, switch_name, txn_id, callback_url=None):
     """Create a vLAN for the user.
 
     :Returns: Dictionary
@@ -106,29 +202,647 @@ def create(self, username, vlan_name, switch_name, txn_id):
 
     :param vlan_name: The kind of vLAN to make, like FrontEnd or BackEnd
     :type vlan_name: String
+
+    :param callback_url: Where to send the result once the task is done; see ``send_callback``
+    :type callback_url: String
     """
     logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
     resp = {'error' : None, 'content': {},
             'params': {'vlan_name': vlan_name, 'switch_name': switch_name}}
     logger.info('Task Starting')
+    _reap_names([vlan_name], logger)
     try:
-        vlan_tag_id = database.register_vlan(username=username, vlan_name=vlan_name, logger=logger)
+        vlan_tag_id = _claim_warm_portgroup(username, vlan_name, switch_name, txn_id, logger)
+        if vlan_tag_id is not None:
+            database.invalidate_vlan_cache(username)
+            logger.info('Task Completed')
+            return resp
+        vlan_tag_id = database.register_vlan(username=username, vlan_name=vlan_name,
+                                             logger=logger, switch_name=switch_name)
     except ValueError as doh:
         resp['error'] = '{}'.format(doh)
         return resp
 
     try:
-        error = create_network(vlan_name, vlan_tag_id, switch_name)
+        error, moid = create_network(vlan_name, vlan_tag_id, switch_name)
     except Exception as doh:
         resp['error'] = '{}'.format(doh)
     else:
         resp['error'] = error
+        if not error:
+            _record_portgroups({vlan_name: (switch_name, moid)}, logger)
     if resp['error']:
         try:
             # Delete the record in the DB to keep VMware & the DB records in sync
             # otherwise, we'll leak vLAN tag ids
             database.delete_vlan(username=username, vlan_name=vlan_name)
         except Exception as doh:
-            logger.traceback(doh)
+            logger.exception(doh)
+    database.invalidate_vlan_cache(username)
     logger.info('Task Completed')
     return resp
+
+
+@app.task(name='vlan.provision', bind=True)
+def provision(self, username, vlan_name, switch_name, txn_id, callback_url=None):
+    """Make the portgroup of a vLAN that the API already reserved a tag for.
+
+    The vLAN is ``ready`` once its portgroup exists, or ``failed`` with the
+    error if it cannot be made. Either way, the record keeps its tag until the
+    user deletes the vLAN.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to create a vLAN
+    :type username: String
+
+    :param vlan_name: The full name of the reserved vLAN
+    :type vlan_name: String
+
+    :param switch_name: The name of the switch to add the new vLAN to
+    :type switch_name: String
+
+    :param callback_url: Where to send the result once the task is done; see ``send_callback``
+    :type callback_url: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+    resp = {'error' : None, 'content': {},
+            'params': {'vlan_name': vlan_name, 'switch_name': switch_name}}
+    logger.info('Task Starting')
+    reserved = database.start_provisioning(username, vlan_name)
+    if reserved is None:
+        # Already picked up by another delivery of this task, or deleted
+        resp['error'] = 'vLAN {} is not waiting to be made'.format(vlan_name)
+        logger.info('Task Completed')
+        return resp
+    vlan_tag_id, moid = reserved
+    _reap_names([vlan_name], logger)
+    try:
+        if moid:
+            error = rename_network(moid, vlan_name)
+        else:
+            error, moid = create_network(vlan_name, vlan_tag_id, switch_name)
+    except Exception as doh:
+        logger.exception(doh)
+        error = '{}'.format(doh)
+    if error:
+        resp['error'] = error
+        try:
+            database.fail_vlan(username, vlan_name, error)
+        except Exception as doh:
+            logger.exception(doh)
+    else:
+        _record_portgroups({vlan_name: (switch_name, moid)}, logger)
+        if reserved[1]:
+            replenish.apply_async(kwargs={'txn_id': txn_id, 'switch_names': [switch_name]})
+    database.invalidate_vlan_cache(username)
+    resp['content'] = {'tag': vlan_tag_id, 'state': 'failed' if error else 'ready'}
+    logger.info('Task Completed')
+    return resp
+
+
+@app.task(name='vlan.create_batch', bind=True)
+def create_batch(self, username, vlan_names, switch_name, txn_id, callback_url=None):
+    """Create many vLANs on the same switch for the user.
+
+    All the vLAN tags are allocated in one database transaction, and all the
+    networks are made with one vCenter task. Any vLAN that cannot be made is
+    removed from the database, without affecting the vLANs that were made.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to create the vLANs
+    :type username: String
+
+    :param vlan_names: The kinds of vLANs to make, like FrontEnd and BackEnd
+    :type vlan_names: List
+
+    :param switch_name: The name of the switch to add the new vLANs to
+    :type switch_name: String
+
+    :param callback_url: Where to send the result once the task is done; see ``send_callback``
+    :type callback_url: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+    resp = {'error' : None, 'content': {},
+            'params': {'vlan_names': vlan_names, 'switch_name': switch_name}}
+    logger.info('Task Starting')
+    vlan_tags, errors = database.register_vlans(username=username, vlan_names=vlan_names,
+                                                logger=logger, switch_name=switch_name)
+    if vlan_tags:
+        _reap_names(sorted(vlan_tags.keys()), logger)
+        try:
+            results, moids = create_networks(vlan_tags, switch_name)
+        except Exception as doh:
+            results, moids = {name: '{}'.format(doh) for name in vlan_tags.keys()}, {}
+        errors.update({name: error for name, error in results.items() if error})
+        portgroups = {name: (switch_name, moids.get(name, None)) for name in vlan_tags.keys() if name not in errors}
+        if portgroups:
+            _record_portgroups(portgroups, logger)
+        failed = [name for name in vlan_tags.keys() if name in errors]
+        if failed:
+            try:
+                # Only roll back the vLANs that failed; keeps VMware & the DB records in sync
+                database.delete_vlans(username=username, vlan_names=failed)
+            except Exception as doh:
+                logger.exception(doh)
+        database.invalidate_vlan_cache(username)
+    USER_TAG = '{}_'.format(username)
+    for name in vlan_names:
+        short_name = name.replace(USER_TAG, '', 1)
+        if name in errors:
+            resp['content'][short_name] = {'tag': None, 'error': errors[name]}
+        else:
+            resp['content'][short_name] = {'tag': vlan_tags[name], 'error': None}
+    if errors:
+        resp['error'] = 'Unable to create {} of {} vLANs'.format(len(errors), len(vlan_names))
+    logger.info('Task Completed')
+    return resp
+
+
+@app.task(name='vlan.delete_batch', bind=True)
+def delete_batch(self, username, vlan_names, txn_id, callback_url=None):
+    """Delete many vLANs owned by the user. The vLANs are only marked as deleted;
+    ``vlan.reap`` destroys their networks later.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who wants to destroy the vLANs
+    :type username: String
+
+    :param vlan_names: The kinds of vLANs to destroy, like FrontEnd and BackEnd
+    :type vlan_names: List
+
+    :param callback_url: Where to send the result once the task is done; see ``send_callback``
+    :type callback_url: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+    resp = {'error' : None, 'content': {}, 'params': {'vlan_names': vlan_names}}
+    logger.info('Task Starting')
+    errors = {}
+    _mark_deleting(username, vlan_names, errors, txn_id, logger)
+    resp['content'] = _batch_results(username, vlan_names, errors)
+    if errors:
+        resp['error'] = 'Unable to delete {} of {} vLANs'.format(len(errors), len(vlan_names))
+    logger.info('Task Completed')
+    return resp
+
+
+@app.task(name='vlan.delete_all', bind=True)
+def delete_all(self, username, txn_id):
+    """Delete every vLAN a user owns.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user whose vLANs should be destroyed
+    :type username: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+    resp = {'error' : None, 'content': {}, 'params': {'username': username}}
+    logger.info('Task Starting')
+    errors = {}
+    vlan_names = _mark_deleting(username, None, errors, txn_id, logger)
+    resp['content'] = _batch_results(username, vlan_names, errors)
+    if errors:
+        resp['error'] = 'Unable to delete {} of {} vLANs'.format(len(errors), len(vlan_names))
+    logger.info('Task Completed')
+    return resp
+
+
+def _mark_deleting(username, vlan_names, errors, txn_id, logger):
+    """Mark vLANs as deleted in a single statement, then start ``vlan.reap`` to
+    destroy their networks.
+
+    :Returns: List - the names of the vLANs to delete; every vLAN the user owns
+              if ``vlan_names`` is None
+
+    :Raises: The error from the database if ``vlan_names`` is None, since
+             there's nothing to report it against
+
+    :param username: The name of the user who owns the vLANs
+    :type username: String
+
+    :param vlan_names: The full names of the vLANs to delete, or None to delete every vLAN the user owns
+    :type vlan_names: List
+
+    :param errors: Updated in place with the error message of each vLAN that was not deleted
+    :type errors: Dictionary
+
+    :param txn_id: A client-supplied transaction id - makes debugging easier
+    :type txn_id: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    if vlan_names is not None and not vlan_names:
+        return vlan_names
+    try:
+        outcome = database.mark_deleting(username, vlan_names)
+    except Exception as doh:
+        if vlan_names is None:
+            raise
+        logger.exception(doh)
+        errors.update({name: '{}'.format(doh) for name in vlan_names})
+        return vlan_names
+    if vlan_names is None:
+        vlan_names = sorted(outcome.keys())
+    states = set(outcome.values())
+    if states & {'deleted', 'deleting'}:
+        database.invalidate_vlan_cache(username)
+    if 'deleting' in states:
+        reap.apply_async(kwargs={'txn_id': txn_id})
+    for name in vlan_names:
+        if name not in outcome:
+            errors[name] = 'Unable to delete vLAN you do not own'
+        elif outcome[name] not in ('deleted', 'deleting'):
+            errors[name] = 'vLAN {} is still being made; try again once it is ready'.format(name)
+    return vlan_names
+
+
+@app.task(name='vlan.reap', bind=True, rate_limit=const.VLAB_VLAN_REAP_RATE)
+def reap(self, txn_id):
+    """Destroy the networks of deleted vLANs, a batch of ``VLAB_VLAN_REAP_BATCH``
+    at a time. A vLAN's tag is only freed once vCenter has destroyed its network.
+    Failures are tried again later, waiting longer after each one.
+
+    :Returns: Dictionary
+
+    :param txn_id: A client-supplied transaction id - makes debugging easier
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+    resp = {'error' : None, 'content': {}, 'params': {}}
+    logger.info('Task Starting')
+    resp['content'] = _reap(database.claim_deleting(), logger)
+    logger.info('Task Completed')
+    return resp
+
+
+def _reap(vlans, logger):
+    """Destroy the networks of deleted vLANs, then free the tags of the ones
+    that are gone.
+
+    :Returns: Dictionary - how many vLANs were destroyed, and how many failed
+
+    :param vlans: The deleted vLANs, as returned by ``database.claim_deleting``
+    :type vlans: List
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    destroyed, failed = [], []
+    # A name can be deleted, made again, and deleted again, but each call to
+    # vCenter needs unique names
+    rounds = []
+    for vlan in vlans:
+        for names in rounds:
+            if vlan['vlan_name'] not in names:
+                names[vlan['vlan_name']] = vlan
+                break
+        else:
+            rounds.append({vlan['vlan_name']: vlan})
+    for names in rounds:
+        try:
+            results = delete_networks(sorted(names.keys()),
+                                      portgroups={name: vlan['portgroup'] for name, vlan in names.items()})
+        except Exception as doh:
+            logger.exception(doh)
+            results = {name: '{}'.format(doh) for name in names.keys()}
+        for name, vlan in names.items():
+            error = results.get(name, '')
+            if not error or error == NO_SUCH_VLAN.format(name):
+                destroyed.append(vlan)
+            else:
+                failed.append((vlan, error))
+    if destroyed:
+        database.release_deleted(destroyed)
+    if failed:
+        logger.error('Unable to destroy {} deleted vLANs'.format(len(failed)))
+        database.retry_deleting(failed)
+    return {'destroyed': len(destroyed), 'failed': len(failed)}
+
+
+def _reap_names(vlan_names, logger):
+    """Destroy any deleted vLANs that have the same names as new vLANs, so
+    vCenter is free to use the names again.
+
+    :Returns: None
+
+    :param vlan_names: The names of the new vLANs
+    :type vlan_names: List
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    try:
+        vlans = database.claim_deleting(limit=None, vlan_names=vlan_names)
+        if vlans:
+            _reap(vlans, logger)
+    except Exception as doh:
+        logger.exception(doh)
+
+
+@app.task(name='vlan.backfill', bind=True)
+def backfill(self, txn_id):
+    """Find the switch and portgroup of every vLAN record that was made before
+    they were stored in the database.
+
+    :Returns: Dictionary
+
+    :param txn_id: A client-supplied transaction id - makes debugging easier
+    :type txn_id: String
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+    resp = {'error' : None, 'content': {}, 'params': {}}
+    logger.info('Task Starting')
+    unmapped = database.get_unmapped_vlans()
+    found = find_portgroups(sorted(unmapped.keys())) if unmapped else {}
+    if found:
+        database.record_portgroups(found)
+        for owner in set([unmapped[name] for name in found.keys()]):
+            database.invalidate_vlan_cache(owner)
+    missing = sorted([name for name in unmapped.keys() if name not in found])
+    if missing:
+        logger.error('No portgroup found for vLANs: {}'.format(missing))
+    resp['content'] = {'updated': len(found), 'missing': missing}
+    logger.info('Task Completed')
+    return resp
+
+
+@app.task(name='vlan.replenish', bind=True)
+def replenish(self, txn_id, switch_names=None):
+    """Make portgroups ahead of time, until each switch in the warm pool has as
+    many ready as ``VLAB_VLAN_WARM_POOL_SWITCHES`` says it should.
+
+    :Returns: Dictionary
+
+    :param txn_id: A client-supplied transaction id - makes debugging easier
+    :type txn_id: String
+
+    :param switch_names: Only replenish these switches. Default is every switch in the warm pool.
+    :type switch_names: List
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+    resp = {'error' : None, 'content': {}, 'params': {'switch_names': switch_names}}
+    logger.info('Task Starting')
+    targets = database.get_warm_pool_targets()
+    for switch_name in sorted(targets.keys()):
+        if switch_names and switch_name not in switch_names:
+            continue
+        try:
+            tags = database.reserve_warm_tags(switch_name, targets[switch_name])
+        except ValueError as doh:
+            # The switch is not in VLAB_VLAN_SWITCHES, and has no pool of tags
+            logger.error('Unable to replenish warm pool: {}'.format(doh))
+            resp['content'][switch_name] = {'added': 0, 'failed': 0, 'error': '{}'.format(doh)}
+            continue
+        if not tags:
+            continue
+        names = {_warm_name(switch_name, tag): tag for tag in tags}
+        try:
+            errors, moids = create_networks(names, switch_name)
+        except Exception as doh:
+            logger.exception(doh)
+            errors, moids = {name: '{}'.format(doh) for name in names.keys()}, {}
+        made = {names[name]: moid for name, moid in moids.items()}
+        failed = [tag for name, tag in names.items() if errors.get(name, '')]
+        if made:
+            database.fill_warm_portgroups(switch_name, made)
+        if failed:
+            logger.error('Unable to make {} warm portgroups on switch {}'.format(len(failed), switch_name))
+            database.release_warm_tags(switch_name, failed)
+        resp['content'][switch_name] = {'added': len(made), 'failed': len(failed)}
+    logger.info('Task Completed')
+    return resp
+
+
+@app.task(name='vlan.reconcile', bind=True)
+def reconcile(self, txn_id, repair=const.VLAB_VLAN_RECONCILE_REPAIR):
+    """Compare the records against the portgroups in vCenter, and report where
+    they disagree. The first run in a worker process compares everything; later
+    runs only compare the records and portgroups that changed since.
+
+    :Returns: Dictionary
+
+    :param txn_id: A client-supplied transaction id - makes debugging easier
+    :type txn_id: String
+
+    :param repair: Set to True to also fix what was found. Records whose
+                   portgroup is gone, and vLANs stuck being made, are marked
+                   failed. Portgroups with no record are destroyed.
+    :type repair: Boolean
+    """
+    logger = get_task_logger(txn_id=txn_id, task_id=self.request.id, loglevel=const.VLAB_VLAN_LOG_LEVEL.upper())
+    resp = {'error' : None, 'content': {}, 'params': {'repair': repair}}
+    logger.info('Task Starting')
+    full, changes = get_portgroup_changes()
+    if full:
+        state = database.get_reconcile_state()
+    else:
+        names = [x['name'] for x in changes.values() if x]
+        state = database.get_reconcile_state(since=_reconcile_token['since'], moids=changes.keys(), names=names)
+    # Unchanged portgroups can still belong to changed records
+    portgroups = {moid: x for moid, x in changes.items() if x}
+    records = state['records'] + state['stuck']
+    portgroups.update(portgroup_mirror.get([x['portgroup'] for x in records if x['portgroup']]))
+    portgroups.update(dict(portgroup_mirror.find([x['vlan_name'] for x in records]).values()))
+    found = _diff(portgroups, state['records'], state['warm'], state['pools'], state['stuck'])
+    for kind in ('missing', 'stuck', 'orphans', 'mismatched'):
+        if found[kind]:
+            logger.warning('Found {} {} vLANs: {}'.format(len(found[kind]), kind, sorted(found[kind].keys())))
+    if repair:
+        _repair(found, logger)
+    _reconcile_token['since'] = state['token']
+    resp['content'] = {'full': full, 'adopted': sorted(found['adopt'].keys())}
+    resp['content'].update({kind: sorted(found[kind].keys()) for kind in ('missing', 'stuck', 'orphans', 'mismatched')})
+    logger.info('Task Completed')
+    return resp
+
+
+def _diff(portgroups, records, warm, pools, stuck):
+    """Find where the records and the portgroups in vCenter disagree.
+
+    :Returns: Dictionary - with these keys:
+
+              - ``adopt`` maps the name of a record without a portgroup id to
+                the (switch name, portgroup id) of the portgroup with its name and tag
+              - ``missing`` maps the name of a ready vLAN to its record, when
+                its portgroup does not exist
+              - ``stuck`` maps the name of a vLAN stuck being made to its record
+              - ``orphans`` maps the name of a portgroup, with a tag from a vLAN
+                tag pool, to its id, when no record or warm portgroup owns it
+              - ``mismatched`` maps the name of a vLAN to its record, when its
+                portgroup has a different tag
+
+    :param portgroups: Maps the id of each portgroup to compare to its name, tag and switch
+    :type portgroups: Dictionary
+
+    :param records: The records to compare, from ``database.get_reconcile_state``
+    :type records: List
+
+    :param warm: Maps the (switch name, tag) of each warm portgroup to its id
+    :type warm: Dictionary
+
+    :param pools: Maps each switch name to its (smallest, largest) tag
+    :type pools: Dictionary
+
+    :param stuck: The records of vLANs stuck being made
+    :type stuck: List
+    """
+    found = {'adopt': {}, 'missing': {}, 'stuck': {}, 'orphans': {}, 'mismatched': {}}
+    by_name = {x['name']: moid for moid, x in portgroups.items()}
+    for record in records:
+        if record['state'] != 'ready':
+            continue
+        name = record['vlan_name']
+        moid = record['portgroup']
+        if moid not in portgroups:
+            moid = by_name.get(name, None)
+            if moid is None:
+                found['missing'][name] = record
+                continue
+            found['adopt'][name] = (portgroups[moid]['switch'], moid)
+        if portgroups[moid]['tag'] != record['tag']:
+            found['mismatched'][name] = record
+    for record in stuck:
+        moid = by_name.get(record['vlan_name'], None)
+        if moid is not None and portgroups[moid]['tag'] == record['tag']:
+            found['adopt'][record['vlan_name']] = (portgroups[moid]['switch'], moid)
+        else:
+            found['stuck'][record['vlan_name']] = record
+    known_ids = set([x['portgroup'] for x in records + stuck]) | set(warm.values())
+    known_names = set([x['vlan_name'] for x in records + stuck]) | set([_warm_name(*x) for x in warm.keys()])
+    for moid, portgroup in portgroups.items():
+        if moid in known_ids or portgroup['name'] in known_names:
+            continue
+        tag_min, tag_max = pools.get(portgroup['switch'], (None, None))
+        if tag_min is not None and portgroup['tag'] is not None and tag_min <= portgroup['tag'] <= tag_max:
+            found['orphans'][portgroup['name']] = moid
+    return found
+
+
+def _repair(found, logger):
+    """Fix what ``_diff`` found, except for mismatched tags.
+
+    :Returns: None
+
+    :param found: The output of ``_diff``
+    :type found: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    owners = set()
+    if found['adopt']:
+        _record_portgroups(found['adopt'], logger)
+    failures = [(x, 'The portgroup of this vLAN no longer exists in vCenter') for x in found['missing'].values()]
+    failures += [(x, 'Timed out while making the vLAN') for x in found['stuck'].values()]
+    for record, error in failures:
+        try:
+            database.fail_vlan(record['person'], record['vlan_name'], error)
+        except Exception as doh:
+            logger.exception(doh)
+        owners.add(record['person'])
+    if found['orphans']:
+        try:
+            errors = delete_networks(sorted(found['orphans'].keys()), portgroups=found['orphans'])
+        except Exception as doh:
+            logger.exception(doh)
+        else:
+            failed = sorted([name for name, error in errors.items() if error and error != NO_SUCH_VLAN.format(name)])
+            if failed:
+                logger.error('Unable to destroy orphaned portgroups: {}'.format(failed))
+    # Records adopted by name are already listed the same way, so only failures change listings
+    for owner in owners:
+        database.invalidate_vlan_cache(owner)
+
+
+def _claim_warm_portgroup(username, vlan_name, switch_name, txn_id, logger):
+    """Make a vLAN by renaming a portgroup from the switch's warm pool, instead
+    of waiting on vCenter to make a new one.
+
+    :Returns: Integer - the vLAN tag, or None if no warm portgroup was used
+
+    :Raises: ValueError - If vLAN name is already taken
+
+    :param username: The name of the user who wants to create a vLAN
+    :type username: String
+
+    :param vlan_name: The full name of the new vLAN
+    :type vlan_name: String
+
+    :param switch_name: The name of the switch to add the new vLAN to
+    :type switch_name: String
+
+    :param txn_id: A client-supplied transaction id - makes debugging easier
+    :type txn_id: String
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    if switch_name not in database.get_warm_pool_targets():
+        return None
+    claimed = database.claim_warm_portgroup(username=username, vlan_name=vlan_name, switch_name=switch_name)
+    if claimed is None:
+        logger.info('No warm portgroup ready on switch {}'.format(switch_name))
+        return None
+    vlan_tag_id, moid = claimed
+    try:
+        error = rename_network(moid, vlan_name)
+    except Exception as doh:
+        error = '{}'.format(doh)
+    if error:
+        logger.error('Unable to use warm portgroup {}: {}'.format(moid, error))
+        try:
+            database.unclaim_warm_portgroup(username=username, vlan_name=vlan_name)
+        except Exception as doh:
+            logger.exception(doh)
+        return None
+    # The record was claimed as provisioning; this marks it ready
+    _record_portgroups({vlan_name: (switch_name, moid)}, logger)
+    replenish.apply_async(kwargs={'txn_id': txn_id, 'switch_names': [switch_name]})
+    return vlan_tag_id
+
+
+def _warm_name(switch_name, tag):
+    """The name of a warm portgroup, until it's claimed.
+
+    :Returns: String
+    """
+    return 'vlab-warm-{}-{}'.format(switch_name, tag)
+
+
+def _record_portgroups(portgroups, logger):
+    """Save where newly made vLANs live. A failure here does not fail the
+    create; the vLAN works, and ``vlan.backfill`` can record it later.
+
+    :Returns: None
+
+    :param portgroups: Maps vLAN names to a tuple of (switch name, portgroup managed object id)
+    :type portgroups: Dictionary
+
+    :param logger: An object for logging messages
+    :type logger: logging.LoggerAdapter
+    """
+    try:
+        database.record_portgroups(portgroups)
+    except Exception as doh:
+        logger.exception(doh)
+
+
+def _batch_results(username, vlan_names, errors):
+    """Build the per-vLAN content of a batch delete response.
+
+    :Returns: Dictionary
+
+    :param username: The name of the user who owns the vLANs
+    :type username: String
+
+    :param vlan_names: The full names of every vLAN in the batch
+    :type vlan_names: List
+
+    :param errors: Maps the full vLAN name to an error message
+    :type errors: Dictionary
+    """
+    USER_TAG = '{}_'.format(username)
+    return {name.replace(USER_TAG, '', 1): {'error': errors.get(name, None)} for name in vlan_names}
@@ -2,15 +2,686 @@
 """
 This module abstracts the VMware API for creating/deleting Distributed Virtual Portgroups.
 """
-from vlab_inf_common.vmware import vCenter, vim, consume_task
+import time
+import threading
+from concurrent.futures import Future
+
+from pyVmomi import vmodl
+from vlab_inf_common.vmware import vCenter, vim
 
 from vlab_vlan.lib import const
 
+# The error ``delete_networks`` gives for a network that does not exist; callers
+# that only want the network gone can treat it as destroyed
+NO_SUCH_VLAN = 'No such vLAN exists: {}'
+
+
+class SessionManager(object):
+    """Keeps a single, long-lived vCenter session for the worker process.
+
+    Logging into vCenter is slow, and vCenter limits how many sessions can be
+    open at once. Instead of a login/logout for every task, all tasks share
+    this session, which logs in again if vCenter has expired it.
+
+    :param host: The IP/FQDN of the vCenter server
+    :type host: String
+
+    :param user: The name of the user to connect to vCenter as
+    :type user: String
+
+    :param password: The vCenter user's password
+    :type password: String
+
+    :param port: The port to use when connecting to the vCenter server
+    :type port: Integer
+
+    :param check_interval: Sessions idle for longer than this many seconds are
+                           checked with vCenter before being reused.
+    :type check_interval: Integer
+    """
+    def __init__(self, host, user, password, port=443, check_interval=600):
+        self._host = host
+        self._user = user
+        self._password = password
+        self._port = port
+        self._check_interval = check_interval
+        self._vcenter = None
+        self._last_used = 0
+        self._lock = threading.RLock()
+
+    def get(self):
+        """Obtain the shared vCenter connection, logging in if needed.
+
+        :Returns: vlab_inf_common.vmware.vCenter
+        """
+        with self._lock:
+            idle = time.time() - self._last_used
+            if self._vcenter is not None and idle > self._check_interval:
+                if not self._is_authenticated():
+                    self._logout()
+            if self._vcenter is None:
+                self._vcenter = vCenter(host=self._host, user=self._user,
+                                        password=self._password, port=self._port)
+            self._last_used = time.time()
+            return self._vcenter
+
+    def run(self, func, *args, **kwargs):
+        """Call a function with the shared vCenter connection as its first
+        argument. If vCenter has expired the session, log in again and retry once.
+
+        :Returns: Whatever ``func`` returns
+
+        :param func: The function to call
+        :type func: Callable
+        """
+        vcenter = self.get()
+        try:
+            return func(vcenter, *args, **kwargs)
+        except vim.fault.NotAuthenticated:
+            self.reset(vcenter)
+            return func(self.get(), *args, **kwargs)
+
+    def reset(self, vcenter):
+        """Log out of a session vCenter has expired. Does nothing if another
+        thread already replaced that session.
+
+        :Returns: None
+
+        :param vcenter: The connection whose session has expired
+        :type vcenter: vlab_inf_common.vmware.vCenter
+        """
+        with self._lock:
+            if vcenter is self._vcenter:
+                self._logout()
+
+    def close(self):
+        """Log out of vCenter. The next call to ``get`` will log in again.
+
+        :Returns: None
+        """
+        with self._lock:
+            self._logout()
+
+    def _is_authenticated(self):
+        """Ask vCenter if the session is still valid
+
+        :Returns: Boolean
+        """
+        try:
+            return self._vcenter.content.sessionManager.currentSession is not None
+        except Exception:
+            return False
+
+    def _logout(self):
+        """Drop the current session. The caller must hold the lock.
+
+        :Returns: None
+        """
+        if self._vcenter is not None:
+            try:
+                self._vcenter.close()
+            except Exception:
+                # The session is already gone; there's nothing left to log out of
+                pass
+            self._vcenter = None
+
+
+class TaskWatcher(object):
+    """Waits on many vCenter tasks at once, using a single background thread.
+
+    Every task being waited on is kept in one vCenter ListView, and a single
+    PropertyCollector filter follows the state of every task in that view. The
+    background thread long-polls that collector with ``WaitForUpdatesEx``, so
+    vCenter is asked about all the tasks at once, no matter how many there are.
+    Callers hand a task to ``watch`` and get back a Future. A worker running many
+    threads (i.e. ``celery worker -P threads``) can then have many vCenter tasks
+    outstanding at once.
+
+    :param session: Supplies the vCenter connection used to watch the tasks
+    :type session: SessionManager
+
+    :param max_wait: The most seconds a single long-poll waits for vCenter to
+                     report a change. Timeouts are checked at least this often.
+    :type max_wait: Integer
+    """
+    def __init__(self, session, max_wait=5):
+        self._session = session
+        self._max_wait = max_wait
+        # Maps the task's id in vCenter to (task, future, deadline, timeout)
+        self._watching = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._vcenter = None
+        self._collector = None
+        self._view = None
+        self._version = ''
+        self._states = {}
+
+    def watch(self, task, timeout=300):
+        """Start tracking a vCenter task.
+
+        :Returns: concurrent.futures.Future - Its result is the result of the
+                  vCenter task. If the vCenter task fails or times out, the
+                  Future raises RuntimeError.
+
+        :param task: The vCenter task to track
+        :type task: vim.Task
+
+        :param timeout: How many seconds to wait for the task to complete
+        :type timeout: Integer
+        """
+        future = Future()
+        with self._lock:
+            self._watching[task._moId] = (task, future, time.time() + timeout, timeout)
+            view = self._view
+            # A forked worker process inherits a thread object, but not the thread
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='vcenter-task-watcher')
+                self._thread.daemon = True
+                self._thread.start()
+        if view is not None:
+            try:
+                # Also wakes up the pending WaitForUpdatesEx
+                view.ModifyListView(add=[task])
+            except Exception:
+                # The session changed; the new view is built with every watched task
+                pass
+        return future
+
+    def close(self):
+        """Stop tracking every vCenter task. Anything still waiting on one gets
+        a RuntimeError.
+
+        :Returns: None
+        """
+        with self._lock:
+            watching, self._watching = self._watching, {}
+        for task, future, _, _ in watching.values():
+            future.set_exception(RuntimeError('Stopped waiting on task {}'.format(task)))
+        self._unbind()
+
+    def _run(self):
+        """Long-poll vCenter until there are no tasks left to track.
+
+        :Returns: None
+        """
+        while True:
+            with self._lock:
+                if not self._watching:
+                    self._thread = None
+                    return
+            try:
+                self._bind()
+                options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=self._max_wait)
+                update = self._collector.WaitForUpdatesEx(self._version, options)
+            except vim.fault.NotAuthenticated:
+                self._session.reset(self._vcenter)
+                self._unbind()
+            except Exception:
+                # The collector is gone, or vCenter is unreachable; build a new one
+                self._unbind()
+                time.sleep(1)
+            else:
+                if update is not None:
+                    self._version = update.version
+                    self._apply(update)
+            self._expire()
+
+    def _bind(self):
+        """Create the ListView and PropertyCollector for the current vCenter
+        session. Does nothing if they already exist for this session.
+
+        :Returns: None
+        """
+        vcenter = self._session.get()
+        if vcenter is self._vcenter and self._collector is not None:
+            return
+        self._unbind()
+        content = vcenter.content
+        with self._lock:
+            tasks = [x[0] for x in self._watching.values()]
+        view = content.viewManager.CreateListView(obj=tasks)
+        collector = content.propertyCollector.CreatePropertyCollector()
+        collector.CreateFilter(get_task_filter_spec(view), partialUpdates=True)
+        with self._lock:
+            self._vcenter = vcenter
+            self._collector = collector
+            self._view = view
+            self._version = ''
+            self._states = {}
+            bound = set([x._moId for x in tasks])
+            missing = [x[0] for moid, x in self._watching.items() if moid not in bound]
+        if missing:
+            view.ModifyListView(add=missing)
+
+    def _unbind(self):
+        """Destroy the ListView and PropertyCollector, if they exist.
+
+        :Returns: None
+        """
+        with self._lock:
+            collector, self._collector = self._collector, None
+            view, self._view = self._view, None
+            self._vcenter = None
+        for destroy in (getattr(collector, 'DestroyPropertyCollector', None),
+                        getattr(view, 'DestroyView', None)):
+            if destroy is None:
+                continue
+            try:
+                destroy()
+            except Exception:
+                # Belongs to a session that no longer exists
+                pass
+
+    def _apply(self, update):
+        """Record the changes vCenter reported, and complete the Future of every
+        task that has finished.
+
+        :Returns: None
+
+        :param update: The changes to the tasks
+        :type update: vmodl.query.PropertyCollector.UpdateSet
+        """
+        finished = {}
+        for filter_set in update.filterSet:
+            for obj_update in filter_set.objectSet:
+                moid = obj_update.obj._moId
+                if obj_update.kind == 'leave':
+                    self._states.pop(moid, None)
+                    continue
+                state = self._states.setdefault(moid, {})
+                for change in obj_update.changeSet:
+                    state[change.name] = change.val
+                if state.get('info.state') in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+                    finished[moid] = self._states.pop(moid)
+        done = []
+        for moid, state in finished.items():
+            with self._lock:
+                entry = self._watching.pop(moid, None)
+            if entry is None:
+                continue
+            task, future, _, _ = entry
+            done.append(task)
+            if state['info.state'] == vim.TaskInfo.State.error:
+                error = state.get('info.error', None)
+                msg = error.msg if error is not None else 'Task {} failed'.format(task)
+                future.set_exception(RuntimeError(msg))
+            else:
+                future.set_result(state.get('info.result', None))
+        self._forget(done)
+
+    def _expire(self):
+        """Fail the Future of every task that has run out of time.
+
+        :Returns: None
+        """
+        now = time.time()
+        with self._lock:
+            expired = [moid for moid, x in self._watching.items() if x[2] < now]
+            expired = [self._watching.pop(moid) for moid in expired]
+        for task, future, _, timeout in expired:
+            msg = 'Timeout of {} seconds exceeded for task {}'.format(timeout, task)
+            future.set_exception(RuntimeError(msg))
+        self._forget([x[0] for x in expired])
+
+    def _forget(self, tasks):
+        """Stop vCenter from reporting changes to tasks no longer being watched.
+
+        :Returns: None
+
+        :param tasks: The tasks to remove from the ListView
+        :type tasks: List
+        """
+        if tasks and self._view is not None:
+            try:
+                self._view.ModifyListView(remove=tasks)
+            except Exception:
+                # Only costs some extra updates; the next session starts with a fresh view
+                pass
+
+
+class InventoryCache(object):
+    """Maps the names of one kind of vCenter object to the objects themselves.
+
+    Walking the vCenter inventory is slow, and objects like switches rarely
+    change, so the mapping is kept for ``ttl`` seconds. A name that is not in
+    the mapping causes a refresh, in case the object is new. The mapping is also
+    refreshed when the vCenter session changes, because the objects belong to
+    the session that found them.
+
+    :param vimtype: The kind of object to map, like vim.DistributedVirtualSwitch
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+    :param ttl: How many seconds the mapping is valid for
+    :type ttl: Integer
+    """
+    def __init__(self, vimtype, ttl=3600):
+        self._vimtype = vimtype
+        self._ttl = ttl
+        self._objects = {}
+        self._vcenter = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def get(self, vcenter, name):
+        """Look up an object by name.
+
+        :Returns: pyVmomi.VmomiSupport.ManagedObject
+
+        :Raises: KeyError - If vCenter has no object by that name
+
+        :param vcenter: The connection to look the object up with
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param name: The name of the object
+        :type name: String
+        """
+        return self.get_many(vcenter, [name])[name]
+
+    def get_many(self, vcenter, names):
+        """Look up many objects by name. The inventory is read at most once, no
+        matter how many of the names are unknown.
+
+        :Returns: Dictionary - maps each name to its object. Names vCenter has
+                  no object for are left out.
+
+        :param vcenter: The connection to look the objects up with
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param names: The names of the objects
+        :type names: List
+        """
+        with self._lock:
+            refreshed = self._refresh_if_stale(vcenter)
+            if not refreshed and not set(names).issubset(self._objects.keys()):
+                self._refresh(vcenter)
+            return {name: self._objects[name] for name in names if name in self._objects}
+
+    def names(self, vcenter):
+        """The names of every object.
+
+        :Returns: List
+
+        :param vcenter: The connection to look the objects up with
+        :type vcenter: vlab_inf_common.vmware.vCenter
+        """
+        with self._lock:
+            self._refresh_if_stale(vcenter)
+            return sorted(self._objects.keys())
+
+    def add(self, vcenter, objects):
+        """Remember some objects, like ones that were just made or renamed, so
+        looking them up does not read the inventory again. An object already
+        known by another name is only known by its new one.
+
+        :Returns: None
+
+        :param vcenter: The connection the objects belong to
+        :type vcenter: vlab_inf_common.vmware.vCenter
+
+        :param objects: Maps the name of each object to the object
+        :type objects: Dictionary
+        """
+        with self._lock:
+            if vcenter is not self._vcenter:
+                # The next lookup reads the inventory for that session anyway
+                return
+            moved = set(getattr(x, '_moId', x) for x in objects.values())
+            for name, obj in list(self._objects.items()):
+                if getattr(obj, '_moId', obj) in moved:
+                    del self._objects[name]
+            self._objects.update(objects)
+
+    def remove(self, names):
+        """Forget some objects, like ones that were just destroyed.
+
+        :Returns: None
+
+        :param names: The names of the objects to forget
+        :type names: List
+        """
+        with self._lock:
+            for name in names:
+                self._objects.pop(name, None)
+
+    def invalidate(self):
+        """Forget every object. The next lookup reads the inventory from vCenter.
+
+        :Returns: None
+        """
+        with self._lock:
+            self._objects = {}
+            self._vcenter = None
+            self._expires_at = 0
+
+    def _refresh_if_stale(self, vcenter):
+        """Read the inventory again if the TTL is up, or the session changed.
+        The caller must hold the lock.
+
+        :Returns: Boolean - True if the inventory was read
+        """
+        if vcenter is not self._vcenter or time.time() > self._expires_at:
+            self._refresh(vcenter)
+            return True
+        return False
+
+    def _refresh(self, vcenter):
+        """Read the inventory. The caller must hold the lock.
+
+        :Returns: None
+        """
+        self._objects = get_inventory(vcenter, self._vimtype)
+        self._vcenter = vcenter
+        self._expires_at = time.time() + self._ttl
+
+
+class PortgroupMirror(object):
+    """Keeps a copy of the name, vLAN tag, and switch of every portgroup in
+    vCenter, and reports what changed since the last look.
+
+    The first ``sync`` reads every portgroup with one PropertyCollector filter.
+    Every later ``sync`` hands the version token from the one before to
+    ``WaitForUpdatesEx``, so vCenter only sends the portgroups that were made,
+    changed, or destroyed since. The copy is read again from scratch when the
+    vCenter session changes, because the filter belongs to the session.
+    """
+    PATH_SET = ('name', 'config.defaultPortConfig.vlan', 'config.distributedVirtualSwitch')
+
+    def __init__(self):
+        self._vcenter = None
+        self._collector = None
+        self._view = None
+        self._version = ''
+        # Maps the portgroup's id in vCenter to the raw property values
+        self._props = {}
+        # Maps the portgroup's id in vCenter to its name, tag and switch
+        self._portgroups = {}
+        self._names = {}
+        self._switches = {}
+        self._lock = threading.Lock()
+
+    def sync(self, vcenter):
+        """Bring the copy up to date.
+
+        :Returns: Tuple - (Boolean, Dictionary). The Boolean is True if every
+                  portgroup was read, instead of only the changes. The Dictionary
+                  maps the id of every portgroup that changed to its name, tag
+                  and switch, or to None if it was destroyed.
+
+        :param vcenter: The connection to read the portgroups with
+        :type vcenter: vlab_inf_common.vmware.vCenter
+        """
+        with self._lock:
+            full = self._bind(vcenter)
+            changed = set()
+            try:
+                while True:
+                    options = vmodl.query.PropertyCollector.WaitOptions(maxWaitSeconds=0)
+                    update = self._collector.WaitForUpdatesEx(self._version, options)
+                    if update is None:
+                        break
+                    self._version = update.version
+                    changed.update(self._apply(update))
+                    if not update.truncated:
+                        break
+            except Exception:
+                # Start over with a full read next time
+                self._unbind()
+                raise
+            self._resolve(vcenter, changed)
+            return full, {moid: self._portgroups.get(moid, None) for moid in changed}
+
+    def get(self, moids):
+        """Look up portgroups by their id in vCenter, as of the last ``sync``.
+
+        :Returns: Dictionary - maps each id to the portgroup's name, tag and switch.
+                  Ids of portgroups that don't exist are left out.
+
+        :param moids: The managed object ids of the portgroups
+        :type moids: Iterable
+        """
+        with self._lock:
+            return {moid: self._portgroups[moid] for moid in moids if moid in self._portgroups}
+
+    def find(self, names):
+        """Look up portgroups by name, as of the last ``sync``.
+
+        :Returns: Dictionary - maps each name to a tuple of (managed object id,
+                  Dictionary of the name, tag and switch). Names of portgroups
+                  that don't exist are left out.
+
+        :param names: The names of the portgroups
+        :type names: Iterable
+        """
+        with self._lock:
+            found = {name: self._names[name] for name in names if name in self._names}
+            return {name: (moid, self._portgroups[moid]) for name, moid in found.items()}
+
+    def close(self):
+        """Forget every portgroup, and destroy the PropertyCollector.
+
+        :Returns: None
+        """
+        with self._lock:
+            self._unbind()
+
+    def _bind(self, vcenter):
+        """Create the ContainerView and PropertyCollector for a vCenter session.
+        Does nothing if they already exist for this session. The caller must
+        hold the lock.
+
+        :Returns: Boolean - True if they were created, and every portgroup will be read
+        """
+        if vcenter is self._vcenter and self._collector is not None:
+            return False
+        self._unbind()
+        content = vcenter.content
+        view = content.viewManager.CreateContainerView(container=content.rootFolder,
+                                                       type=[vim.dvs.DistributedVirtualPortgroup],
+                                                       recursive=True)
+        collector = content.propertyCollector.CreatePropertyCollector()
+        spec = get_inventory_filter_spec(view, vim.dvs.DistributedVirtualPortgroup, path_set=self.PATH_SET)
+        collector.CreateFilter(spec, partialUpdates=False)
+        self._vcenter = vcenter
+        self._collector = collector
+        self._view = view
+        return True
+
+    def _unbind(self):
+        """Destroy the ContainerView and PropertyCollector, and forget every
+        portgroup. The caller must hold the lock.
+
+        :Returns: None
+        """
+        for destroy in (getattr(self._collector, 'DestroyPropertyCollector', None),
+                        getattr(self._view, 'DestroyView', None)):
+            if destroy is None:
+                continue
+            try:
+                destroy()
+            except Exception:
+                # Belongs to a session that no longer exists
+                pass
+        self._vcenter = None
+        self._collector = None
+        self._view = None
+        self._version = ''
+        self._props = {}
+        self._portgroups = {}
+        self._names = {}
+        self._switches = {}
+
+    def _apply(self, update):
+        """Record the property values vCenter reported. The caller must hold the lock.
+
+        :Returns: Set - the ids of the portgroups that changed
+
+        :param update: The changes to the portgroups
+        :type update: vmodl.query.PropertyCollector.UpdateSet
+        """
+        changed = set()
+        for filter_set in update.filterSet:
+            for obj_update in filter_set.objectSet:
+                moid = obj_update.obj._moId
+                changed.add(moid)
+                if obj_update.kind == 'leave':
+                    self._props.pop(moid, None)
+                    continue
+                props = self._props.setdefault(moid, {})
+                for change in obj_update.changeSet:
+                    if change.op in ('remove', 'indirectRemove'):
+                        props.pop(change.name, None)
+                    else:
+                        props[change.name] = change.val
+        return changed
+
+    def _resolve(self, vcenter, changed):
+        """Turn the raw property values of the changed portgroups into their
+        name, tag, and switch name. The caller must hold the lock.
+
+        :Returns: None
+        """
+        for moid in changed:
+            old = self._portgroups.pop(moid, None)
+            if old is not None and self._names.get(old['name']) == moid:
+                self._names.pop(old['name'])
+        switch_ids = set()
+        for moid in changed:
+            switch = self._props.get(moid, {}).get('config.distributedVirtualSwitch', None)
+            if switch is not None:
+                switch_ids.add(switch._moId)
+        if not switch_ids.issubset(self._switches.keys()):
+            self._switches = {x._moId: name for name, x in get_inventory(vcenter, vim.DistributedVirtualSwitch).items()}
+        for moid in changed:
+            if moid not in self._props:
+                continue
+            props = self._props[moid]
+            vlan_id = getattr(props.get('config.defaultPortConfig.vlan', None), 'vlanId', None)
+            switch = props.get('config.distributedVirtualSwitch', None)
+            portgroup = {'name': props.get('name', None),
+                         # Trunk and private vLAN portgroups have no single tag
+                         'tag': vlan_id if isinstance(vlan_id, int) else None,
+                         'switch': self._switches.get(switch._moId, None) if switch is not None else None}
+            self._portgroups[moid] = portgroup
+            self._names[portgroup['name']] = moid
+
+
+vcenter_session = SessionManager(host=const.INF_VCENTER_SERVER,
+                                 user=const.INF_VCENTER_USER,
+                                 password=const.INF_VCENTER_PASSWORD,
+                                 port=const.INF_VCENTER_PORT,
+                                 check_interval=const.INF_VCENTER_SESSION_CHECK_INTERVAL)
+task_watcher = TaskWatcher(session=vcenter_session)
+switch_cache = InventoryCache(vim.DistributedVirtualSwitch, ttl=const.INF_VCENTER_SWITCH_CACHE_TTL)
+network_cache = InventoryCache(vim.Network, ttl=const.INF_VCENTER_NETWORK_CACHE_TTL)
+portgroup_mirror = PortgroupMirror()
+
 
 def create_network(name, vlan_id, switch_name):
     """Create a new network for VMs.
 
-    :Returns: String (error message)
+    :Returns: Tuple - (String error message, String managed object id of the new
+              portgroup). The id is None if the portgroup was not made.
 
     :param name: The name of the new distributed virtual portgroup
     :type name: String
@@ -21,25 +692,127 @@ def create_network(name, vlan_id, switch_name):
     :param switch_name: The name of the switch to add the new vLAN network to
     :type switch_name: String
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER,\
-                password=const.INF_VCENTER_PASSWORD) as vcenter:
-        try:
-            switch = vcenter.dv_switches[switch_name]
-        except KeyError:
-            available = list(vcenter.dv_switches.keys())
-            msg = 'No such switch: {}, Available: {}'.format(switch_name, available)
-            raise ValueError(msg)
-        spec = get_dv_portgroup_spec(name, vlan_id)
-        task = switch.AddDVPortgroup_Task([spec])
-        try:
-            consume_task(task, timeout=300)
-            error = ''
-        except RuntimeError as doh:
-            error = '{}'.format(doh)
-        return error
+    return vcenter_session.run(_create_network, name, vlan_id, switch_name)
+
+
+def _create_network(vcenter, name, vlan_id, switch_name):
+    """Does the work of ``create_network`` using the supplied vCenter connection.
+
+    :Returns: Tuple
+    """
+    errors, moids = _create_networks(vcenter, {name: vlan_id}, switch_name)
+    return errors[name], moids.get(name, None)
+
+
+def create_networks(vlans, switch_name):
+    """Create many new networks on the same switch, using a single vCenter task.
+
+    :Returns: Tuple - (Dictionary, Dictionary). The first maps each network name
+              to an error message; an empty string means the network was created.
+              The second maps the name of each network that was created to the
+              managed object id of its portgroup.
 
+    :Raises: ValueError - If the switch does not exist
 
-def delete_network(name):
+    :param vlans: Maps the name of each new distributed virtual portgroup to its vLAN tag id
+    :type vlans: Dictionary
+
+    :param switch_name: The name of the switch to add the new vLAN networks to
+    :type switch_name: String
+    """
+    return vcenter_session.run(_create_networks, vlans, switch_name)
+
+
+def _create_networks(vcenter, vlans, switch_name):
+    """Does the work of ``create_networks`` using the supplied vCenter connection.
+
+    :Returns: Tuple
+    """
+    switch = _get_switch(vcenter, switch_name)
+    specs = [get_dv_portgroup_spec(name, vlan_id) for name, vlan_id in vlans.items()]
+    # Unlike AddDVPortgroup_Task, the result of CreateDVPortgroup_Task is the new
+    # portgroup, so a single create never has to list the switch's portgroups
+    single = len(specs) == 1
+    try:
+        task = switch.CreateDVPortgroup_Task(specs[0]) if single else switch.AddDVPortgroup_Task(specs)
+    except vmodl.fault.ManagedObjectNotFound:
+        # The switch was deleted, and maybe re-created, since it was cached
+        switch_cache.invalidate()
+        switch = _get_switch(vcenter, switch_name)
+        task = switch.CreateDVPortgroup_Task(specs[0]) if single else switch.AddDVPortgroup_Task(specs)
+    created = None
+    try:
+        created = task_watcher.watch(task, timeout=300).result()
+        error = ''
+    except RuntimeError as doh:
+        # The task failed, but vCenter might have made some portgroups before it did
+        error = '{}'.format(doh)
+    if single and created is not None:
+        portgroups = {specs[0].name: created}
+    else:
+        portgroups = get_portgroups(vcenter, switch)
+    errors = {name: '' if name in portgroups else error for name in vlans.keys()}
+    moids = {name: portgroups[name]._moId for name in vlans.keys() if name in portgroups}
+    # So deleting them by name does not have to read the whole inventory again
+    network_cache.add(vcenter, {name: portgroups[name] for name in moids.keys()})
+    return errors, moids
+
+
+def _get_switch(vcenter, switch_name):
+    """Look up a Distributed Virtual Switch by name.
+
+    :Returns: vim.DistributedVirtualSwitch
+
+    :Raises: ValueError - If the switch does not exist
+
+    :param vcenter: The connection to look the switch up with
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param switch_name: The name of the switch
+    :type switch_name: String
+    """
+    try:
+        return switch_cache.get(vcenter, switch_name)
+    except KeyError:
+        available = switch_cache.names(vcenter)
+        msg = 'No such switch: {}, Available: {}'.format(switch_name, available)
+        raise ValueError(msg)
+
+
+def rename_network(portgroup, name):
+    """Give an existing portgroup a new name, like when a warm portgroup is
+    handed to a user.
+
+    :Returns: String (error message)
+
+    :param portgroup: The managed object id of the portgroup
+    :type portgroup: String
+
+    :param name: The new name of the portgroup
+    :type name: String
+    """
+    return vcenter_session.run(_rename_network, portgroup, name)
+
+
+def _rename_network(vcenter, portgroup, name):
+    """Does the work of ``rename_network`` using the supplied vCenter connection.
+
+    :Returns: String (error message)
+    """
+    network = _get_object(vcenter, vim.dvs.DistributedVirtualPortgroup, portgroup)
+    try:
+        task = network.Rename_Task(newName=name)
+    except vmodl.fault.ManagedObjectNotFound:
+        return 'No such portgroup: {}'.format(portgroup)
+    try:
+        task_watcher.watch(task, timeout=300).result()
+    except RuntimeError as doh:
+        return '{}'.format(doh)
+    network_cache.add(vcenter, {name: network})
+    return ''
+
+
+def delete_network(name, portgroup=None):
     """Destroy a vLAN network
 
     :Returns: None
@@ -48,20 +821,311 @@ def delete_network(name):
 
     :param name: The name of the network to destroy
     :type name: String
+
+    :param portgroup: The managed object id of the network's portgroup, if known
+    :type portgroup: String
     """
-    with vCenter(host=const.INF_VCENTER_SERVER, user=const.INF_VCENTER_USER, \
-                password=const.INF_VCENTER_PASSWORD) as vcenter:
+    vcenter_session.run(_delete_network, name, portgroup)
+
+
+def _delete_network(vcenter, name, portgroup=None):
+    """Does the work of ``delete_network`` using the supplied vCenter connection.
+
+    :Returns: None
+
+    :Raises: ValueError
+    """
+    portgroups = {name: portgroup} if portgroup else {}
+    error = _delete_networks(vcenter, [name], portgroups)[name]
+    if error:
+        raise ValueError(error)
+
+
+def delete_networks(names, portgroups=None):
+    """Destroy many vLAN networks. All the networks are destroyed concurrently
+    by vCenter.
+
+    :Returns: Dictionary - maps each network name to an error message. An empty
+              string means the network was destroyed, and ``NO_SUCH_VLAN``
+              that it does not exist.
+
+    :param names: The names of the networks to destroy
+    :type names: List
+
+    :param portgroups: Maps network names to the managed object id of their
+                       portgroup. Networks not in here are looked up by name.
+    :type portgroups: Dictionary
+    """
+    return vcenter_session.run(_delete_networks, names, portgroups)
+
+
+def _delete_networks(vcenter, names, portgroups=None):
+    """Does the work of ``delete_networks`` using the supplied vCenter connection.
+
+    :Returns: Dictionary
+    """
+    portgroups = portgroups if portgroups else {}
+    networks = {name: _get_object(vcenter, vim.dvs.DistributedVirtualPortgroup, portgroups[name])
+                for name in names if portgroups.get(name, None)}
+    unknown = [name for name in names if name not in networks]
+    if unknown:
+        # Enumerating every network in vCenter can take longer than the destroy,
+        # so networks are found via an index kept by the worker process.
+        networks.update(network_cache.get_many(vcenter, unknown))
+    errors = {}
+    futures = {}
+    for name in names:
+        try:
+            network = networks[name]
+        except KeyError:
+            errors[name] = NO_SUCH_VLAN.format(name)
+            continue
         try:
-            network = vcenter.networks[name]
+            task = _destroy(vcenter, name, network, find_again=name not in portgroups)
         except KeyError:
-            msg = 'No such vLAN exists: {}'.format(name)
-            raise ValueError(msg)
+            errors[name] = NO_SUCH_VLAN.format(name)
+            continue
+        if task is None:
+            # The portgroup was already destroyed
+            errors[name] = ''
+            continue
+        # Start every destroy before waiting on any, so vCenter works on them all at once
+        futures[name] = task_watcher.watch(task, timeout=300)
+    for name, future in futures.items():
         try:
-            task = network.Destroy_Task()
-            consume_task(task, timeout=300)
+            future.result()
+            errors[name] = ''
         except RuntimeError:
-            msg = "Network {} in use. Must delete VMs using network before deleting network.".format(name)
-            raise ValueError(msg)
+            errors[name] = "Network {} in use. Must delete VMs using network before deleting network.".format(name)
+    network_cache.remove([name for name, error in errors.items() if not error])
+    return errors
+
+
+def _destroy(vcenter, name, network, find_again=True):
+    """Start destroying a network. If the network in the index no longer exists,
+    look it up again, in case it was re-created.
+
+    :Returns: vim.Task, or None if the network no longer exists and was not looked up again
+
+    :Raises: KeyError - If the network does not exist
+
+    :param vcenter: The connection to look the network up with
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param name: The name of the network
+    :type name: String
+
+    :param network: The network, as found in the index
+    :type network: vim.Network
+
+    :param find_again: Set to False when the network came from its managed object
+                       id, so a new network with the same name is left alone
+    :type find_again: Boolean
+    """
+    try:
+        return network.Destroy_Task()
+    except vmodl.fault.ManagedObjectNotFound:
+        if not find_again:
+            return None
+        network_cache.remove([name])
+        return network_cache.get(vcenter, name).Destroy_Task()
+
+
+def find_portgroups(names):
+    """Look up the switch and portgroup of many networks by name. Used to fill
+    in database records made before the portgroup was tracked.
+
+    :Returns: Dictionary - maps the name of each network that was found to a
+              tuple of (switch name, portgroup managed object id)
+
+    :param names: The names of the networks to look up
+    :type names: List
+    """
+    return vcenter_session.run(_find_portgroups, names)
+
+
+def _find_portgroups(vcenter, names):
+    """Does the work of ``find_portgroups`` using the supplied vCenter connection.
+
+    :Returns: Dictionary
+    """
+    switches = {x._moId: name for name, x in get_inventory(vcenter, vim.DistributedVirtualSwitch).items()}
+    wanted = set(names)
+    found = {}
+    path_set = ['name', 'config.distributedVirtualSwitch']
+    for obj, props in _retrieve_from_view(vcenter, vim.dvs.DistributedVirtualPortgroup, path_set):
+        if props.get('name') in wanted:
+            switch = props.get('config.distributedVirtualSwitch', None)
+            switch_name = switches.get(switch._moId, None) if switch is not None else None
+            found[props['name']] = (switch_name, obj._moId)
+    return found
+
+
+def get_portgroup_changes():
+    """Find the portgroups that were made, changed, or destroyed since the last
+    call. The first call in a worker process reports every portgroup.
+
+    :Returns: Tuple - see ``PortgroupMirror.sync``
+    """
+    return vcenter_session.run(portgroup_mirror.sync)
+
+
+def get_inventory(vcenter, vimtype):
+    """Find every object of one type, along with its name. All the names are
+    read with a single PropertyCollector call, instead of one call per object.
+
+    :Returns: Dictionary - maps the name of each object to the object
+
+    :param vcenter: The connection to look the objects up with
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param vimtype: The kind of object to find, like vim.DistributedVirtualSwitch
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+    """
+    return {props['name']: obj for obj, props in _retrieve_from_view(vcenter, vimtype, ['name'])}
+
+
+def get_portgroups(vcenter, switch):
+    """Find every portgroup on a switch, along with its name, using a single
+    PropertyCollector call.
+
+    :Returns: Dictionary - maps the name of each portgroup to the portgroup
+
+    :param vcenter: The connection to look the portgroups up with
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param switch: The switch the portgroups are on
+    :type switch: vim.DistributedVirtualSwitch
+    """
+    collector = vcenter.content.propertyCollector
+    return {props['name']: obj for obj, props in _retrieve(collector, get_portgroup_filter_spec(switch))}
+
+
+def _retrieve_from_view(vcenter, vimtype, path_set):
+    """Read some properties of every object of one type.
+
+    :Returns: List - of (object, Dictionary of property name -> value) tuples
+
+    :param vcenter: The connection to look the objects up with
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param vimtype: The kind of object to find
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+    :param path_set: The properties to read
+    :type path_set: List
+    """
+    content = vcenter.content
+    view = content.viewManager.CreateContainerView(container=content.rootFolder,
+                                                   type=[vimtype],
+                                                   recursive=True)
+    try:
+        spec = get_inventory_filter_spec(view, vimtype, path_set=path_set)
+        return _retrieve(content.propertyCollector, spec)
+    finally:
+        view.DestroyView()
+
+
+def _retrieve(collector, spec):
+    """Run a PropertyCollector filter, reading every page of results.
+
+    :Returns: List - of (object, Dictionary of property name -> value) tuples
+
+    :param collector: The PropertyCollector to use
+    :type collector: vmodl.query.PropertyCollector
+
+    :param spec: What to read
+    :type spec: vmodl.query.PropertyCollector.FilterSpec
+    """
+    options = vmodl.query.PropertyCollector.RetrieveOptions()
+    result = collector.RetrievePropertiesEx([spec], options)
+    found = []
+    while result is not None:
+        for obj in result.objects:
+            found.append((obj.obj, {x.name: x.val for x in obj.propSet}))
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(result.token)
+    return found
+
+
+def _get_object(vcenter, vimtype, moid):
+    """Make a usable object from a managed object id, without asking vCenter.
+
+    :Returns: pyVmomi.VmomiSupport.ManagedObject
+
+    :param vcenter: The connection the object will use
+    :type vcenter: vlab_inf_common.vmware.vCenter
+
+    :param vimtype: The kind of object
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+    :param moid: The managed object id, like ``dvportgroup-42``
+    :type moid: String
+    """
+    # vCenter does not offer the SOAP stub publicly, but every object needs it
+    return vimtype(moid, vcenter._conn._stub)
+
+
+def get_inventory_filter_spec(view, vimtype, path_set=('name',)):
+    """Obtain a PropertyCollector filter for some properties of every object
+    within a ContainerView.
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param view: The ContainerView holding the objects
+    :type view: vim.view.ContainerView
+
+    :param vimtype: The kind of object in the view
+    :type vimtype: pyVmomi.VmomiSupport.LazyType
+
+    :param path_set: The properties to read. Defaults to only the name.
+    :type path_set: List
+    """
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(name='objects',
+                                                            type=vim.view.ContainerView,
+                                                            path='view',
+                                                            skip=False)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vimtype, pathSet=list(path_set))
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+
+
+def get_portgroup_filter_spec(switch):
+    """Obtain a PropertyCollector filter for the name of every portgroup on a switch.
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param switch: The switch the portgroups are on
+    :type switch: vim.DistributedVirtualSwitch
+    """
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(name='portgroups',
+                                                            type=vim.DistributedVirtualSwitch,
+                                                            path='portgroup',
+                                                            skip=False)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=switch, skip=True, selectSet=[traversal])
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.dvs.DistributedVirtualPortgroup,
+                                                           pathSet=['name'])
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
+
+
+def get_task_filter_spec(view):
+    """Obtain a PropertyCollector filter that follows the state of every task
+    within a ListView.
+
+    :Returns: vmodl.query.PropertyCollector.FilterSpec
+
+    :param view: The ListView holding the tasks to follow
+    :type view: vim.view.ListView
+    """
+    traversal = vmodl.query.PropertyCollector.TraversalSpec(name='tasks',
+                                                            type=vim.view.ListView,
+                                                            path='view',
+                                                            skip=False)
+    obj_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+    prop_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.Task,
+                                                           pathSet=['info.state', 'info.error', 'info.result'])
+    return vmodl.query.PropertyCollector.FilterSpec(objectSet=[obj_spec], propSet=[prop_spec])
 
 
 def get_dv_portgroup_spec(name, vlan_id):